@@ -0,0 +1,295 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Background agent that keeps logged-in FTP connections between pyftpsync runs.
+
+The agent listens on a Unix socket in the state folder. When an FtpTarget
+with the 'agent' option is closed, it passes its control connection (the
+file descriptor, see SCM_RIGHTS) to the agent instead of sending QUIT. The
+next run that opens a target for the same host, port, and user gets that
+connection back, so TCP connect, login, and the keyring lookup are skipped.
+
+Idle connections are checked with NOOP every `check_interval` seconds and
+closed after `idle_timeout` seconds.
+The socket is only accessible by the current user, because clients get
+connections that are already logged in.
+"""
+from __future__ import print_function
+
+import array
+import errno
+import ftplib
+import json
+import os
+import socket
+import sys
+import time
+
+from ftpsync.targets import get_state_path
+
+
+#: File name of the agent's socket (inside the state folder)
+AGENT_SOCKET_NAME = "agent.sock"
+DEFAULT_IDLE_TIMEOUT = 5 * 60
+DEFAULT_CHECK_INTERVAL = 30
+#: Max. number of idle connections that are kept per host and user
+DEFAULT_MAX_IDLE = 4
+#: Clients give up after this number of seconds (and connect directly)
+CLIENT_TIMEOUT = 2.0
+_MAX_MSG_SIZE = 64 * 1024
+
+#: Passing file descriptors requires Unix sockets and sendmsg() (Python 3.3+)
+AGENT_SUPPORTED = hasattr(socket, "AF_UNIX") and hasattr(socket.socket, "sendmsg")
+
+
+def get_agent_path():
+    """Return the path of the agent's Unix socket."""
+    return get_state_path(AGENT_SOCKET_NAME)
+
+
+def get_agent_key(host, port, username):
+    """Return the key that identifies interchangeable connections."""
+    return "%s@%s:%s" % (username or "", host, port or 21)
+
+
+def _send_msg(sock, data, fd=None):
+    """Send a dict as JSON and optionally pass a file descriptor."""
+    ancdata = []
+    if fd is not None:
+        ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+    sock.sendmsg([json.dumps(data).encode("utf-8")], ancdata)
+
+
+def _recv_msg(sock):
+    """Return (dict, file descriptor or None) sent by _send_msg()."""
+    fds = array.array("i")
+    msg, ancdata, _flags, _addr = sock.recvmsg(_MAX_MSG_SIZE, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, cdata in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+    if not msg:
+        raise EOFError("agent connection closed")
+    return json.loads(msg.decode("utf-8")), (fds[0] if fds else None)
+
+
+def _wrap_ftp(fd, host, welcome, debug=0):
+    """Return an ftplib.FTP instance for a logged-in control connection."""
+    ftp = ftplib.FTP()
+    ftp.debug(debug)
+    ftp.sock = socket.socket(fileno=fd)
+    ftp.af = ftp.sock.family
+    ftp.file = ftp.sock.makefile("r", encoding=ftp.encoding)
+    ftp.host = host
+    ftp.welcome = welcome
+    return ftp
+
+
+#===============================================================================
+# AgentClient
+#===============================================================================
+class AgentClient(object):
+    """Borrow connections from and return them to a running agent.
+
+    All methods fail silently (returning None or False) if no agent is running.
+    """
+    def __init__(self, path=None, timeout=CLIENT_TIMEOUT):
+        self.path = path or get_agent_path()
+        self.timeout = timeout
+
+    def _request(self, data, fd=None):
+        if not AGENT_SUPPORTED or not os.path.exists(self.path):
+            return None, None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            _send_msg(sock, data, fd)
+            return _recv_msg(sock)
+        except (socket.error, EOFError, ValueError) as e:
+            if getattr(e, "errno", None) not in (errno.ENOENT, errno.ECONNREFUSED):
+                print("pyftpsync agent not available: %s" % e, file=sys.stderr)
+            return None, None
+        finally:
+            sock.close()
+
+    def get_connection(self, key, host, debug=0):
+        """Return a logged-in ftplib.FTP instance for `key` or None."""
+        res, fd = self._request({"cmd": "get", "key": key})
+        if fd is None:
+            return None
+        return _wrap_ftp(fd, host, res.get("welcome"), debug)
+
+    def put_connection(self, key, ftp):
+        """Hand `ftp` to the agent and return True (the caller must not use it afterwards)."""
+        res, _fd = self._request({"cmd": "put", "key": key, "welcome": ftp.welcome,
+                                  "host": ftp.host},
+                                 ftp.sock.fileno())
+        return bool(res and res.get("ok"))
+
+    def get_stats(self):
+        res, _fd = self._request({"cmd": "stats"})
+        return res
+
+    def stop(self):
+        res, _fd = self._request({"cmd": "stop"})
+        return bool(res and res.get("ok"))
+
+
+#===============================================================================
+# FtpAgent
+#===============================================================================
+class FtpAgent(object):
+    """Serve idle FTP connections to AgentClients (see module docstring)."""
+    def __init__(self, path=None, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 check_interval=DEFAULT_CHECK_INTERVAL, max_idle=DEFAULT_MAX_IDLE,
+                 verbose=3):
+        if not AGENT_SUPPORTED:
+            raise RuntimeError("The agent requires Unix sockets and Python 3.3+")
+        self.path = path or get_agent_path()
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.max_idle = max_idle
+        self.verbose = verbose
+        self.stats = {"agent_connections_kept": 0,
+                      "agent_connections_reused": 0,
+                      "agent_connections_expired": 0,
+                      "agent_connections_broken": 0,
+                      "agent_health_checks": 0,
+                      }
+        self._idle = {} # {key: [(ftp, last used), ...]}
+        self._sock = None
+        self._stop = False
+
+    def _listen(self):
+        if os.path.exists(self.path):
+            if AgentClient(self.path).get_stats() is not None:
+                raise RuntimeError("An agent is already listening on %s" % self.path)
+            os.remove(self.path) # left over from a crashed agent
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        sock.settimeout(self.check_interval)
+        self._sock = sock
+
+    def serve_forever(self):
+        """Handle requests until stop() or a 'stop' request."""
+        self._listen()
+        if self.verbose >= 3:
+            print("pyftpsync agent listening on %s" % self.path)
+        last_check = time.time()
+        try:
+            while not self._stop:
+                try:
+                    conn, _addr = self._sock.accept()
+                except socket.timeout:
+                    conn = None
+                if conn is not None:
+                    try:
+                        conn.settimeout(CLIENT_TIMEOUT)
+                        self._handle(conn)
+                    except (socket.error, EOFError, ValueError) as e:
+                        print("Invalid agent request: %s" % e, file=sys.stderr)
+                    finally:
+                        conn.close()
+                if time.time() - last_check >= self.check_interval:
+                    self.check_connections()
+                    last_check = time.time()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop = True
+
+    def _handle(self, conn):
+        req, fd = _recv_msg(conn)
+        cmd = req.get("cmd")
+        if cmd == "get":
+            ftp = self._pop_healthy(req["key"])
+            if ftp is None:
+                _send_msg(conn, {"ok": False})
+            else:
+                _send_msg(conn, {"ok": True, "welcome": ftp.welcome}, ftp.sock.fileno())
+                self.stats["agent_connections_reused"] += 1
+                ftp.close() # the client has its own copy of the descriptor now
+        elif cmd == "put":
+            if fd is None:
+                raise ValueError("'put' without connection")
+            idle = self._idle.setdefault(req["key"], [])
+            ftp = _wrap_ftp(fd, req.get("host"), req.get("welcome"))
+            if len(idle) < self.max_idle:
+                idle.append((ftp, time.time()))
+                self.stats["agent_connections_kept"] += 1
+            else:
+                self._quit(ftp)
+            _send_msg(conn, {"ok": True})
+        elif cmd == "stats":
+            res = dict(self.stats)
+            res["agent_idle_connections"] = sum(len(idle) for idle in self._idle.values())
+            res["ok"] = True
+            _send_msg(conn, res)
+        elif cmd == "stop":
+            self._stop = True
+            _send_msg(conn, {"ok": True})
+        else:
+            raise ValueError("Unknown command %r" % cmd)
+
+    def _pop_healthy(self, key):
+        """Return the most recently used idle connection that answers NOOP."""
+        idle = self._idle.get(key)
+        while idle:
+            ftp, _last_used = idle.pop()
+            if self._check(ftp):
+                return ftp
+        return None
+
+    def _check(self, ftp):
+        self.stats["agent_health_checks"] += 1
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except (ftplib.all_errors, ValueError):
+            self.stats["agent_connections_broken"] += 1
+            ftp.close()
+            return False
+
+    def _quit(self, ftp):
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+
+    def check_connections(self):
+        """Close expired connections and send NOOP to the others (so they are kept open)."""
+        now = time.time()
+        for key, idle in list(self._idle.items()):
+            keep = []
+            for ftp, last_used in idle:
+                if now - last_used >= self.idle_timeout:
+                    self.stats["agent_connections_expired"] += 1
+                    self._quit(ftp)
+                elif self._check(ftp):
+                    keep.append((ftp, last_used))
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def close(self):
+        """Stop listening and send QUIT to all idle connections."""
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        idle_lists, self._idle = self._idle, {}
+        for idle in idle_lists.values():
+            for ftp, _last_used in idle:
+                self._quit(ftp)
@@ -0,0 +1,602 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Asyncio based FTP target and upload synchronizer (requires Python 3.5+).
+
+AsyncFtpTarget keeps a pool of control connections, so many listings and
+transfers can be in flight at the same time. Unlike FtpTarget, there is no
+current directory: all coroutines take paths relative to root_dir.
+This module is only imported on demand, because it is not valid Python 2.
+"""
+import asyncio
+import ftplib
+import io
+import os
+from posixpath import join as join_url, dirname as dirname_url, \
+    normpath as normpath_url
+import re
+import sys
+import time
+
+from ftpsync import diff as diff_mod
+from ftpsync import targets
+from ftpsync.ftp_target import parse_mlsd_line, DEFAULT_RETRIES, NETWORK_ERRORS, \
+    DEFAULT_RETRY_DELAY, _RetriedCallback
+from ftpsync.resources import DirectoryEntry, FileEntry
+from ftpsync.synchronizers import UploadSynchronizer, check_unsupported_options
+from ftpsync.targets import _Target, DirMetadata, get_credentials_for_url, \
+    decode_meta, encode_meta
+
+
+DEFAULT_CONNECTIONS = 10
+DEFAULT_TIMEOUT = 60
+DEFAULT_BLOCKSIZE = targets.DEFAULT_BLOCKSIZE
+#: Errors that discard the connection and retry the operation
+TRANSIENT_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError,
+                    asyncio.TimeoutError) + NETWORK_ERRORS
+
+
+#===============================================================================
+# AsyncFtpConnection
+#===============================================================================
+class AsyncFtpConnection(object):
+    """A single FTP control connection (passive mode, binary transfers)."""
+
+    def __init__(self, host, port=None, timeout=DEFAULT_TIMEOUT, encoding="utf-8"):
+        self.host = host
+        self.port = port or 21
+        self.timeout = timeout
+        self.encoding = encoding
+        self.use_epsv = True
+        self.reader = None
+        self.writer = None
+
+    async def connect(self, username=None, password=None):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout)
+        await self._get_response()
+        resp = await self.sendcmd("USER %s" % (username or "anonymous"), expect="23")
+        if resp.startswith("3"):
+            await self.sendcmd("PASS %s" % (password or "anonymous@"))
+        await self.sendcmd("TYPE I")
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            await self.sendcmd("QUIT")
+        except (ftplib.Error, EOFError, OSError, asyncio.TimeoutError):
+            pass
+        self._close_writer(self.writer)
+        self.writer = None
+
+    @staticmethod
+    def _close_writer(writer):
+        try:
+            writer.close()
+        except OSError:
+            pass
+
+    async def _readline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise EOFError("Connection closed by server")
+        return line.decode(self.encoding, "replace").rstrip("\r\n")
+
+    async def _get_response(self, expect="2"):
+        """Read a (possibly multi-line) reply and raise ftplib errors like FTP.voidresp()."""
+        line = await self._readline()
+        lines = [line]
+        if line[3:4] == "-":
+            code = line[:3]
+            while True:
+                line = await self._readline()
+                lines.append(line)
+                if line[:3] == code and line[3:4] != "-":
+                    break
+        resp = "\n".join(lines)
+        if resp[:1] in expect:
+            return resp
+        elif resp[:1] == "4":
+            raise ftplib.error_temp(resp)
+        elif resp[:1] == "5":
+            raise ftplib.error_perm(resp)
+        raise ftplib.error_reply(resp)
+
+    async def sendcmd(self, cmd, expect="2"):
+        self.writer.write((cmd + "\r\n").encode(self.encoding))
+        await self.writer.drain()
+        return await self._get_response(expect)
+
+    async def _open_data(self, cmd):
+        """Open a passive data connection, send `cmd` and return (reader, writer)."""
+        port = None
+        if self.use_epsv:
+            try:
+                resp = await self.sendcmd("EPSV")
+                port = int(re.search(r"\(\|\|\|(\d+)\|\)", resp).group(1))
+            except (ftplib.error_perm, AttributeError):
+                self.use_epsv = False
+        if port is None:
+            # Like ftplib, we ignore the host address returned by PASV
+            resp = await self.sendcmd("PASV")
+            nums = re.search(r"(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)", resp).groups()
+            port = int(nums[4]) * 256 + int(nums[5])
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, port), self.timeout)
+        try:
+            await self.sendcmd(cmd, expect="1")
+        except BaseException:
+            self._close_writer(writer)
+            raise
+        return reader, writer
+
+    async def retrieve(self, cmd, callback, blocksize=DEFAULT_BLOCKSIZE):
+        """Send RETR, MLSD, ... and pass received data to `callback`."""
+        reader, writer = await self._open_data(cmd)
+        try:
+            while True:
+                data = await asyncio.wait_for(reader.read(blocksize), self.timeout)
+                if not data:
+                    break
+                callback(data)
+        finally:
+            self._close_writer(writer)
+        return await self._get_response()
+
+    async def store(self, cmd, fp, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+        """Send STOR and upload the content of file object `fp`."""
+        reader, writer = await self._open_data(cmd)
+        try:
+            while True:
+                buf = fp.read(blocksize)
+                if not buf:
+                    break
+                writer.write(buf)
+                await asyncio.wait_for(writer.drain(), self.timeout)
+                if callback:
+                    callback(buf)
+        finally:
+            self._close_writer(writer)
+        return await self._get_response()
+
+
+#===============================================================================
+# AsyncFtpTarget
+#===============================================================================
+class AsyncFtpTarget(_Target):
+    """FTP target with coroutine methods that may be called concurrently.
+
+    Each operation borrows one of up to `connections` (option, default: 10)
+    control connections. Connections are opened lazily inside the running
+    event loop, so open() only marks the target as connected.
+    """
+    def __init__(self, path, host, port=None, username=None, password=None, extra_opts=None):
+        path = path or "/"
+        super(AsyncFtpTarget, self).__init__(path, extra_opts)
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.features = None # Set by the first connection
+        self._idle = []
+        self._sem = None
+        self._probe_lock = None
+
+    def __str__(self):
+        return "<async-ftp:%s%s>" % (self.host, self.root_dir)
+
+    def get_base_name(self):
+        return "ftp:%s%s" % (self.host, self.root_dir)
+
+    def get_id(self):
+        return self.host + self.root_dir
+
+    def open(self):
+        if self.username is None or self.password is None:
+            creds = get_credentials_for_url(self.host, allow_prompt=False)
+            if creds:
+                self.username, self.password = creds
+        self.connected = True
+
+    def close(self):
+        """Mark as closed (use `await aclose()` to terminate open connections)."""
+        self.connected = False
+
+    async def aclose(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            await conn.close()
+        self._sem = None # bound to the current event loop
+        self._probe_lock = None
+        self.connected = False
+
+    def get_capabilities(self):
+        return {"hash_algos": [],
+                "set_time": "MFMT" if self.support_set_time else False,
+                "rest_stream": False,
+                "mode_z": False,
+                }
+
+    def _abs_path(self, rel_path):
+        return normpath_url(join_url(self.root_dir or "/", rel_path or "."))
+
+    def _inc_stat(self, name, ofs=1):
+        if self.synchronizer:
+            self.synchronizer._inc_stat(name, ofs)
+
+    async def _acquire(self):
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.get_option("connections", DEFAULT_CONNECTIONS))
+            self._probe_lock = asyncio.Lock()
+        await self._sem.acquire()
+        if self._idle:
+            return self._idle.pop()
+        try:
+            conn = AsyncFtpConnection(self.host, self.port,
+                                      self.get_option("timeout", DEFAULT_TIMEOUT))
+            await conn.connect(self.username, self.password)
+            self._inc_stat("ftp_connections")
+            if self.features is None:
+                # Other new connections wait until the first one has probed
+                async with self._probe_lock:
+                    if self.features is None:
+                        await self._probe(conn)
+        except BaseException:
+            self._sem.release()
+            raise
+        return conn
+
+    def _release(self, conn, broken=False):
+        if broken:
+            AsyncFtpConnection._close_writer(conn.writer)
+        else:
+            self._idle.append(conn)
+        self._sem.release()
+
+    async def _probe(self, conn):
+        """Check FEAT for MLST and MFMT."""
+        features = {}
+        try:
+            resp = await conn.sendcmd("FEAT")
+        except ftplib.error_perm:
+            resp = ""
+        for line in resp.splitlines()[1:-1]:
+            feat, _, params = line.strip().partition(" ")
+            if feat:
+                features[feat.upper()] = params.strip()
+        self.support_set_time = "MFMT" in features and not self.get_option("no_set_time")
+        if self.support_set_time:
+            self.mtime_precision = 1
+        self.features = features
+
+    async def _call(self, func, *args):
+        """Run `await func(conn, *args)` on a pooled connection.
+
+        Broken connections are discarded and the call is repeated on another
+        connection (see FtpTarget's @_retry_transient).
+        """
+        retries = self.get_option("retries", DEFAULT_RETRIES)
+        delay = self.get_option("retry_delay", DEFAULT_RETRY_DELAY)
+        attempt = 0
+        while True:
+            try:
+                conn = await self._acquire()
+            except TRANSIENT_ERRORS as e:
+                conn, error = None, e
+            else:
+                try:
+                    res = await func(conn, *args)
+                except ftplib.error_perm:
+                    self._release(conn)
+                    raise
+                except TRANSIENT_ERRORS as e:
+                    self._release(conn, broken=True)
+                    error = e
+                except BaseException:
+                    self._release(conn, broken=True)
+                    raise
+                else:
+                    self._release(conn)
+                    return res
+            if attempt >= retries:
+                raise error
+            attempt += 1
+            print("%s failed (%s): retry %s/%s in %s sec..."
+                  % (func.__name__, error, attempt, retries, delay), file=sys.stderr)
+            self._inc_stat("ftp_retries")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+    async def get_dir(self, rel_dir=""):
+        """Return (entry_list, meta_dict) for a remote folder.
+
+        Mtimes are adjusted from the folder's meta data file, like
+        FtpTarget.get_dir() does. meta_dict is None if there was no meta file.
+        """
+        path = self._abs_path(rel_dir)
+        entry_map = {}
+        has_meta = False
+        for name, res_type, size, mtime, unique in await self._mlsd(rel_dir):
+            if res_type == "dir":
+                entry_map[name] = DirectoryEntry(self, path, name, size, mtime, unique)
+            elif res_type == "file":
+                if name == DirMetadata.META_FILE_NAME:
+                    has_meta = True
+                elif name != DirMetadata.DEBUG_META_FILE_NAME:
+                    entry_map[name] = FileEntry(self, path, name, size, mtime, unique)
+
+        meta = None
+        if has_meta:
+            try:
+                data = await self.read_file(join_url(rel_dir, DirMetadata.META_FILE_NAME))
+                self._inc_stat("meta_bytes_read", len(data))
+                meta = decode_meta(data)
+            except (ftplib.error_perm, ValueError, RuntimeError) as e:
+                print("Could not read meta info: %s" % e, file=sys.stderr)
+                meta = None
+        if meta is not None:
+            meta_files = meta.setdefault("files", {})
+            for name in list(meta_files.keys()):
+                info = meta_files[name]
+                entry = entry_map.get(name)
+                if (entry and entry.size == info.get("s")
+                        and entry.mtime <= info.get("u", 0)):
+                    entry.meta = info
+                    entry.mtime = info["m"]
+                else:
+                    del meta_files[name] # outdated or missing
+        return list(entry_map.values()), meta
+
+    async def _mlsd(self, rel_dir):
+        """Return parsed MLSD lines [(name, type, size, mtime, unique), ...]."""
+        path = self._abs_path(rel_dir)
+        buf = io.BytesIO()
+        async def _list(conn):
+            buf.seek(0)
+            buf.truncate()
+            await conn.retrieve("MLSD %s" % path, buf.write)
+        await self._call(_list)
+        return [parse_mlsd_line(line)
+                for line in buf.getvalue().decode("utf-8", "replace").splitlines()
+                if line]
+
+    async def read_file(self, rel_path):
+        """Return the content of a remote file as bytes."""
+        path = self._abs_path(rel_path)
+        buf = io.BytesIO()
+        async def _retr(conn):
+            buf.seek(0)
+            buf.truncate()
+            await conn.retrieve("RETR %s" % path, buf.write)
+        await self._call(_retr)
+        return buf.getvalue()
+
+    async def write_file(self, rel_path, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+        self.check_write(rel_path)
+        path = self._abs_path(rel_path)
+        pos = fp_src.tell()
+        if callback:
+            callback = _RetriedCallback(callback)
+        async def _stor(conn):
+            fp_src.seek(pos)
+            if callback:
+                callback.restart()
+            await conn.store("STOR %s" % path, fp_src, blocksize, callback)
+        await self._call(_stor)
+
+    async def write_meta(self, rel_dir, meta):
+        """Store a DirMetadata compatible dict (or remove it if it is empty)."""
+        rel_path = join_url(rel_dir, DirMetadata.META_FILE_NAME)
+        if not meta.get("files") and not meta.get("peer_sync") and not meta.get("hashes"):
+            await self.remove_file(rel_path)
+            return
+        data = encode_meta(meta, compact=self.get_option("meta_format") == "compact",
+                           use_gzip=self.get_option("meta_gzip", False))
+        await self.write_file(rel_path, io.BytesIO(data))
+        self._inc_stat("meta_bytes_written", len(data))
+
+    async def set_mtime(self, rel_path, mtime):
+        """Set mtime using MFMT and return True (or False if not supported)."""
+        if not self.support_set_time:
+            return False
+        path = self._abs_path(rel_path)
+        stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+        async def _mfmt(conn):
+            await conn.sendcmd("MFMT %s %s" % (stamp, path))
+        await self._call(_mfmt)
+        return True
+
+    async def remove_file(self, rel_path):
+        self.check_write(rel_path)
+        path = self._abs_path(rel_path)
+        async def _dele(conn):
+            await conn.sendcmd("DELE %s" % path)
+        await self._call(_dele)
+
+    async def mkdir(self, rel_path):
+        self.check_write(rel_path)
+        path = self._abs_path(rel_path)
+        async def _mkd(conn):
+            await conn.sendcmd("MKD %s" % path)
+        await self._call(_mkd)
+
+    async def rmdir(self, rel_path):
+        """Remove a remote folder and all of its content."""
+        self.check_write(rel_path)
+        jobs = []
+        # (list all files, including meta data files)
+        for name, res_type, _size, _mtime, _unique in await self._mlsd(rel_path):
+            sub_path = join_url(rel_path, name)
+            if res_type == "dir":
+                jobs.append(self.rmdir(sub_path))
+            elif res_type == "file":
+                jobs.append(self.remove_file(sub_path))
+        await asyncio.gather(*jobs)
+        path = self._abs_path(rel_path)
+        async def _rmd(conn):
+            await conn.sendcmd("RMD %s" % path)
+        await self._call(_rmd)
+
+
+#===============================================================================
+# AsyncUploadSynchronizer
+#===============================================================================
+class AsyncUploadSynchronizer(UploadSynchronizer):
+    """Upload local changes to an AsyncFtpTarget.
+
+    Remote folders are listed level by level and all transfers of a run are
+    started at once; the connection pool of the target limits how many of
+    them are actually in flight.
+    Files are compared like UploadSynchronizer does without sync info;
+    options that need the per-file copy path (see UNSUPPORTED_OPTIONS) are
+    rejected.
+    """
+    #: Options that are not available with --async
+    UNSUPPORTED_OPTIONS = ("compare", "verify", "journal", "order", "detect_moves", 
+                           "delta", "max_rate", "max_transfers_per_host", "atomic")
+
+    def __init__(self, local, remote, options):
+        if not isinstance(remote, AsyncFtpTarget):
+            raise ValueError("remote must be an AsyncFtpTarget: %s" % remote)
+        check_unsupported_options(options, self.UNSUPPORTED_OPTIONS, "with --async")
+        super(AsyncUploadSynchronizer, self).__init__(local, remote, options)
+
+    def run(self):
+        start = time.time()
+        info_strings = self.get_info_strings()
+        print("{0} {1}\n{2:>20} {3}".format(info_strings[0].capitalize(),
+                                            self.local.get_base_name(),
+                                            info_strings[1],
+                                            self.remote.get_base_name()))
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self._run())
+        finally:
+            loop.run_until_complete(self.remote.aclose())
+            loop.close()
+            asyncio.set_event_loop(None)
+        self._set_elap_stats(start)
+
+    async def _list_remote_tree(self, local_dirs):
+        """Return {rel_dir: ({name: entry}, meta)} for all remote folders that
+        also exist locally."""
+        res = {}
+        level = [""]
+        while level:
+            results = await asyncio.gather(*[self.remote.get_dir(d) for d in level])
+            next_level = []
+            for rel_dir, (entries, meta) in zip(level, results):
+                res[rel_dir] = (dict((e.name, e) for e in entries), meta)
+                self._inc_stat("remote_dirs")
+                for entry in entries:
+                    if entry.is_file():
+                        self._inc_stat("remote_files")
+                    elif join_url(rel_dir, entry.name) in local_dirs:
+                        next_level.append(join_url(rel_dir, entry.name))
+            level = next_level
+        return res
+
+    async def _run(self):
+        local_files, local_dirs = self._scan_tree(self.local)
+        self._stats["local_files"] = len(local_files)
+        self._stats["local_dirs"] = len(local_dirs)
+        remote_tree = await self._list_remote_tree(local_dirs)
+
+        mkdirs = [d for d in sorted(local_dirs) if d not in remote_tree]
+        for rel_dir in mkdirs:
+            self._log_action("copy", "new", ">", local_dirs[rel_dir], rel_path=rel_dir)
+        files_by_dir = {}
+        for rel_path, local_file in local_files.items():
+            files_by_dir.setdefault(dirname_url(rel_path), []).append(local_file)
+        eps = max(FileEntry.EPS_TIME, self.local.mtime_precision, self.remote.mtime_precision)
+        uploads = []
+        removals = []
+        for rel_dir, dir_files in sorted(files_by_dir.items()):
+            remote_entries = list(remote_tree.get(rel_dir, ({}, None))[0].values())
+            for status, local_file, remote_file in diff_mod.diff_listings(dir_files, 
+                                                                          remote_entries, eps):
+                if local_file is None:
+                    continue
+                self._inc_stat("entries_seen")
+                rel_path = join_url(rel_dir, local_file.name)
+                action = self._get_upload_action(status, local_file, remote_file)
+                if action:
+                    self._log_action("copy" if action != "older" else "restore", action, 
+                                     ">", local_file, rel_path=rel_path)
+                    uploads.append(rel_path)
+                elif status == diff_mod.EQUAL:
+                    self._log_action("", "equal", "=", local_file, min_level=4, 
+                                     rel_path=rel_path)
+
+        if self.options.get("delete"):
+            for rel_dir, (entry_map, _meta) in sorted(remote_tree.items()):
+                for name, entry in sorted(entry_map.items()):
+                    rel_path = join_url(rel_dir, name)
+                    if rel_path in local_files or rel_path in local_dirs:
+                        continue
+                    if not self.options.get("delete_unmatched") and not self._match(entry):
+                        continue
+                    self._log_action("delete", "missing", "X", entry, rel_path=rel_path)
+                    removals.append((rel_path, entry))
+
+        if self.dry_run:
+            self._stats["files_written"] = len(uploads)
+            return
+
+        # Parent folders must exist before we can upload into them
+        for depth in sorted(set(d.count("/") for d in mkdirs)):
+            level = [d for d in mkdirs if d.count("/") == depth]
+            await asyncio.gather(*[self.remote.mkdir(d) for d in level])
+            self._inc_stat("dirs_created", len(level))
+
+        jobs = [self._upload(rel_path, local_files[rel_path]) for rel_path in uploads]
+        jobs.extend(self._remove(rel_path, entry) for rel_path, entry in removals)
+        mtime_set = await asyncio.gather(*jobs)
+
+        # Store mtimes in meta data if the server cannot set them
+        metas = {}
+        for rel_path, is_set in zip(uploads, mtime_set):
+            if is_set:
+                continue
+            local_file = local_files[rel_path]
+            rel_dir = dirname_url(rel_path)
+            if rel_dir not in metas:
+                meta = remote_tree.get(rel_dir, ({}, None))[1]
+                metas[rel_dir] = meta or {"files": {}, "peer_sync": {}, "hashes": {}}
+            metas[rel_dir]["files"][local_file.name] = {"m": local_file.mtime,
+                                                        "s": local_file.size,
+                                                        "u": time.time(),
+                                                        }
+        for rel_path, entry in removals:
+            rel_dir = dirname_url(rel_path)
+            meta = metas.get(rel_dir) or remote_tree.get(rel_dir, ({}, None))[1]
+            if meta and meta.get("files", {}).pop(entry.name, None):
+                metas[rel_dir] = meta
+        await asyncio.gather(*[self.remote.write_meta(d, m) for d, m in metas.items()])
+
+    async def _upload(self, rel_path, local_file):
+        """Copy a local file and return True if its mtime was set on the server."""
+        start = time.time()
+        def _block_written(data):
+            self._inc_stat("bytes_written", len(data))
+            self._inc_stat("upload_bytes_written", len(data))
+        local_path = os.path.join(self.local.root_dir, rel_path.replace("/", os.sep))
+        with open(local_path, "rb") as fp_src:
+            await self.remote.write_file(rel_path, fp_src, callback=_block_written)
+        res = await self.remote.set_mtime(rel_path, local_file.mtime)
+        self._inc_stat("files_written")
+        self._inc_stat("upload_files_written")
+        self._inc_stat("upload_write_time", time.time() - start)
+        return res
+
+    async def _remove(self, rel_path, entry):
+        if entry.is_dir():
+            await self.remote.rmdir(rel_path)
+            self._inc_stat("dirs_deleted")
+        else:
+            await self.remote.remove_file(rel_path)
+            self._inc_stat("files_deleted")
@@ -0,0 +1,85 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Compare two directory listings in one sorted-merge pass.
+
+Listings are converted to name-sorted columns (name, size, mtime, is_dir).
+"""
+from __future__ import print_function
+
+from operator import attrgetter
+
+
+#: Both entries are equal (same type; files: same size and mtime within eps)
+EQUAL = "equal"
+#: The local file is newer / older than the remote file
+NEWER = "newer"
+OLDER = "older"
+#: The entry only exists on the local / remote target
+LOCAL_ONLY = "local_only"
+REMOTE_ONLY = "remote_only"
+#: Same mtime but different size, or a file and a directory with the same name
+DIFFERENT = "different"
+
+
+#===============================================================================
+# Listing
+#===============================================================================
+class Listing(object):
+    """Columnar view of a directory listing, sorted by name."""
+    def __init__(self, entries):
+        self.entries = sorted(entries, key=attrgetter("name"))
+        self.names = [e.name for e in self.entries]
+        self.sizes = [e.size or 0 for e in self.entries]
+        self.mtimes = [e.mtime or 0 for e in self.entries]
+        self.is_dir = [e.is_dir() for e in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def _classify(size_1, mtime_1, is_dir_1, size_2, mtime_2, is_dir_2, eps):
+    if is_dir_1 != is_dir_2:
+        return DIFFERENT
+    if is_dir_1:
+        return EQUAL
+    dt = mtime_1 - mtime_2
+    if dt > eps:
+        return NEWER
+    elif dt < -eps:
+        return OLDER
+    elif size_1 != size_2:
+        return DIFFERENT
+    return EQUAL
+
+
+def _merge_python(local, remote, eps):
+    res = []
+    i = j = 0
+    n_local = len(local)
+    n_remote = len(remote)
+    while i < n_local or j < n_remote:
+        if j >= n_remote or (i < n_local and local.names[i] < remote.names[j]):
+            res.append((LOCAL_ONLY, local.entries[i], None))
+            i += 1
+        elif i >= n_local or remote.names[j] < local.names[i]:
+            res.append((REMOTE_ONLY, None, remote.entries[j]))
+            j += 1
+        else:
+            status = _classify(local.sizes[i], local.mtimes[i], local.is_dir[i],
+                               remote.sizes[j], remote.mtimes[j], remote.is_dir[j], eps)
+            res.append((status, local.entries[i], remote.entries[j]))
+            i += 1
+            j += 1
+    return res
+
+
+def diff_listings(local_entries, remote_entries, eps):
+    """Return a name-sorted list of (status, local_entry, remote_entry) tuples.
+
+    `status` is EQUAL, NEWER, OLDER, LOCAL_ONLY, REMOTE_ONLY, or DIFFERENT;
+    mtimes are equal if they differ by `eps` seconds or less.
+    """
+    return _merge_python(Listing(local_entries), Listing(remote_entries), eps)
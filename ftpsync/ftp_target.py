@@ -7,12 +7,26 @@ from __future__ import print_function
 
 import calendar
 import ftplib
+import functools
 import io
+import json
+import math
+import os
+import socket
+from multiprocessing.pool import ThreadPool
 from posixpath import join as join_url, normpath as normpath_url, relpath as relpath_url
 import sys
+import threading
 import time
+import zlib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
 from ftpsync import targets
+from ftpsync.agent import AgentClient, get_agent_key
 from ftpsync.targets import _Target, DirMetadata, prompt_for_password,\
     save_password, get_credentials_for_url
 from ftpsync.resources import DirectoryEntry, FileEntry
@@ -20,10 +34,277 @@ from ftplib import error_perm
 
 DEFAULT_BLOCKSIZE = targets.DEFAULT_BLOCKSIZE
 
+#: Map hashlib names to algorithm names used by the FTP HASH command
+#: (http://tools.ietf.org/html/draft-bryan-ftpext-hash-02) and to the
+#: non-standard Xxxx commands
+HASH_ALGO_MAP = {"md5": ("MD5", "XMD5"),
+                 "sha1": ("SHA-1", "XSHA1"),
+                 "sha256": ("SHA-256", "XSHA256"),
+                 }
+
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_DELAY = 1.0
+try:
+    NETWORK_ERRORS = (ConnectionError, TimeoutError, socket.timeout, socket.gaierror)
+except NameError: # Python 2 (local file errors are IOError, not socket.error)
+    NETWORK_ERRORS = (socket.error, )
+#: Errors that may go away after reconnecting (e.g. '421 Timeout', dropped
+#: connections). 5xx replies (error_perm) and local file errors are permanent.
+TRANSIENT_ERRORS = (ftplib.error_temp, ftplib.error_reply, EOFError) + NETWORK_ERRORS
+
+#: Re-probe server capabilities after this number of seconds
+DEFAULT_HOST_INFO_TTL = 24 * 60 * 60
+#: File name of the persisted HOST_INFO (inside the state folder)
+HOST_INFO_FILE_NAME = "host_info.json"
+#: MLSD facts that we need (requesting only these keeps listings small)
+MLST_FACTS = ("type", "size", "modify", "unique")
+
+#: Files with these extensions are always/never transferred with MODE Z
+COMPRESSIBLE_EXTENSIONS = frozenset((
+    ".css", ".csv", ".htm", ".html", ".js", ".json", ".md", ".svg", ".txt", 
+    ".xml", ".yaml", ".yml"))
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    ".7z", ".bz2", ".gif", ".gz", ".jpeg", ".jpg", ".mp3", ".mp4", ".png", 
+    ".rar", ".webp", ".woff", ".woff2", ".xz", ".zip"))
+#: Other files are compressed if a sample has less entropy (bits per byte)
+MODE_Z_MAX_ENTROPY = 7.0
+MODE_Z_SAMPLE_SIZE = 4096
+MODE_Z_LEVEL = 6
+
+#: Atomic uploads are stored as '.<name>' + TEMP_SUFFIX and renamed afterwards
+TEMP_SUFFIX = ".pyftpsync-tmp"
+#: Values for the 'atomic' option: rename after each file, after each
+#: directory, or after the whole run
+ATOMIC_MODES = ("file", "dir", "plan")
+#: Temp files of other processes are only removed if they are older (seconds)
+TEMP_FILE_MAX_AGE = 24 * 60 * 60
+
+DEFAULT_DELETE_WORKERS = 4
+#: Uploads of local files are sent with socket.sendfile() in chunks of this
+#: size (progress is reported after each chunk)
+SENDFILE_BLOCKSIZE = 1024 * 1024
+#: Max. number of control commands that are sent before reading the replies
+PIPELINE_SIZE = 32
+#: Servers that don't answer two pipelined NOOPs within this number of
+#: seconds don't support pipelining
+PIPELINE_PROBE_TIMEOUT = 5.0
+#: Connections used by prefetch_tree() to list directories in parallel
+DEFAULT_LIST_CONNECTIONS = 4
+#: FtpTarget methods that don't need the server's current directory to match
+#: cur_dir (see _sync_cwd())
+_LAZY_CWD_METHODS = ("cwd", "get_dir", "mkdir", "remove_file", "flush_batch")
+#: Don't open an additional connection for less than this number of files
+MIN_FILES_PER_WORKER = 20
+
+
+def parse_mlsd_line(line):
+    """Return (name, type, size, mtime, unique) for a line of MLSD output."""
+    data, _, name = line.partition("; ")
+    res_type = size = mtime = unique = None
+    fields = data.split(";")
+    # http://tools.ietf.org/html/rfc3659#page-23
+    # "Size" / "Modify" / "Create" / "Type" / "Unique" / "Perm" / "Lang"
+    #   / "Media-Type" / "CharSet" / os-depend-fact / local-fact
+    for field in fields:
+        field_name, _, field_value = field.partition("=")
+        field_name = field_name.lower()
+        if field_name == "type":
+            res_type = field_value.lower()
+        elif field_name in ("sizd", "size"):
+            size = int(field_value)
+        elif field_name == "modify":
+            # Use calendar.timegm() instead of time.mktime(), because
+            # the date was returned as UTC
+            mtime = calendar.timegm(time.strptime(field_value[:14], "%Y%m%d%H%M%S"))
+#            print("MLST modify: ", field_value, "mtime", mtime, "ctime", time.ctime(mtime))
+        elif field_name == "unique":
+            unique = field_value
+    return name, res_type, size, mtime, unique
+
+
+def get_entropy(data):
+    """Return the Shannon entropy of a byte string in bits per byte (0..8)."""
+    if not data:
+        return 0.0
+    counts = [0] * 256
+    for b in bytearray(data):
+        counts[b] += 1
+    total = float(len(data))
+    return -sum(c / total * math.log(c / total, 2) for c in counts if c)
+
+
+def is_compressible(name, sample=None):
+    """Return True if a file is worth being transferred with MODE Z.
+
+    The decision is based on the extension, or the entropy of `sample` (a
+    few KB taken from the start of the file) if the extension is unknown.
+    """
+    ext = os.path.splitext(name)[1].lower()
+    if ext in COMPRESSIBLE_EXTENSIONS:
+        return True
+    elif ext in INCOMPRESSIBLE_EXTENSIONS or not sample:
+        return False
+    return get_entropy(sample) < MODE_Z_MAX_ENTROPY
+
+
+def _retry_transient(method):
+    """Decorator that reconnects and retries an FtpTarget method on transient errors.
+
+    Only idempotent operations should be decorated. Nested calls are not
+    retried separately (only the outermost call is).
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._retry_depth > 0:
+            return method(self, *args, **kwargs)
+        retries = self.get_option("retries", DEFAULT_RETRIES)
+        delay = self.get_option("retry_delay", DEFAULT_RETRY_DELAY)
+        attempt = 0
+        self._retry_depth += 1
+        try:
+            while True:
+                self._in_retry = attempt > 0
+                try:
+                    if method.__name__ not in _LAZY_CWD_METHODS:
+                        self._sync_cwd()
+                    return method(self, *args, **kwargs)
+                except TRANSIENT_ERRORS as e:
+                    if attempt >= retries:
+                        raise
+                    attempt += 1
+                    print("%s failed (%s): retry %s/%s in %s sec..." 
+                          % (method.__name__, e, attempt, retries, delay), 
+                          file=sys.stderr)
+                    self._inc_stat("ftp_retries")
+                    time.sleep(delay)
+                    delay *= 2
+                    try:
+                        self.reconnect()
+                    except TRANSIENT_ERRORS as e:
+                        print("Reconnect failed: %s" % e, file=sys.stderr)
+        finally:
+            self._retry_depth -= 1
+            self._in_retry = False
+    return wrapper
+
+
+class _SentBlock(object):
+    """Passed to write_file() callbacks instead of the data sent by sendfile()."""
+    __slots__ = ("size", )
+
+    def __init__(self, size):
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class _RetriedCallback(object):
+    """Wraps a write_file() callback, so blocks that are sent again after a
+    retry are not reported (and counted) twice."""
+    def __init__(self, callback):
+        self.callback = callback
+        self.reported = 0
+        self.pos = 0
+
+    def restart(self):
+        """Called before the upload is repeated from the start."""
+        self.pos = 0
+
+    def __call__(self, data):
+        self.pos += len(data)
+        new = self.pos - self.reported
+        if new <= 0:
+            return
+        if new < len(data):
+            data = _SentBlock(new) if isinstance(data, _SentBlock) else data[-new:]
+        self.reported = self.pos
+        self.callback(data)
+
+
+#===============================================================================
+# FtpConnectionPool
+#===============================================================================
+class FtpConnectionPool(object):
+    """Share logged-in connections between FtpTargets (e.g. jobs to the same host).
+
+    Pass the pool as 'connection_pool' option. FtpTarget.open() then blocks
+    until less than `max_per_host` targets are connected to that host, and
+    reuses an idle connection if one is available. close() hands the
+    connection back to the pool instead of sending QUIT.
+    """
+    def __init__(self, max_per_host=2):
+        self.max_per_host = max_per_host
+        self._lock = threading.Lock()
+        self._slots = {} # {'host:port': BoundedSemaphore}
+        self._idle = {} # {('host:port', username): [ftp, ...]}
+        self.stats = {"pool_connections_reused": 0,
+                      "pool_wait_secs": 0.0,
+                      }
+
+    @staticmethod
+    def _get_key(target):
+        return "%s:%s" % (target.host, target.port or 21)
+
+    def acquire(self, target):
+        """Wait for a free slot and return an idle ftplib.FTP instance or None."""
+        key = self._get_key(target)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._slots[key] = threading.BoundedSemaphore(self.max_per_host)
+        start = time.time()
+        slot.acquire()
+        with self._lock:
+            self.stats["pool_wait_secs"] += time.time() - start
+            idle = self._idle.get((key, target.username))
+            if idle:
+                self.stats["pool_connections_reused"] += 1
+                return idle.pop()
+        return None
+
+    def release(self, target, ftp):
+        """Free the slot and keep `ftp` for reuse (pass None if it is broken)."""
+        key = self._get_key(target)
+        if ftp is not None:
+            with self._lock:
+                self._idle.setdefault((key, target.username), []).append(ftp)
+        self._slots[key].release()
+
+    def close(self):
+        """Send QUIT to all idle connections."""
+        with self._lock:
+            idle_lists, self._idle = self._idle, {}
+        for idle in idle_lists.values():
+            for ftp in idle:
+                try:
+                    ftp.quit()
+                except ftplib.all_errors:
+                    pass
+
+
 #===============================================================================
 # FtpTarget
 #===============================================================================
 class FtpTarget(_Target):
+
+    #: Information about servers, shared by all instances: {'host:port': {...}}
+    #:   'probe_time': time of the last capability probe
+    #:   'features': dict as returned by FEAT
+    #:   'syst': response to SYST
+    #:   'set_time_cmd': command that sets file mtimes ('MFMT', 'SITE UTIME',
+    #:                   'MDTM') or False if not supported
+    #:   'mlst_opts': facts that we pass to 'OPTS MLST' (None: keep defaults)
+    #:   'rest_stream', 'mode_z', 'utf8': True if supported
+    #: This dict is persisted to the state folder (see _load_host_info())
+    HOST_INFO = {}
+    _host_info_loaded = False
+    #: Open connections of this process per host: {'host:port': count}
+    #: (see 'max_connections' option)
+    HOST_CONNECTIONS = {}
+    _host_connections_lock = threading.Lock()
+    #: Commands that may set mtimes, tried in this order
+    SET_TIME_CMDS = ("MFMT", "SITE UTIME", "MDTM")
     
     def __init__(self, path, host, port, username=None, password=None, extra_opts=None):
         path = path or "/"
@@ -34,6 +315,24 @@ class FtpTarget(_Target):
         self.port = port
         self.username = username
         self.password = password
+        self.features = None # Set by get_features()
+        self._hash_algo = None # Currently selected by 'OPTS HASH'
+        self._retry_depth = 0 # Used by @_retry_transient
+        self._in_retry = False # True while @_retry_transient repeats a call
+        self._pool = None # FtpConnectionPool, if we hold one of its slots
+        self._counted = False # True, if counted in HOST_CONNECTIONS
+        self._agent = None # AgentClient, if the 'agent' option is set
+        self._agent_key = None
+        self._tree = None # {abs dir: (MLSD lines, meta data bytes)}, see prefetch_tree()
+        self._ftp_cwd = None # Current directory on the server (may differ from cur_dir)
+        self._prefetched_meta = None # Meta data bytes for the next open_readable()
+        self._batch = None # Queued commands (absolute paths), see flush_batch()
+        # Atomic uploads that were not yet renamed: {final path: temp path}
+        # (shared with clones, so lanes can be committed together)
+        self._pending_commits = {}
+        # Temp files that this process stored (so leftovers may be removed)
+        self._own_temp_files = set()
+        self._commit_lock = threading.Lock()
 #        if connect:
 #            self.open()
 
@@ -43,11 +342,116 @@ class FtpTarget(_Target):
     def get_base_name(self):
         return "ftp:%s%s" % (self.host, self.root_dir)
 
+    def get_host_key(self):
+        return "%s:%s" % (self.host, self.port or 21)
+
     def open(self):
         assert not self.connected
         no_prompt  = self.get_option("no_prompt", True)
         store_password = self.get_option("store_password", False)
 
+        pooled_ftp = agent_ftp = None
+        pool = self.get_option("connection_pool")
+        if pool and not self._pool:
+            # A reconnect() keeps the slot, so only acquire it once
+            pooled_ftp = pool.acquire(self)
+            self._pool = pool
+        elif not pool and self.get_option("agent"):
+            self._agent = AgentClient()
+            self._agent_key = get_agent_key(self.host, self.port, self.username)
+            agent_ftp = self._agent.get_connection(self._agent_key, self.host,
+                                                   self.get_option("ftp_debug", 0))
+        try:
+            if pooled_ftp is not None:
+                try:
+                    pooled_ftp.voidcmd("NOOP")
+                    self.ftp = pooled_ftp
+                except ftplib.all_errors:
+                    pooled_ftp = None # timed out while idle
+            if agent_ftp is not None:
+                # The agent checked the connection already
+                self.ftp = agent_ftp
+                self._inc_stat("agent_connections_reused")
+            elif pooled_ftp is None:
+                self._login(no_prompt)
+
+            try:
+                # 
+                self.ftp.cwd(self.root_dir)
+            except error_perm as e:
+                # If credentials were passed, but authentication fails, prompt 
+                # for new password
+                if not e.args[0].startswith("550"):
+                    raise # error other then 550 No such directory'
+                print("Could not change directory to %s (%s): missing permissions?" % (self.root_dir, e))
+
+            start = time.time()
+            pwd = self.ftp.pwd()
+            self.rtt = time.time() - start
+            if pwd != self.root_dir:
+                raise RuntimeError("Unable to navigate to working directory %r" % self.root_dir)
+        except Exception:
+            if pool and self._pool and not self._retry_depth:
+                self._pool.release(self, None)
+                self._pool = None
+            if self._counted and not self._retry_depth:
+                self._release_connection()
+                self._counted = False
+            raise
+        if not self._counted:
+            # The main connection is always allowed (extra ones may be refused)
+            self._counted = self._reserve_connection(force=True)
+        self.cur_dir = self._ftp_cwd = pwd
+        self.connected = True
+        self._probe_server()
+        if self._batch is None and self._can_pipeline():
+            self._batch = []
+        # Successfully authenticated: store password
+        if store_password:
+            save_password(self.host, self.username, self.password)
+        return
+
+    def clone(self):
+        # Waiting for a second slot of the connection pool could dead-lock
+        # with other jobs that do the same
+        if self.get_option("connection_pool"):
+            return None
+        if not self._reserve_connection():
+            return None
+        clone = FtpTarget(self.root_dir, self.host, self.port, self.username, 
+                          self.password, self.extra_opts)
+        clone._counted = True
+        clone._pending_commits = self._pending_commits
+        clone._own_temp_files = self._own_temp_files
+        clone._commit_lock = self._commit_lock
+        return clone
+
+    def _reserve_connection(self, force=False):
+        """Count a new connection to our host.
+
+        Return False if 'max_connections' connections are open already
+        (unless `force` is true).
+        """
+        limit = self.get_option("max_connections")
+        key = self.get_host_key()
+        with FtpTarget._host_connections_lock:
+            count = FtpTarget.HOST_CONNECTIONS.get(key, 0)
+            if limit and count >= limit and not force:
+                return False
+            FtpTarget.HOST_CONNECTIONS[key] = count + 1
+        return True
+
+    def _release_connection(self):
+        """Undo _reserve_connection()."""
+        key = self.get_host_key()
+        with FtpTarget._host_connections_lock:
+            count = FtpTarget.HOST_CONNECTIONS.get(key, 0)
+            if count > 1:
+                FtpTarget.HOST_CONNECTIONS[key] = count - 1
+            else:
+                FtpTarget.HOST_CONNECTIONS.pop(key, None)
+
+    def _login(self, no_prompt):
         if self.port:
             self.ftp.connect(self.host, self.port)
         else:
@@ -71,115 +475,561 @@ class FtpTarget(_Target):
                 self.user, self.password = prompt_for_password(self.host, self.username)
                 self.ftp.login(self.username, self.password)
 
-        # TODO: case sensitivity?
-#        resp = self.ftp.sendcmd("system")
-#        self.is_unix = "unix" in resp.lower() # not necessarily true, better check with read/write tests
-        
-        try:
-            # 
-            self.ftp.cwd(self.root_dir)
-        except error_perm as e:
-            # If credentials were passed, but authentication fails, prompt 
-            # for new password
-            if not e.args[0].startswith("550"):
-                raise # error other then 550 No such directory'
-            print("Could not change directory to %s (%s): missing permissions?" % (self.root_dir, e))
-
-        pwd = self.ftp.pwd()
-        if pwd != self.root_dir:
-            raise RuntimeError("Unable to navigate to working directory %r" % self.root_dir)
-        self.cur_dir = pwd
-        self.connected = True
-        # Successfully authenticated: store password
-        if store_password:
-            save_password(self.host, self.username, self.password)
-        return
-
     def close(self):
-        if self.connected:
+        if self.connected and self._batch:
+            self.flush_batch()
+        if self._pool:
+            self._pool.release(self, self.ftp if self.connected else None)
+            self._pool = None
+        elif self.connected and self._agent:
+            if self._agent.put_connection(self._agent_key, self.ftp):
+                self.ftp.close() # the agent keeps its own copy
+            else:
+                self.ftp.quit()
+        elif self.connected:
             self.ftp.quit()
+        if self._counted:
+            self._release_connection()
+            self._counted = False
         self.connected = False
+
+    def reconnect(self):
+        """Drop the (possibly broken) connection, login again, and restore cur_dir."""
+        cur_dir = self.cur_dir
+        try:
+            self.ftp.close()
+        except ftplib.all_errors:
+            pass
+        self.connected = False
+        self.ftp = ftplib.FTP()
+        self.ftp.debug(self.get_option("ftp_debug", 0))
+        self._hash_algo = None
+        self._inc_stat("ftp_reconnects")
+        self.open()
+        if cur_dir and cur_dir != self.root_dir:
+            self.ftp.cwd(cur_dir)
+            self.cur_dir = self._ftp_cwd = cur_dir
+
+    def keep_alive(self):
+        """Send queued commands and NOOP, reconnect if the server dropped the connection."""
+        try:
+            self._sync_cwd()
+            self.ftp.voidcmd("NOOP")
+        except error_perm as e:
+            print("Queued command failed: %s" % e, file=sys.stderr)
+        except ftplib.all_errors as e:
+            print("Connection lost (%s): reconnecting..." % e, file=sys.stderr)
+            self.reconnect()
+
+    def _use_host_info_cache(self):
+        return self.get_option("host_info_cache", True)
+
+    def _load_host_info(self):
+        """Read persisted HOST_INFO entries that are not yet expired."""
+        FtpTarget._host_info_loaded = True
+        if not self._use_host_info_cache():
+            return
+        ttl = self.get_option("host_info_ttl", DEFAULT_HOST_INFO_TTL)
+        try:
+            with open(targets.get_state_path(HOST_INFO_FILE_NAME), "rt") as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return # missing or corrupt: probe again
+        now = time.time()
+        for key, info in data.items():
+            if key not in FtpTarget.HOST_INFO and now - info.get("probe_time", 0) < ttl:
+                FtpTarget.HOST_INFO[key] = info
+
+    def _save_host_info(self):
+        """Persist HOST_INFO to the state folder."""
+        if not self._use_host_info_cache():
+            return
+        try:
+            path = targets.get_state_path(HOST_INFO_FILE_NAME)
+            with open(path + ".tmp", "wt") as f:
+                json.dump(FtpTarget.HOST_INFO, f, indent=4, sort_keys=True)
+            if os.path.exists(path):
+                os.remove(path) # os.rename() does not replace files on Windows
+            os.rename(path + ".tmp", path)
+        except (IOError, OSError) as e:
+            print("Could not store host info: %s" % e, file=sys.stderr)
+
+    def _get_host_info(self):
+        """Return the (shared) dict of known server capabilities."""
+        if not FtpTarget._host_info_loaded:
+            self._load_host_info()
+        info = FtpTarget.HOST_INFO.setdefault(self.get_host_key(), {})
+        ttl = self.get_option("host_info_ttl", DEFAULT_HOST_INFO_TTL)
+        if "probe_time" in info and time.time() - info["probe_time"] >= ttl:
+            info.clear()
+        return info
+
+    def get_features(self):
+        """Return a dict {FEATURE: params} as reported by the FEAT command."""
+        if self.features is None:
+            info = self._get_host_info()
+            if "features" in info:
+                self.features = info["features"]
+                return self.features
+            self.features = {}
+            try:
+                resp = self.ftp.sendcmd("FEAT")
+            except error_perm:
+                resp = "" # FEAT is not supported
+            # Feature lines are indented by one space:
+            #   211-Features:
+            #    MDTM
+            #    HASH SHA-1;SHA-256*;MD5
+            #   211 End
+            for line in resp.splitlines()[1:-1]:
+                feat, _, params = line.strip().partition(" ")
+                if feat:
+                    self.features[feat.upper()] = params.strip()
+            info["features"] = self.features
+        return self.features
+
+    def _probe_server(self):
+        """Check and enable server capabilities (called by open()).
+
+        Results are cached in HOST_INFO, so only the first connection to a
+        host sends FEAT and SYST.
+        Session settings ('OPTS UTF8', 'OPTS MLST') are sent every time.
+        """
+        info = self._get_host_info()
+        if "probe_time" not in info:
+            features = self.get_features()
+            try:
+                info["syst"] = self.ftp.sendcmd("SYST")
+            except error_perm:
+                info["syst"] = None
+            # 'MLST type*;size*;modify*;perm;unique;' (enabled facts have a '*')
+            facts = [f for f in features.get("MLST", "").lower().split(";") if f]
+            enabled = set(f.rstrip("*") for f in facts if f.endswith("*"))
+            wanted = [f for f in MLST_FACTS if f in facts or f + "*" in facts]
+            if wanted and enabled != set(wanted):
+                info["mlst_opts"] = ";".join(wanted) + ";"
+            else:
+                info["mlst_opts"] = None
+            info["rest_stream"] = features.get("REST", "").upper() == "STREAM"
+            info["mode_z"] = "Z" in features.get("MODE", "").upper().split()
+            info["utf8"] = "UTF8" in features
+            info["probe_time"] = time.time()
+            self._init_set_time()
+            self._save_host_info()
+        else:
+            self.features = info["features"]
+            self._init_set_time()
+
+        if info.get("utf8"):
+            try:
+                self.ftp.sendcmd("OPTS UTF8 ON")
+                self.ftp.encoding = "utf-8"
+            except error_perm:
+                pass
+        if info.get("mlst_opts"):
+            try:
+                self.ftp.sendcmd("OPTS MLST " + info["mlst_opts"])
+            except error_perm:
+                pass
+        syst = (info.get("syst") or "").lower()
+        if syst:
+            self.case_sensitive = "windows" not in syst
+        if "MLST" in self.features:
+            # MLSD reports times in UTC (RFC 3659)
+            self.time_ofs = 0
+
+    def get_capabilities(self):
+        info = self._get_host_info()
+        return {"hash_algos": self.get_hash_algos(),
+                "set_time": info.get("set_time_cmd") or False,
+                "rest_stream": bool(info.get("rest_stream")),
+                "mode_z": bool(info.get("mode_z")),
+                "utf8": bool(info.get("utf8")),
+                "mlsd": "MLST" in self.get_features(),
+                }
+
+    def _get_set_time_cmd(self):
+        """Return 'MFMT', 'SITE UTIME', 'MDTM', False (not supported) or None (unknown)."""
+        if self.get_option("no_set_time"):
+            return False
+        return self._get_host_info().get("set_time_cmd")
+
+    def _init_set_time(self):
+        """Check if the server allows to set mtimes (called by open())."""
+        info = self._get_host_info()
+        if "set_time_cmd" not in info and "MFMT" in self.get_features():
+            info["set_time_cmd"] = "MFMT"
+        # SITE UTIME and MDTM are not announced by FEAT, so we will try them
+        # on the first call to set_mtime()
+        cmd = self._get_set_time_cmd()
+        self.support_set_time = bool(cmd) if cmd is not None else None
+        if cmd:
+            # MLSD reports whole seconds only
+            self.mtime_precision = 1
         
+    def _inc_stat(self, name, ofs=1):
+        if self.synchronizer:
+            self.synchronizer._inc_stat(name, ofs)
+
     def get_id(self):
         return self.host + self.root_dir
 
+    @_retry_transient
     def cwd(self, dir_name):
         path = normpath_url(join_url(self.cur_dir, dir_name))
         if not path.startswith(self.root_dir):
             # paranoic check to prevent that our sync tool goes berserk
             raise RuntimeError("Tried to navigate outside root %r: %r" 
                                % (self.root_dir, path))
-        self.ftp.cwd(dir_name)
+        if self._tree is None and not self._batch:
+            self._sync_cwd()
+            self.ftp.cwd(dir_name)
+            self._ftp_cwd = path
+        # else: CWD is sent by _sync_cwd(), when a command needs it
         self.cur_dir = path
         self.cur_dir_meta = None
         return self.cur_dir
 
+    def _sync_cwd(self):
+        """Send queued commands and CWD if the server's current directory differs from cur_dir."""
+        if not self.connected:
+            return
+        if self._batch:
+            if self._ftp_cwd != self.cur_dir:
+                self._batch.append(("CWD %s" % self.cur_dir, None))
+                self._ftp_cwd = None # unknown, if the batch fails
+            self._flush_batch()
+        elif self._ftp_cwd != self.cur_dir:
+            self.ftp.cwd(self.cur_dir)
+        self._ftp_cwd = self.cur_dir
+
+    def _can_pipeline(self):
+        """Return True if the server accepts pipelined commands (probed once per host)."""
+        if not self.get_option("pipeline", True):
+            return False
+        info = self._get_host_info()
+        if "pipelining" not in info:
+            info["pipelining"] = self._probe_pipelining()
+            self._save_host_info()
+        return info["pipelining"]
+
+    def _probe_pipelining(self):
+        sock = self.ftp.sock
+        timeout = sock.gettimeout()
+        sock.settimeout(PIPELINE_PROBE_TIMEOUT)
+        try:
+            sock.sendall(b"NOOP\r\nNOOP\r\n")
+            self.ftp.voidresp()
+            self.ftp.voidresp()
+            return True
+        except ftplib.all_errors as e:
+            print("Server does not support pipelined commands (%s): reconnecting..." % e,
+                  file=sys.stderr)
+        finally:
+            sock.settimeout(timeout)
+        # We don't know how many replies are still on the way (reconnect()
+        # calls open() again, which finds the cached result)
+        self._get_host_info()["pipelining"] = False
+        self.reconnect()
+        return False
+
+    def _pipeline(self, cmds, ignore_errors=False, on_reply=None):
+        """Send control commands back-to-back and read the replies afterwards.
+
+        Up to PIPELINE_SIZE commands are sent at once, or one command at a
+        time if the server does not support pipelining. All replies are
+        read before the first error_perm is raised (unless `ignore_errors`),
+        so replies always match their commands.
+        `on_reply(cmd, error)` is called for every reply (error is None on
+        success).
+        """
+        size = PIPELINE_SIZE if len(cmds) > 1 and self._can_pipeline() else 1
+        error = None
+        for i in range(0, len(cmds), size):
+            batch = cmds[i:i + size]
+            if len(batch) > 1:
+                data = "".join("%s\r\n" % cmd for cmd in batch)
+                self.ftp.sock.sendall(data.encode(self.ftp.encoding))
+                self._inc_stat("pipeline_batches")
+                self._inc_stat("pipeline_cmds", len(batch))
+            else:
+                self.ftp.putcmd(batch[0])
+            for cmd in batch:
+                try:
+                    self.ftp.getresp()
+                except error_perm as e:
+                    if error is None:
+                        error = error_perm("%s: %s" % (cmd, e))
+                    if on_reply:
+                        on_reply(cmd, e)
+                else:
+                    if on_reply:
+                        on_reply(cmd, None)
+        if error is not None and not ignore_errors:
+            raise error
+
+    def _queue_cmd(self, cmd, on_success=None):
+        """Queue a command; `on_success()` is called when the server accepted it."""
+        self._batch.append((cmd, on_success))
+        if len(self._batch) >= PIPELINE_SIZE:
+            self._sync_cwd()
+
+    def _flush_batch(self):
+        """Send queued commands and call their `on_success` handlers.
+
+        Commands are removed from the queue as their replies arrive, so only
+        unanswered commands are sent again after a reconnect. If one of those
+        fails, it is ignored only if it had run already (see _is_done()).
+        """
+        batch = self._batch
+        retry = self._in_retry
+        failed = []
+        def _on_reply(cmd, error):
+            item = batch.pop(0)
+            if error is not None:
+                failed.append((item, error))
+            elif item[1]:
+                item[1]()
+        try:
+            self._pipeline([cmd for cmd, _ in batch], ignore_errors=True, 
+                           on_reply=_on_reply)
+        except Exception:
+            # Send failed commands again (and check them) after reconnecting
+            batch[:0] = [item for item, _ in failed]
+            raise
+        error = None
+        for (cmd, on_success), e in failed:
+            if retry and self._is_done(cmd):
+                if on_success:
+                    on_success()
+            elif error is None:
+                error = error_perm("%s: %s" % (cmd, e))
+        if error is not None:
+            raise error
+
+    def _is_done(self, cmd):
+        """Return True if DELE, RMD, or MKD `cmd` failed, because its effect is
+        already in place (i.e. it ran before the connection dropped)."""
+        verb, _, path = cmd.partition(" ")
+        try:
+            facts = self.ftp.sendcmd("MLST %s" % path)
+        except error_perm as e:
+            return str(e).startswith("550") and verb in ("DELE", "RMD")
+        return verb == "MKD" and "type=dir;" in facts.lower()
+
+    @_retry_transient
+    def flush_batch(self):
+        """Send queued commands (MKD, DELE), which are otherwise sent before the next command."""
+        if self._batch:
+            self._flush_batch()
+
+    def prefetch_tree(self):
+        """List the whole remote tree, so get_dir() and cwd() need no round trips.
+
+        Directories are listed level by level with 'MLSD <path>' (no CWD),
+        using up to 'list_connections' connections in parallel. Meta data
+        files are fetched along the way.
+        Every listing is used once by get_dir() (later calls list again).
+        """
+        start = time.time()
+        connections = self.get_option("list_connections", DEFAULT_LIST_CONNECTIONS)
+        if self.get_option("connection_pool"):
+            connections = 1 # don't bypass the per-host limit
+        self._sync_cwd()
+        free = queue.Queue()
+        free.put(self.ftp)
+        extra = []
+        tree = {}
+
+        def _list(path):
+            ftp = free.get()
+            try:
+                lines = []
+                ftp.retrlines("MLSD %s" % path, lines.append)
+                meta = None
+                if any(parse_mlsd_line(line)[0] == DirMetadata.META_FILE_NAME 
+                       for line in lines):
+                    buf = io.BytesIO()
+                    ftp.retrbinary("RETR %s" % join_url(path, DirMetadata.META_FILE_NAME), 
+                                   buf.write)
+                    meta = buf.getvalue()
+                return path, lines, meta
+            finally:
+                free.put(ftp)
+
+        pool = ThreadPool(connections) if connections > 1 else None
+        try:
+            level = [self.root_dir or "/"]
+            while level:
+                while pool and len(extra) < min(connections, len(level)) - 1:
+                    ftp = self._connect_ftp()
+                    if ftp is None:
+                        break
+                    extra.append(ftp)
+                    free.put(ftp)
+                results = pool.map(_list, level) if pool and len(level) > 1 \
+                    else [_list(path) for path in level]
+                level = []
+                for path, lines, meta in results:
+                    tree[path] = (lines, meta)
+                    for line in lines:
+                        name, res_type, _size, _mtime, _unique = parse_mlsd_line(line)
+                        if res_type == "dir" and name not in (".", ".."):
+                            level.append(join_url(path, name))
+        finally:
+            if pool:
+                pool.close()
+            for ftp in extra:
+                self._close_ftp(ftp)
+        self._tree = tree
+        self._inc_stat("tree_dirs_listed", len(tree))
+        self._inc_stat("tree_list_secs", time.time() - start)
+        return True
+
+    def clear_tree(self):
+        """Discard the prefetched listing and send CWD on every cwd() again."""
+        self._tree = None
+        self._prefetched_meta = None
+
+    @_retry_transient
     def pwd(self):
         return self.ftp.pwd()
 
+    @_retry_transient
     def mkdir(self, dir_name):
         self.check_write(dir_name)
-        self.ftp.mkd(dir_name)
+        if self._batch is not None:
+            self._queue_cmd("MKD %s" % join_url(self.cur_dir, dir_name))
+            return
+        self._sync_cwd()
+        try:
+            self.ftp.mkd(dir_name)
+        except error_perm:
+            # Maybe created before the connection dropped
+            if not (self._in_retry and self._is_done("MKD %s" % dir_name)):
+                raise
 
-    def _rmdir_impl(self, dir_name, keep_root=False):
-        # FTP does not support deletion of non-empty directories.
-#        print("rmdir(%s)" % dir_name)
-        self.check_write(dir_name)
-        names = self.ftp.nlst(dir_name)
-#        print("rmdir(%s): %s" % (dir_name, names))
-        # Skip ftp.cwd(), if dir is empty
-        names = [ n for n in names if n not in (".", "..") ]
-        if len(names) > 0:
-            self.ftp.cwd(dir_name)
+    def _connect_ftp(self):
+        """Return an additional, authenticated connection with cwd set to root_dir.
+
+        Return None if 'max_connections' are open already. Pass the result
+        to _close_ftp() when done.
+        """
+        if not self._reserve_connection():
+            return None
+        ftp = ftplib.FTP()
+        ftp.debug(self.get_option("ftp_debug", 0))
+        try:
+            if self.port:
+                ftp.connect(self.host, self.port)
+            else:
+                ftp.connect(self.host)
+            ftp.login(self.username, self.password)
+            ftp.cwd(self.root_dir)
+        except Exception:
+            self._close_ftp(ftp)
+            raise
+        return ftp
+
+    def _close_ftp(self, ftp):
+        """Close a connection that was returned by _connect_ftp()."""
+        try:
+            ftp.quit()
+        except ftplib.all_errors:
+            ftp.close()
+        self._release_connection()
+
+    def _walk_tree(self, dir_name):
+        """Return (file_paths, dir_paths) below cur_dir/dir_name, using MLSD type facts.
+
+        Paths are relative to cur_dir; directories are listed parents first.
+        """
+        file_paths = []
+        dir_paths = []
+        todo = [dir_name]
+        while todo:
+            parent = todo.pop(0)
+            lines = []
+            self.ftp.retrlines("MLSD %s" % parent, lines.append)
+            for line in lines:
+                name, res_type, _size, _mtime, _unique = parse_mlsd_line(line)
+                if res_type in ("cdir", "pdir") or name in (".", ".."):
+                    continue
+                path = normpath_url(join_url(parent, name))
+                if res_type == "dir":
+                    dir_paths.append(path)
+                    todo.append(path)
+                else:
+                    file_paths.append(path)
+        return file_paths, dir_paths
+
+    def _delete_files(self, file_paths):
+        """Delete a list of files (relative to cur_dir), using parallel connections."""
+        workers = self.get_option("delete_workers", DEFAULT_DELETE_WORKERS)
+        workers = min(workers, len(file_paths) // MIN_FILES_PER_WORKER)
+        if self.get_option("connection_pool"):
+            workers = 1 # don't bypass the per-host limit
+        if workers <= 1:
+            self._pipeline(["DELE %s" % path for path in file_paths])
+            return
+
+        # Additional connections start in root_dir, so pass absolute paths
+        abs_paths = [ join_url(self.cur_dir, p) for p in file_paths ]
+        conns = [self.ftp]
+        try:
+            for _ in range(workers - 1):
+                ftp = self._connect_ftp()
+                if ftp is None:
+                    break
+                conns.append(ftp)
+            if len(conns) == 1:
+                # 'max_connections' reached
+                self._pipeline(["DELE %s" % path for path in file_paths])
+                return
+
+            def _worker(args):
+                ftp, paths = args
+                for path in paths:
+                    ftp.delete(path)
+
+            chunks = [ abs_paths[i::len(conns)] for i in range(len(conns)) ]
+            pool = ThreadPool(len(conns))
             try:
-                for name in names:
-                    try:
-                        # try to delete this as a file
-                        self.ftp.delete(name)
-                    except ftplib.all_errors as _e:
-#                        print("    ftp.delete(%s) failed: %s, trying rmdir()..." % (name, _e))
-                        # assume <name> is a folder
-                        self.rmdir(name)
+                pool.map(_worker, zip(conns, chunks))
             finally:
-                if dir_name != ".":
-                    self.ftp.cwd("..")
-#        print("ftp.rmd(%s)..." % (dir_name, ))
+                pool.close()
+                pool.join()
+        finally:
+            for ftp in conns[1:]:
+                self._close_ftp(ftp)
+        return
+
+    def _rmdir_impl(self, dir_name, keep_root=False):
+        # FTP does not support deletion of non-empty directories, so we list
+        # the whole tree first, delete all files, and then remove the
+        # directories bottom-up.
+        self.check_write(dir_name)
+        file_paths, dir_paths = self._walk_tree(dir_name)
+        if file_paths:
+            self._delete_files(file_paths)
         if not keep_root:
-            self.ftp.rmd(dir_name)
+            dir_paths.insert(0, dir_name)
+        self._pipeline(["RMD %s" % path for path in reversed(dir_paths)])
         return
 
-    
+    @_retry_transient
     def rmdir(self, dir_name):
         return self._rmdir_impl(dir_name)
 
 
+    @_retry_transient
     def get_dir(self):
         entry_list = []
         entry_map = {}
         local_res = {"has_meta": False} # pass local variables outside func scope 
         
         def _addline(line):
-            data, _, name = line.partition("; ")
-            res_type = size = mtime = unique = None
-            fields = data.split(";")
-            # http://tools.ietf.org/html/rfc3659#page-23
-            # "Size" / "Modify" / "Create" / "Type" / "Unique" / "Perm" / "Lang"
-            #   / "Media-Type" / "CharSet" / os-depend-fact / local-fact
-            for field in fields:
-                field_name, _, field_value = field.partition("=")
-                field_name = field_name.lower()
-                if field_name == "type":
-                    res_type = field_value
-                elif field_name in ("sizd", "size"):
-                    size = int(field_value)
-                elif field_name == "modify":
-                    # Use calendar.timegm() instead of time.mktime(), because
-                    # the date was returned as UTC
-                    mtime = calendar.timegm(time.strptime(field_value, "%Y%m%d%H%M%S"))
-#                    print("MLST modify: ", field_value, "mtime", mtime, "ctime", time.ctime(mtime))
-                elif field_name == "unique":
-                    unique = field_value
-                    
+            name, res_type, size, mtime, unique = parse_mlsd_line(line)
             entry = None
             if res_type == "dir":
                 entry = DirectoryEntry(self, self.cur_dir, name, size, mtime, unique)
@@ -187,6 +1037,9 @@ class FtpTarget(_Target):
                 if name == DirMetadata.META_FILE_NAME:
                     # the meta-data file is silently ignored
                     local_res["has_meta"] = True
+                elif name.endswith(TEMP_SUFFIX):
+                    # Upload in progress or left over by a failed atomic upload
+                    local_res.setdefault("temp_files", []).append((name, mtime))
                 elif not name in (DirMetadata.DEBUG_META_FILE_NAME, ):
                     entry = FileEntry(self, self.cur_dir, name, size, mtime, unique)
             elif res_type in ("cdir", "pdir"):
@@ -198,8 +1051,18 @@ class FtpTarget(_Target):
                 entry_map[name] = entry
                 entry_list.append(entry)
                 
-        # raises error_perm, if command is not supported
-        self.ftp.retrlines("MLSD", _addline)
+        cached = self._tree.pop(self.cur_dir, None) if self._tree else None
+        if cached:
+            self._inc_stat("tree_dirs_cached")
+            lines, self._prefetched_meta = cached
+            for line in lines:
+                _addline(line)
+        else:
+            self._sync_cwd()
+            # raises error_perm, if command is not supported
+            self.ftp.retrlines("MLSD", _addline)
+
+        self._remove_temp_files(local_res.get("temp_files"))
 
         # load stored meta data if present
         self.cur_dir_meta = DirMetadata(self)
@@ -243,30 +1106,341 @@ class FtpTarget(_Target):
 
         return entry_list
 
+    @_retry_transient
     def open_readable(self, name):
         """Open cur_dir/name for reading."""
+        if name == DirMetadata.META_FILE_NAME and self._prefetched_meta is not None:
+            out, self._prefetched_meta = io.BytesIO(self._prefetched_meta), None
+            return out
         out = io.BytesIO()
-        self.ftp.retrbinary("RETR %s" % name, out.write)
+        if self._use_mode_z(name):
+            self._transfer_mode_z("RETR %s" % name, reader=out.write)
+        else:
+            self.ftp.retrbinary("RETR %s" % name, out.write)
         out.flush()
         out.seek(0)
         return out
 
     def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
+        if callback:
+            callback = _RetriedCallback(callback)
+        self._write_file(name, fp_src, blocksize, callback)
+
+    @_retry_transient
+    def _write_file(self, name, fp_src, blocksize, callback):
         self.check_write(name)
-        self.ftp.storbinary("STOR %s" % name, fp_src, blocksize, callback)
+        if self._in_retry:
+            fp_src.seek(0)
+            if callback:
+                callback.restart()
+        atomic = self._get_atomic_mode()
+        store_name = ".%s%s" % (name, TEMP_SUFFIX) if atomic else name
+        if atomic:
+            with self._commit_lock:
+                self._own_temp_files.add(join_url(self.cur_dir, store_name))
+        if self._use_mode_z(name, fp_src):
+            self._transfer_mode_z("STOR %s" % store_name, fp_src=fp_src, 
+                                  blocksize=blocksize, callback=callback)
+        elif self._use_sendfile(fp_src):
+            self._store_sendfile("STOR %s" % store_name, fp_src, callback)
+        else:
+            self.ftp.storbinary("STOR %s" % store_name, fp_src, blocksize, callback)
         # TODO: check result
+        if atomic == "file":
+            self.ftp.rename(store_name, name)
+            with self._commit_lock:
+                self._own_temp_files.discard(join_url(self.cur_dir, store_name))
+            self._inc_stat("atomic_renames")
+        elif atomic:
+            with self._commit_lock:
+                self._pending_commits[join_url(self.cur_dir, name)] = \
+                    join_url(self.cur_dir, store_name)
+
+    def _get_atomic_mode(self):
+        """Return 'file', 'dir', 'plan', or None (see 'atomic' option)."""
+        atomic = self.get_option("atomic")
+        if atomic is True:
+            return "file"
+        if atomic and atomic not in ATOMIC_MODES:
+            raise ValueError("Invalid atomic mode: %r" % atomic)
+        return atomic or None
+
+    def _get_store_name(self, name):
+        """Return the name that cur_dir/name was uploaded to (differs until committed)."""
+        path = self._pending_commits.get(join_url(self.cur_dir, name))
+        return path if path is not None else name
+
+    @_retry_transient
+    def commit_uploads(self):
+        """Rename atomic uploads to their final names (RNFR/RNTO burst)."""
+        with self._commit_lock:
+            pending = sorted(self._pending_commits.items())
+        cmds = []
+        for path, temp_path in pending:
+            cmds.extend(("RNFR %s" % temp_path, "RNTO %s" % path))
+        self._pipeline(cmds, ignore_errors=self._in_retry)
+        with self._commit_lock:
+            for path, temp_path in pending:
+                self._pending_commits.pop(path, None)
+                self._own_temp_files.discard(temp_path)
+        self._inc_stat("atomic_renames", len(pending))
+        return len(pending)
+
+    def _remove_temp_files(self, temp_files):
+        """Delete temp files of failed atomic uploads in cur_dir.
+
+        `temp_files` is a list of (name, mtime). Pending uploads are kept. Files
+        of other processes (or lanes of other runs) are only removed if they
+        are older than TEMP_FILE_MAX_AGE, because they may still be in flight.
+        """
+        if not temp_files or self.readonly or self.dry_run or not self._get_atomic_mode():
+            return
+        with self._commit_lock:
+            pending = set(self._pending_commits.values())
+            own = set(self._own_temp_files)
+        min_mtime = time.time() - TEMP_FILE_MAX_AGE
+        self._sync_cwd()
+        for name, mtime in temp_files:
+            path = join_url(self.cur_dir, name)
+            if path in pending:
+                continue
+            if path in own or (mtime is not None and mtime < min_mtime):
+                self.ftp.delete(name)
+                with self._commit_lock:
+                    self._own_temp_files.discard(path)
+                self._inc_stat("atomic_temp_files_removed")
+
+    def _use_sendfile(self, fp_src):
+        """Return True if fp_src can be uploaded with socket.sendfile().
+
+        Requires Python 3.5+ and a local file opened by FsTarget (wrappers
+        like throttled readers or mirror consumers need read()).
+        """
+        if not self.get_option("sendfile", True) or not hasattr(socket.socket, "sendfile"):
+            return False
+        if not isinstance(fp_src, (io.BufferedReader, io.FileIO)):
+            return False
+        try:
+            fp_src.fileno()
+        except (IOError, OSError, io.UnsupportedOperation):
+            return False
+        return True
+
+    def _store_sendfile(self, cmd, fp_src, callback=None):
+        """Send STOR with the kernel copying fp_src to the data connection.
+
+        `callback` is called after every SENDFILE_BLOCKSIZE bytes with a
+        _SentBlock, which only supports len().
+        """
+        self.ftp.voidcmd("TYPE I")
+        offset = fp_src.tell()
+        sent_bytes = 0
+        conn = self.ftp.transfercmd(cmd)
+        try:
+            while True:
+                sent = conn.sendfile(fp_src, offset, SENDFILE_BLOCKSIZE)
+                if not sent:
+                    break
+                offset += sent
+                sent_bytes += sent
+                if callback:
+                    callback(_SentBlock(sent))
+        finally:
+            conn.close()
+        self.ftp.voidresp()
+        self._inc_stat("sendfile_files")
+        self._inc_stat("sendfile_bytes", sent_bytes)
+
+    def _use_mode_z(self, name, fp_src=None):
+        """Return True if cur_dir/name should be transferred with MODE Z.
+
+        Requires the 'mode_z' option and server support. `fp_src` is sampled
+        (and rewound) if the file extension is not conclusive.
+        """
+        if not self.get_option("mode_z") or not self._get_host_info().get("mode_z"):
+            return False
+        sample = None
+        if fp_src is not None:
+            try:
+                pos = fp_src.tell()
+                sample = fp_src.read(MODE_Z_SAMPLE_SIZE)
+                fp_src.seek(pos)
+            except (IOError, OSError, AttributeError):
+                sample = None # not seekable
+        return is_compressible(name, sample)
+
+    def _transfer_mode_z(self, cmd, fp_src=None, reader=None, 
+                         blocksize=DEFAULT_BLOCKSIZE, callback=None):
+        """Send STOR (from `fp_src`) or RETR (to `reader`) in deflate mode."""
+        raw_bytes = wire_bytes = 0
+        self.ftp.voidcmd("TYPE I")
+        self.ftp.voidcmd("MODE Z")
+        try:
+            conn = self.ftp.transfercmd(cmd)
+            try:
+                if fp_src is not None:
+                    comp = zlib.compressobj(MODE_Z_LEVEL)
+                    while True:
+                        buf = fp_src.read(blocksize)
+                        if not buf:
+                            break
+                        data = comp.compress(buf)
+                        if data:
+                            conn.sendall(data)
+                        raw_bytes += len(buf)
+                        wire_bytes += len(data)
+                        if callback:
+                            callback(buf)
+                    data = comp.flush()
+                    conn.sendall(data)
+                    wire_bytes += len(data)
+                else:
+                    decomp = zlib.decompressobj()
+                    while True:
+                        data = conn.recv(blocksize)
+                        if not data:
+                            break
+                        buf = decomp.decompress(data)
+                        reader(buf)
+                        raw_bytes += len(buf)
+                        wire_bytes += len(data)
+                    buf = decomp.flush()
+                    reader(buf)
+                    raw_bytes += len(buf)
+            finally:
+                conn.close()
+            self.ftp.voidresp()
+        finally:
+            try:
+                self.ftp.voidcmd("MODE S")
+            except ftplib.all_errors:
+                pass # we will reconnect anyway
+        self._inc_stat("mode_z_files")
+        self._inc_stat("mode_z_bytes_raw", raw_bytes)
+        self._inc_stat("mode_z_bytes_wire", wire_bytes)
+        self._inc_stat("mode_z_bytes_saved", raw_bytes - wire_bytes)
         
+    @_retry_transient
     def remove_file(self, name):
         """Remove cur_dir/name."""
         self.check_write(name)
 #         self.cur_dir_meta.remove(name)
-        self.ftp.delete(name)
+        if self._batch is not None:
+            # Remove the sync info when the server has accepted the DELE
+            meta = None
+            if self.synchronizer:
+                meta = self.cur_dir_meta if self.is_local() else self.peer.cur_dir_meta
+            on_success = functools.partial(meta.remove, name) if meta else None
+            self._queue_cmd("DELE %s" % join_url(self.cur_dir, name), on_success)
+            return
+        self._sync_cwd()
+        try:
+            self.ftp.delete(name)
+        except error_perm:
+            # Maybe deleted before the connection dropped
+            if not (self._in_retry and self._is_done("DELE %s" % name)):
+                raise
         self.remove_sync_info(name)
 
+    def remove_sync_info(self, name):
+        cmd = "DELE %s" % join_url(self.cur_dir, name)
+        if self._batch and any(c == cmd for c, _ in self._batch):
+            return # removed when the DELE was accepted (see remove_file())
+        return super(FtpTarget, self).remove_sync_info(name)
+
+    def rename(self, old_path, new_path):
+        """Rename or move cur_dir/old_path to cur_dir/new_path (RNFR/RNTO)."""
+        self.check_write(new_path)
+        self._sync_cwd()
+        self.ftp.rename(old_path, new_path)
+
+    def _set_server_mtime(self, cmd, name, mtime):
+        """Try to set the mtime using MFMT, SITE UTIME, or MDTM (raises error_perm)."""
+        stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+        if cmd == "MFMT":
+            # '213 Modify=20140101120000; file1.txt'
+            self.ftp.sendcmd("MFMT %s %s" % (stamp, name))
+        elif cmd == "SITE UTIME":
+            # ProFTPD syntax (mod_site_misc)
+            self.ftp.sendcmd("SITE UTIME %s %s" % (stamp, name))
+        else:
+            # Some servers (e.g. vsftpd with mdtm_write) accept MDTM with two
+            # arguments to set the mtime
+            self.ftp.sendcmd("MDTM %s %s" % (stamp, name))
+
     def set_mtime(self, name, mtime, size):
         self.check_write(name)
+        self._sync_cwd()
 #         print("META set_mtime(%s): %s" % (name, time.ctime(mtime)))
-        # We cannot set the mtime on FTP servers, so we store this as additional
-        # meta data in the same directory
-        # TODO: try "SITE UTIME", "MDTM (set version)", or "SRFT" command
+        info = self._get_host_info()
+        cmd = self._get_set_time_cmd()
+        if cmd:
+            try:
+                self._set_server_mtime(cmd, self._get_store_name(name), mtime)
+                # A previously stored meta data entry would now be wrong
+                self.cur_dir_meta.remove_mtime(name)
+                return
+            except error_perm as e:
+                print("Could not set mtime for %s: %s" % (name, e), file=sys.stderr)
+        elif cmd is None:
+            # SITE UTIME and MDTM are not announced by FEAT, so try them once
+            for cmd in self.SET_TIME_CMDS[1:]:
+                try:
+                    self._set_server_mtime(cmd, self._get_store_name(name), mtime)
+                except error_perm:
+                    continue
+                info["set_time_cmd"] = cmd
+                self._save_host_info()
+                self.support_set_time = True
+                self.mtime_precision = 1
+                self.cur_dir_meta.remove_mtime(name)
+                return
+            info["set_time_cmd"] = False
+            self._save_host_info()
+            self.support_set_time = False
+
+        # We cannot set the mtime on this FTP server, so we store this as 
+        # additional meta data in the same directory
         self.cur_dir_meta.set_mtime(name, mtime, size)
+
+    def get_hash_algos(self):
+        """Return hash algorithms that the server can calculate for us."""
+        features = self.get_features()
+        hash_params = [ a.rstrip("*").upper() 
+                       for a in features.get("HASH", "").split(";") ]
+        res = []
+        for algo in targets.HASH_ALGOS:
+            if algo not in HASH_ALGO_MAP:
+                continue
+            hash_name, x_cmd = HASH_ALGO_MAP[algo]
+            if ("HASH" in features and hash_name in hash_params) or x_cmd in features:
+                res.append(algo)
+        return res
+
+    @_retry_transient
+    def get_hash(self, file_entry, algo):
+        """Let the server calculate the hash using HASH, XMD5, XSHA1, ..."""
+        hash_name, x_cmd = HASH_ALGO_MAP[algo]
+        features = self.get_features()
+        path = join_url(file_entry.rel_path, file_entry.name)
+        path = self._pending_commits.get(path, path) # uploaded, but not renamed yet
+        try:
+            if "HASH" in features and hash_name in features["HASH"].upper():
+                if self._hash_algo != hash_name:
+                    self.ftp.sendcmd("OPTS HASH %s" % hash_name)
+                    self._hash_algo = hash_name
+                # '213 SHA-1 0-49 <hex digest> <name>'
+                resp = self.ftp.sendcmd("HASH %s" % path)
+                digest = resp.split()[3]
+            elif x_cmd in features:
+                # '250 <hex digest>' (some servers append the file name)
+                resp = self.ftp.sendcmd("%s %s" % (x_cmd, path))
+                digest = resp.split()[1]
+            else:
+                return None
+        except (error_perm, IndexError) as e:
+            print("Could not get %s hash for %s: %s" % (algo, file_entry.name, e), 
+                  file=sys.stderr)
+            return None
+        self._inc_stat("hash_remote_queries")
+        return digest.lower()
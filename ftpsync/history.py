@@ -0,0 +1,220 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Performance history of FTP hosts, used to estimate the duration of runs
+and to tune the number of connections and the block size of later runs.
+"""
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+
+from ftpsync.targets import get_state_path
+
+
+#: File name of the history (inside the state folder)
+HISTORY_FILE_NAME = "perf_history.json"
+#: Number of runs that are kept per host
+MAX_RECORDS = 20
+#: Transfers smaller than this are too short to measure throughput
+MIN_MEASURE_BYTES = 64 * 1024
+#: Round trips per copied file (PASV, STOR/RETR, transfer reply, MFMT), ...
+COPY_ROUND_TRIPS = 4
+#: ... and per deleted, created, or renamed resource
+CMD_ROUND_TRIPS = 1
+
+#: Limits of the tuned block size (bytes), ...
+MIN_BLOCKSIZE = 8 * 1024
+MAX_BLOCKSIZE = 1024 * 1024
+#: ... of the tuned number of parallel transfer connections, ...
+MAX_CONNECTIONS = 8
+#: ... and of the size of files that are copied in separate lanes
+MIN_LARGE_FILE_SIZE = 256 * 1024
+MAX_LARGE_FILE_SIZE = 64 * 1024 * 1024
+#: Files that take longer than this (seconds) to transfer are 'large'
+LARGE_FILE_SECS = 1.0
+#: Use fewer connections if more retries per copied file are needed
+MAX_ERROR_RATE = 0.05
+#: Try one more connection if the last one added this much throughput
+MIN_CONNECTION_GAIN = 0.1
+
+
+def _median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def measure_run(stats, rtt):
+    """Return a history record for the stats of a real run.
+
+    Per-file round trips are subtracted from the write time, so the rates
+    are those of the data connection.
+    """
+    res = {"time": time.time()}
+    if rtt:
+        res["rtt"] = rtt
+    for kind in ("upload", "download"):
+        size = stats.get(kind + "_bytes_written", 0)
+        secs = stats.get(kind + "_write_time", 0)
+        files = stats.get(kind + "_files_written", 0)
+        if size < MIN_MEASURE_BYTES or not secs:
+            continue
+        overhead = files * COPY_ROUND_TRIPS * (rtt or 0)
+        res[kind + "_rate"] = size / max(secs - overhead, .1 * secs)
+    files = stats.get("files_written", 0)
+    if files:
+        errors = stats.get("ftp_retries", 0) + stats.get("ftp_reconnects", 0)
+        res["error_rate"] = errors / float(files)
+    # Total throughput of all connections (only measured for planned copies)
+    if stats.get("plan_bytes", 0) >= MIN_MEASURE_BYTES and stats.get("plan_secs"):
+        res["connections"] = stats.get("plan_connections", 1)
+        res["throughput"] = stats["plan_bytes"] / stats["plan_secs"]
+    return res
+
+
+def estimate_secs(actions, perf, traverse_secs=0):
+    """Return the estimated duration of `actions` (see get_dry_run_report()) or None.
+
+    `perf` is the result of PerfHistory.get_estimates(). `traverse_secs` is
+    the time needed to compare the trees (i.e. the duration of the dry run).
+    """
+    rtt = perf.get("rtt")
+    if rtt is None:
+        return None
+    secs = traverse_secs
+    for kind, item in actions.items():
+        if kind in ("upload", "download"):
+            # Use the other direction's rate, if this one was never measured
+            rate = perf.get(kind + "_rate") or perf.get("upload_rate") or perf.get("download_rate")
+            if not rate:
+                return None
+            secs += item["bytes"] / float(rate)
+            secs += item["files"] * COPY_ROUND_TRIPS * rtt + item["dirs"] * CMD_ROUND_TRIPS * rtt
+        else:
+            secs += (item["files"] + item["dirs"]) * CMD_ROUND_TRIPS * rtt
+    return secs
+
+
+def _round_pow2(value, lower, upper):
+    """Return the power of two that is closest to `value`, within lower..upper."""
+    res = lower
+    while res < upper and res * 1.5 < value:
+        res *= 2
+    return min(res, upper)
+
+
+def _tune_connections(records):
+    """Return the number of parallel connections with the best throughput or None.
+
+    If the largest number tried so far was also the best, one more is
+    suggested (as long as it still added MIN_CONNECTION_GAIN throughput).
+    If retries were frequent, one connection less is used.
+    """
+    by_count = {}
+    errors = {}
+    for r in records:
+        if r.get("throughput") and r.get("connections"):
+            by_count.setdefault(r["connections"], []).append(r["throughput"])
+            errors.setdefault(r["connections"], []).append(r.get("error_rate", 0))
+    if not by_count:
+        return None
+    rates = dict((n, _median(values)) for n, values in by_count.items())
+    best = max(rates, key=lambda n: rates[n])
+    if _median(errors[best]) > MAX_ERROR_RATE:
+        return max(1, best - 1)
+    if best == max(rates) and best < MAX_CONNECTIONS:
+        prev = rates.get(best - 1)
+        if prev is None or rates[best] >= prev * (1 + MIN_CONNECTION_GAIN):
+            return best + 1
+    return best
+
+
+def tune(records):
+    """Return settings for the next run, derived from history `records`.
+
+    {'connections': n, 'blocksize': bytes, 'large_file_size': bytes};
+    values that could not be derived yet are missing.
+    """
+    res = {}
+    connections = _tune_connections(records)
+    if connections:
+        res["connections"] = connections
+    rtt = _median([r["rtt"] for r in records if r.get("rtt")])
+    rate = _median([max(r.get("upload_rate") or 0, r.get("download_rate") or 0)
+                    for r in records if r.get("upload_rate") or r.get("download_rate")])
+    if rate:
+        # Bandwidth-delay product of one stream
+        if rtt:
+            res["blocksize"] = _round_pow2(rate * rtt, MIN_BLOCKSIZE, MAX_BLOCKSIZE)
+        res["large_file_size"] = _round_pow2(rate * LARGE_FILE_SECS, 
+                                             MIN_LARGE_FILE_SIZE, MAX_LARGE_FILE_SIZE)
+    return res
+
+
+#===============================================================================
+# PerfHistory
+#===============================================================================
+class PerfHistory(object):
+    """Records of previous runs per host, stored in the state folder.
+
+    {'host:port': [{'time': ..., 'rtt': secs, 'upload_rate': bytes/sec, 
+                    'error_rate': retries/file, 'connections': n,
+                    'throughput': bytes/sec, ...}, ...]}
+    Rates are per connection, 'throughput' is the total of 'connections'
+    parallel transfers.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_state_path(HISTORY_FILE_NAME)
+        self.data = None
+
+    def load(self):
+        if self.data is None:
+            try:
+                with open(self.path, "rt") as f:
+                    self.data = json.load(f)
+            except (IOError, OSError, ValueError):
+                self.data = {} # missing or corrupt: start again
+        return self.data
+
+    def save(self):
+        try:
+            with open(self.path + ".tmp", "wt") as f:
+                json.dump(self.data, f, indent=4, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path) # os.rename() does not replace files on Windows
+            os.rename(self.path + ".tmp", self.path)
+        except (IOError, OSError) as e:
+            print("Could not store performance history: %s" % e, file=sys.stderr)
+
+    def add_record(self, host_key, record):
+        """Append a record for `host_key` (the oldest records are dropped)."""
+        records = self.load().setdefault(host_key, [])
+        records.append(record)
+        del records[:-MAX_RECORDS]
+        self.save()
+
+    def get_records(self, host_key):
+        return self.load().get(host_key, [])
+
+    def get_estimates(self, host_key):
+        """Return the medians of all recorded values {'rtt': ..., 'upload_rate': ..., ...}."""
+        res = {}
+        records = self.get_records(host_key)
+        for name in ("rtt", "upload_rate", "download_rate"):
+            values = [r[name] for r in records if r.get(name)]
+            if values:
+                res[name] = _median(values)
+        return res
+
+    def get_tuning(self, host_key):
+        """Return tune() settings for `host_key`."""
+        return tune(self.get_records(host_key))
@@ -0,0 +1,194 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Run many synchronization jobs in one process.
+
+A job file lists local/remote pairs (YAML, or JSON if PyYAML is missing)::
+
+    max_jobs: 8                 # jobs that run at the same time
+    max_connections_per_host: 2 # FTP connections per server
+    max_rate: 1000000           # bytes/sec for all jobs together (optional)
+    max_transfers_per_host: 4   # concurrent transfers per server (optional)
+    defaults:                   # options for all jobs
+      delete: true
+    jobs:
+      - name: site1
+        command: upload         # upload, download, or sync
+        local: /var/www/site1
+        remote: ftp://user@example.com/site1
+        options:                # override defaults
+          force: true
+          max_rate: 200000      # bytes/sec for this job (optional)
+"""
+from __future__ import print_function
+
+import json
+from multiprocessing.pool import ThreadPool
+import sys
+import threading
+import time
+import traceback
+
+from ftpsync.ftp_target import FtpConnectionPool
+from ftpsync.scheduler import Scheduler
+from ftpsync.synchronizers import UploadSynchronizer, DownloadSynchronizer, \
+    BiDirSynchronizer
+from ftpsync.targets import make_target, FsTarget
+
+try:
+    import yaml
+except ImportError:
+    yaml = None  # Only JSON job files are supported
+
+
+DEFAULT_MAX_JOBS = 4
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 2
+
+SYNCHRONIZERS = {"upload": UploadSynchronizer,
+                 "download": DownloadSynchronizer,
+                 "sync": BiDirSynchronizer,
+                 }
+
+
+def load_jobs(path):
+    """Read and check a job file (YAML or JSON) and return its dict."""
+    with open(path, "rt") as f:
+        text = f.read()
+    if path.lower().endswith(".json"):
+        config = json.loads(text)
+    elif yaml:
+        config = yaml.safe_load(text)
+    else:
+        raise RuntimeError("PyYAML is required to read %s (try `pip install pyyaml` "
+                           "or use a .json file)" % path)
+    if not isinstance(config, dict) or not isinstance(config.get("jobs"), list):
+        raise ValueError("%s: expected a dict with a 'jobs' list" % path)
+    return check_jobs(config)
+
+
+def check_jobs(config):
+    """Add default names and commands to all jobs and raise ValueError if a job is invalid."""
+    for i, job in enumerate(config["jobs"]):
+        job.setdefault("name", "job%s" % (i + 1))
+        job.setdefault("command", "upload")
+        if job["command"] not in SYNCHRONIZERS:
+            raise ValueError("%s: invalid command %r (expected one of %s)"
+                             % (job["name"], job["command"], ", ".join(sorted(SYNCHRONIZERS))))
+        if not job.get("local") or not job.get("remote"):
+            raise ValueError("%s: 'local' and 'remote' are required" % job["name"])
+    return config
+
+
+#===============================================================================
+# JobRunner
+#===============================================================================
+class JobRunner(object):
+    """Run the jobs of a job file in a thread pool.
+
+    FTP targets share an FtpConnectionPool, so jobs for the same server reuse
+    logged-in connections and never open more than `max_connections_per_host`.
+    All jobs also share a Scheduler that enforces the global `max_rate` and
+    `max_transfers_per_host`; a job's own 'max_rate' option limits only that job.
+    """
+    def __init__(self, config, options):
+        self.config = check_jobs(config)
+        self.options = options or {}
+        self.verbose = self.options.get("verbose", 3)
+        self.max_jobs = (self.options.get("max_jobs") or config.get("max_jobs")
+                         or DEFAULT_MAX_JOBS)
+        max_per_host = (self.options.get("max_connections")
+                        or config.get("max_connections_per_host")
+                        or DEFAULT_MAX_CONNECTIONS_PER_HOST)
+        self.pool = FtpConnectionPool(max_per_host)
+        self.scheduler = Scheduler(
+            self.options.get("max_rate") or config.get("max_rate"),
+            self.options.get("max_transfers_per_host") or config.get("max_transfers_per_host"))
+        self.results = [] # [(job, stats or None, error or None), ...]
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def get_stats(self):
+        return self._stats
+
+    def _get_job_options(self, job):
+        opts = dict(self.options)
+        # Global limits are enforced by the shared scheduler
+        opts.pop("max_rate", None)
+        opts.pop("max_transfers_per_host", None)
+        opts["scheduler"] = self.scheduler
+        opts.update(self.config.get("defaults") or {})
+        opts.update(job.get("options") or {})
+        # Command line flags win over the job file
+        opts["dry_run"] = self.options.get("dry_run", True)
+        # We cannot ask the user while other jobs are printing
+        if opts.get("resolve", "ask") == "ask":
+            opts["resolve"] = "skip"
+        if opts.get("delete_unmatched"):
+            opts["delete"] = True
+        return opts
+
+    def _run_job(self, job):
+        opts = self._get_job_options(job)
+        target_opts = {"ftp_debug": 1 if opts.get("verbose", 3) >= 5 else 0,
+                       "connection_pool": self.pool,
+                       }
+        local = remote = None
+        try:
+            local = make_target(job["local"], target_opts)
+            remote = make_target(job["remote"], target_opts)
+            if not isinstance(local, FsTarget) and isinstance(remote, FsTarget):
+                raise ValueError("a file system target is expected to be local")
+            s = SYNCHRONIZERS[job["command"]](local, remote, opts)
+            s.run()
+            res = (job, s.get_stats(), None)
+        except Exception as e:
+            if self.verbose >= 4:
+                traceback.print_exc()
+            print("Job %s failed: %s" % (job["name"], e), file=sys.stderr)
+            res = (job, None, e)
+        finally:
+            for target in (remote, local):
+                if target is not None:
+                    try:
+                        target.close()
+                    except Exception:
+                        pass
+        with self._lock:
+            self.results.append(res)
+        if self.verbose >= 1 and res[1]:
+            print("Job %s: wrote %s files. Elap: %s"
+                  % (job["name"], res[1]["files_written"], res[1]["elap_str"]))
+        return res
+
+    def run(self):
+        start = time.time()
+        jobs = self.config["jobs"]
+        if self.verbose >= 3:
+            print("Running %s jobs (max. %s at a time, %s connections per host)"
+                  % (len(jobs), self.max_jobs, self.pool.max_per_host))
+        pool = ThreadPool(self.max_jobs)
+        try:
+            pool.map(self._run_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            self.pool.close()
+
+        stats = self._stats
+        for job, job_stats, _error in self.results:
+            for k, v in (job_stats or {}).items():
+                if isinstance(v, (int, float)) and not isinstance(v, bool):
+                    stats[k] = stats.get(k, 0) + v
+        stats.update(self.pool.stats)
+        stats.update(self.scheduler.get_stats())
+        stats["jobs"] = len(jobs)
+        stats["jobs_failed"] = len([r for r in self.results if r[2] is not None])
+        stats.setdefault("files_written", 0)
+        stats.setdefault("local_files", 0)
+        stats.setdefault("local_dirs", 0)
+        # Sum of the job times (elap_secs) is the time we would need sequentially
+        stats["jobs_elap_secs"] = stats.pop("elap_secs", 0)
+        stats["elap_secs"] = time.time() - start
+        stats["elap_str"] = "%0.2f sec" % stats["elap_secs"]
+        return stats["jobs_failed"] == 0
@@ -0,0 +1,114 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Append-only journal of completed sync actions, used to resume interrupted runs.
+"""
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+
+from ftpsync.targets import get_state_path
+
+
+#: Sync the journal to disk after this many records ...
+DEFAULT_BATCH_SIZE = 50
+#: ... or if the last sync is older than this (seconds)
+DEFAULT_BATCH_SECS = 1.0
+
+
+def get_journal_path(local, remote):
+    """Return the journal path for a pair of targets (in the state folder)."""
+    key = "%s\n%s" % (local.get_id(), remote.get_id())
+    digest = hashlib.md5(key.encode("utf-8")).hexdigest()[:16]
+    return get_state_path("journal-%s.jsonl" % digest)
+
+
+#===============================================================================
+# SyncJournal
+#===============================================================================
+class SyncJournal(object):
+    """Append-only journal, one JSON record per line.
+
+    Records are written immediately, but fsync'ed in batches; a crash may lose
+    the last batch, which only means that these actions are compared again.
+    The file is removed by close(), if the run completed.
+    """
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, batch_secs=DEFAULT_BATCH_SECS):
+        self.path = path
+        self.batch_size = batch_size
+        self.batch_secs = batch_secs
+        self.stats = {"journal_records": 0,
+                      "journal_syncs": 0,
+                      }
+        self._fp = None
+        self._valid_size = 0
+        self._pending = 0
+        self._last_sync = time.time()
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Return the records of an interrupted run (a truncated last line is ignored)."""
+        res = []
+        self._valid_size = 0
+        if not os.path.exists(self.path):
+            return res
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("missing line end")
+                    res.append(json.loads(line.decode("utf-8")))
+                except ValueError:
+                    print("Ignoring invalid journal record in %s: %r" % (self.path, line),
+                          file=sys.stderr)
+                    break
+                self._valid_size += len(line)
+        return res
+
+    def open(self):
+        """Load existing records and open the journal for appending."""
+        records = self.load()
+        self._fp = open(self.path, "at")
+        # Drop a torn last line, so new records start on a line of their own
+        if self._fp.tell() > self._valid_size:
+            self._fp.truncate(self._valid_size)
+        return records
+
+    def record(self, action, rel_dir, **kwargs):
+        """Append a record {'a': action, 'd': rel_dir, ...}."""
+        kwargs["a"] = action
+        kwargs["d"] = rel_dir
+        line = json.dumps(kwargs) + "\n"
+        with self._lock:
+            self._fp.write(line)
+            self.stats["journal_records"] += 1
+            self._pending += 1
+            if (self._pending >= self.batch_size
+                    or time.time() - self._last_sync >= self.batch_secs):
+                self._sync()
+
+    def _sync(self):
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+        self._pending = 0
+        self._last_sync = time.time()
+        self.stats["journal_syncs"] += 1
+
+    def close(self, completed):
+        """Close the journal and remove it if the run `completed`."""
+        with self._lock:
+            if self._fp is None:
+                return
+            if self._pending:
+                self._sync()
+            self._fp.close()
+            self._fp = None
+        if completed:
+            os.remove(self.path)
@@ -14,10 +14,14 @@ from __future__ import print_function
 from pprint import pprint
 
 from ftpsync._version import __version__
-from ftpsync.targets import make_target, FsTarget
+from ftpsync.targets import make_target, FsTarget, HASH_ALGOS
 
 from ftpsync.synchronizers import UploadSynchronizer, \
-    DownloadSynchronizer, BiDirSynchronizer, DEFAULT_OMIT
+    DownloadSynchronizer, BiDirSynchronizer, MultiUploadSynchronizer, DEFAULT_OMIT
+from ftpsync.watch import WatchSynchronizer
+from ftpsync.jobs import JobRunner, load_jobs
+from ftpsync.agent import AgentClient, FtpAgent, DEFAULT_IDLE_TIMEOUT, \
+    DEFAULT_CHECK_INTERVAL
 
 
 #def disable_stdout_buffering():
@@ -46,6 +50,28 @@ def namespace_to_dict(o):
     return d
 
 
+def format_dry_run_report(report):
+    """Return a one-line summary of BaseSynchronizer.get_dry_run_report()."""
+    parts = []
+    for kind in ("upload", "download", "delete", "move"):
+        item = report["actions"].get(kind)
+        if not item:
+            continue
+        text = "%s %s files" % (kind, item["files"])
+        if item["bytes"]:
+            text += " (%0.1f kB)" % (.001 * item["bytes"])
+        if item["dirs"]:
+            text += ", %s dirs" % item["dirs"]
+        parts.append(text)
+    res = "Would %s in %s dirs." % ("; ".join(parts) or "change nothing", 
+                                     report["dirs_touched"])
+    if report["eta_secs"] is None:
+        res += " ETA: unknown (no real run recorded for this host)"
+    else:
+        res += " ETA: %0.1f sec" % report["eta_secs"]
+    return res
+
+
 #===============================================================================
 # run
 #===============================================================================
@@ -91,6 +117,99 @@ def run():
                             "separate multiple values with ',')")
         parser.add_argument("-o", "--omit", 
                             help="wildcard of files and directories to exclude (applied after --include)")
+        parser.add_argument("--compare", 
+                            default="mtime",
+                            choices=["mtime", "hash"],
+                            help="treat files of same size as equal if their hashes match, "
+                            "even if the modification dates differ (default: %(default)s)")
+        parser.add_argument("--verify", 
+                            nargs="?", const="auto",
+                            choices=["auto"] + list(HASH_ALGOS),
+                            help="hash files while copying them and compare with the "
+                            "server's HASH/XMD5 reply; 'auto' (default if no value is "
+                            "given) uses the fastest algorithm the server supports")
+        parser.add_argument("--delta", 
+                            action="store_true",
+                            help="update existing local files of 1 MB or more in place, "
+                            "rewriting only the 64 kB blocks that changed (hard links "
+                            "to these files see the changes)")
+        parser.add_argument("--mode-z", 
+                            action="store_true",
+                            help="compress transfers of text files (if the FTP server "
+                            "supports MODE Z)")
+        parser.add_argument("--max-rate", 
+                            type=int,
+                            help="limit transfers to MAX_RATE bytes/sec")
+        parser.add_argument("--max-transfers-per-host", 
+                            type=int,
+                            help="limit the number of concurrent transfers per FTP host")
+        parser.add_argument("--atomic", 
+                            nargs="?", const="file",
+                            choices=["file", "dir", "plan"],
+                            help="upload to temporary names and rename them after "
+                            "each file (default), each directory, or the whole run")
+        parser.add_argument("--journal", 
+                            action="store_true",
+                            help="record completed actions, so an interrupted run "
+                            "can be resumed without comparing everything again")
+        parser.add_argument("--meta-format", 
+                            choices=["json", "compact"], default="json",
+                            help="format of the meta data files that pyftpsync "
+                            "writes (compact is smaller, but not readable by older "
+                            "versions, default: %(default)s)")
+        parser.add_argument("--meta-gzip", 
+                            action="store_true",
+                            help="compress meta data files")
+        parser.add_argument("--meta-write-behind", 
+                            action="store_true",
+                            help="write meta data files on a background connection")
+        parser.add_argument("--no-pipeline", 
+                            dest="pipeline", action="store_false",
+                            help="wait for each reply before sending the next command "
+                            "(by default DELE, MKD, RMD, and RNFR/RNTO are sent in batches)")
+        parser.add_argument("--no-sendfile", 
+                            dest="sendfile", action="store_false",
+                            help="upload through Python buffers instead of the "
+                            "kernel's sendfile()")
+        parser.add_argument("--no-perf-history", 
+                            dest="perf_history", action="store_false",
+                            help="don't record throughput and latency of this run "
+                            "and don't tune settings from previous runs")
+        parser.add_argument("--agent", 
+                            action="store_true",
+                            help="borrow logged-in FTP connections from a running "
+                            "`pyftpsync agent` and hand them back afterwards")
+        parser.add_argument("--max-connections", 
+                            type=int,
+                            help="max. number of FTP connections per host, including "
+                            "extra connections for lanes, listing, and deleting "
+                            "(default: no limit)")
+        parser.add_argument("--bulk-list", 
+                            action="store_true",
+                            help="list the whole remote tree up front, using "
+                            "parallel connections and no CWD per folder")
+        parser.add_argument("--order", 
+                            choices=["smallest", "largest", "extension", "directory"],
+                            help="copy files in this order after comparing the whole "
+                            "tree (default: copy while traversing)")
+        parser.add_argument("--ext-priority", 
+                            help="file extensions that --order=extension copies first "
+                            "(separate multiple values with ',', default: "
+                            "'html,htm,css,js,json,xml,svg,txt')")
+        parser.add_argument("--large-file-size", 
+                            type=int,
+                            help="with --order, files of this size (bytes) or larger are "
+                            "copied in separate lanes (default: tuned from the "
+                            "performance history, or 1048576)")
+        parser.add_argument("--large-lanes", 
+                            type=int,
+                            help="number of extra connections for large files "
+                            "(0: copy them last, default: tuned from the "
+                            "performance history, or 1)")
+        parser.add_argument("--blocksize", 
+                            type=int,
+                            help="bytes per read/write call when copying files "
+                            "(default: tuned from the performance history, or 8192)")
         parser.add_argument("--store-password", 
                                  action="store_true",
                                  help="save password to keyring if login succeeds")
@@ -117,6 +236,23 @@ def run():
                                help="remove remote files if they don't exist locally "
                                "or don't match the current filter (implies '--delete' option)")
 
+    upload_parser.add_argument("--detect-moves", 
+                               action="store_true",
+                               help="rename remote files and directories that were moved, "
+                               "instead of copying them again (requires '--delete' option)")
+    upload_parser.add_argument("--mirror", 
+                               action="append", metavar="REMOTE", default=[],
+                               help="additional remote folder that receives the same "
+                               "files (may be repeated)")
+    upload_parser.add_argument("--async", 
+                               action="store_true", dest="async_mode",
+                               help="use asyncio and many parallel FTP connections "
+                               "(requires Python 3.5+)")
+    upload_parser.add_argument("--connections", 
+                               type=int, default=10,
+                               help="max. number of FTP connections in '--async' mode "
+                               "(default: %(default)s)")
+
     upload_parser.set_defaults(command="upload")
     
 
@@ -136,8 +272,38 @@ def run():
                                  help="remove local files if they don't exist on remote target "
                                  "or don't match the current filter (implies '--delete' option)")
     
+    download_parser.add_argument("--detect-moves", 
+                                 action="store_true",
+                                 help="rename local files and directories that were moved, "
+                                 "instead of copying them again (requires '--delete' option)")
+
     download_parser.set_defaults(command="download")
     
+    # Create the parser for the "watch" command
+    watch_parser = subparsers.add_parser("watch", 
+            help="upload modified files to remote folder whenever they change")
+    __add_common_sub_args(watch_parser)
+
+    watch_parser.add_argument("--force", 
+                              action="store_true",
+                              help="overwrite different remote files, even if the target is newer")
+    watch_parser.add_argument("--delete", 
+                              action="store_true",
+                              help="remove remote files if they don't exist locally")
+    watch_parser.add_argument("--debounce", 
+                              type=float, default=2.0,
+                              help="wait until there were no changes for DEBOUNCE seconds "
+                              "before uploading (default: %(default)s)")
+    watch_parser.add_argument("--keepalive", 
+                              type=float, default=60.0,
+                              help="send NOOP to the server after KEEPALIVE idle seconds "
+                              "(default: %(default)s)")
+    watch_parser.add_argument("--poll", 
+                              action="store_true",
+                              help="poll for changes, even if inotify is available")
+
+    watch_parser.set_defaults(command="watch")
+    
     # Create the parser for the "sync" command
     sync_parser = subparsers.add_parser("sync", 
             help="synchronize new and modified files between remote folder and local target")
@@ -158,12 +324,64 @@ def run():
                              help="conflict resolving strategy (default: 'ask')")
     
     sync_parser.set_defaults(command="synchronize")
+
+    # Create the parser for the "run-jobs" command
+    jobs_parser = subparsers.add_parser("run-jobs", 
+            help="run many upload/download/sync jobs from a YAML or JSON file")
+    jobs_parser.add_argument("jobs_file", 
+                             metavar="JOBS_FILE",
+                             help="path to job file")
+    jobs_parser.add_argument("-x", "--execute", 
+                             action="store_false", dest="dry_run", default=True,
+                             help="turn off the dry-run mode (which is ON by default)")
+    jobs_parser.add_argument("--max-jobs", 
+                             type=int,
+                             help="number of jobs that run concurrently "
+                             "(default: 'max_jobs' from job file or 4)")
+    jobs_parser.add_argument("--max-connections", 
+                             type=int,
+                             help="max. number of FTP connections per host (default: "
+                             "'max_connections_per_host' from job file or 2)")
+    jobs_parser.add_argument("--max-rate", 
+                             type=int,
+                             help="limit transfers of all jobs to MAX_RATE bytes/sec "
+                             "(default: 'max_rate' from job file)")
+    jobs_parser.add_argument("--max-transfers-per-host", 
+                             type=int,
+                             help="limit the number of concurrent transfers per FTP host "
+                             "(default: 'max_transfers_per_host' from job file)")
+    jobs_parser.add_argument("--no-color", 
+                             action="store_true",
+                             help="prevent use of ansi terminal color codes")    
+
+    jobs_parser.set_defaults(command="run_jobs")
+
+    # Create the parser for the "agent" command
+    agent_parser = subparsers.add_parser("agent", 
+            help="keep FTP connections logged in between runs that use --agent")
+    agent_parser.add_argument("--idle-timeout", 
+                              type=float, default=DEFAULT_IDLE_TIMEOUT,
+                              help="close connections that were not used for IDLE_TIMEOUT "
+                              "seconds (default: %(default)s)")
+    agent_parser.add_argument("--check-interval", 
+                              type=float, default=DEFAULT_CHECK_INTERVAL,
+                              help="send NOOP to idle connections every CHECK_INTERVAL "
+                              "seconds (default: %(default)s)")
+    agent_parser.add_argument("--status", 
+                              action="store_true",
+                              help="print statistics of the running agent")
+    agent_parser.add_argument("--stop", 
+                              action="store_true",
+                              help="stop the running agent")
+
+    agent_parser.set_defaults(command="agent")
     
     # Parse command line
     args = parser.parse_args()
 
     if not hasattr(args, "command"):
-        parser.error("missing command (choose from 'upload', 'download', 'sync')")
+        parser.error("missing command (choose from 'upload', 'download', 'sync', 'watch', "
+                     "'run-jobs', 'agent')")
 
     # Post-process and check arguments
     args.verbose -= args.quiet
@@ -175,6 +393,47 @@ def run():
     ftp_debug = 0
     if args.verbose >= 5:
         ftp_debug = 1 
+
+    if args.command == "agent":
+        if args.stop or args.status:
+            client = AgentClient()
+            res = client.stop() if args.stop else client.get_stats()
+            if not res:
+                parser.error("no agent is running")
+            if args.status:
+                pprint(res)
+            return
+        try:
+            agent = FtpAgent(idle_timeout=args.idle_timeout, 
+                             check_interval=args.check_interval, verbose=args.verbose)
+            agent.serve_forever()
+        except RuntimeError as e:
+            parser.error(str(e))
+        except KeyboardInterrupt:
+            print("\nAgent stopped.")
+        return
+
+    if args.command == "run_jobs":
+        try:
+            config = load_jobs(args.jobs_file)
+        except (IOError, ValueError, RuntimeError) as e:
+            parser.error(str(e))
+        s = JobRunner(config, namespace_to_dict(args))
+        try:
+            s.run()
+        except KeyboardInterrupt:
+            print("\nAborted by user.")
+            return
+        stats = s.get_stats()
+        if args.verbose >= 4:
+            pprint(stats)
+        elif args.verbose >= 1:
+            if args.dry_run:
+                print("(DRY-RUN) ", end="")
+            print("Ran %s jobs (%s failed). Wrote %s/%s files in %s dirs. Elap: %s" 
+                  % (stats["jobs"], stats["jobs_failed"], stats["files_written"], 
+                     stats["local_files"], stats["local_dirs"], stats["elap_str"]))
+        return
         
     args.local_target = make_target(args.local, {"ftp_debug": ftp_debug})
     
@@ -186,12 +445,35 @@ def run():
 
     # Let the command handler do its thing
     opts = namespace_to_dict(args)
-    if args.command == "upload":
+    if args.command == "upload" and args.async_mode:
+        try:
+            from ftpsync.async_ftp import AsyncFtpTarget, AsyncUploadSynchronizer
+        except (ImportError, SyntaxError):
+            parser.error("--async requires Python 3.5+")
+        remote = args.remote_target
+        if isinstance(remote, FsTarget):
+            parser.error("--async requires an FTP target")
+        remote = AsyncFtpTarget(remote.root_dir, remote.host, remote.port, 
+                                remote.username, remote.password)
+        try:
+            s = AsyncUploadSynchronizer(args.local_target, remote, opts)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.command == "upload" and args.mirror:
+        remotes = [args.remote_target]
+        remotes.extend(make_target(url, {"ftp_debug": ftp_debug}) for url in args.mirror)
+        try:
+            s = MultiUploadSynchronizer(args.local_target, remotes, opts)
+        except ValueError as e:
+            parser.error(str(e))
+    elif args.command == "upload":
         s = UploadSynchronizer(args.local_target, args.remote_target, opts)
     elif args.command == "download":
         s = DownloadSynchronizer(args.local_target, args.remote_target, opts)
     elif args.command == "synchronize":
         s = BiDirSynchronizer(args.local_target, args.remote_target, opts)
+    elif args.command == "watch":
+        s = WatchSynchronizer(args.local_target, args.remote_target, opts)
     else:
         parser.error("unknown command %s" % args.command)
 
@@ -199,7 +481,8 @@ def run():
         s.run()
     except KeyboardInterrupt:
         print("\nAborted by user.")
-        return
+        if args.command != "watch":
+            return
 
     stats = s.get_stats()
     if args.verbose >= 4:
@@ -209,6 +492,8 @@ def run():
             print("(DRY-RUN) ", end="")
         print("Wrote %s/%s files in %s dirs. Elap: %s" 
               % (stats["files_written"], stats["local_files"], stats["local_dirs"], stats["elap_str"]))
+        if args.dry_run and hasattr(s, "get_dry_run_report"):
+            print("(DRY-RUN) %s" % format_dry_run_report(s.get_dry_run_report()))
     
 
 # Script entry point
@@ -41,6 +41,7 @@ class _Resource(object):
         self.mtime_org = mtime  # as reported by source server
         self.unique = unique
         self.meta = None # Set by target.get_dir()
+        self.hash = None # Set by synchronizer in '--compare hash' mode
 
     def __str__(self):
         return "%s('%s', size:%s, modified:%s)" % (self.__class__.__name__, 
@@ -84,9 +85,11 @@ class FileEntry(_Resource):
         super(FileEntry, self).__init__(target, rel_path, name, size, mtime, unique)
 
     @staticmethod
-    def _eps_compare(date_1, date_2):
+    def _eps_compare(date_1, date_2, eps=None):
         res = date_1 - date_2
-        if abs(res) <= FileEntry.EPS_TIME: # '<=',so eps == 0 works as expected
+        if eps is None:
+            eps = FileEntry.EPS_TIME
+        if abs(res) <= eps: # '<=',so eps == 0 works as expected
 #             print("DTC: %s, %s => %s" % (date_1, date_2, res))
             return 0
         elif res < 0:
@@ -96,14 +99,23 @@ class FileEntry(_Resource):
     def is_file(self):
         return True
 
+    def _get_eps(self, other):
+        """Return the max. mtime difference that is considered equal.
+
+        Targets that only store whole seconds (e.g. FTP servers that support
+        MFMT) raise the default EPS_TIME.
+        """
+        return max(FileEntry.EPS_TIME, self.target.mtime_precision, 
+                   other.target.mtime_precision)
+
     def __eq__(self, other):
-        same_time = self._eps_compare(self.mtime, other.mtime) == 0
+        same_time = self._eps_compare(self.mtime, other.mtime, self._get_eps(other)) == 0
         return (other and other.__class__ == self.__class__ 
                 and other.name == self.name and other.size == self.size 
                 and same_time)
 
     def __gt__(self, other):
-        time_greater = self._eps_compare(self.mtime, other.mtime) > 0
+        time_greater = self._eps_compare(self.mtime, other.mtime, self._get_eps(other)) > 0
         return (other and other.__class__ == self.__class__ 
                 and other.name == self.name 
                 and time_greater)
@@ -0,0 +1,202 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Limit bandwidth and concurrent transfers of one or more synchronizers.
+"""
+from __future__ import print_function
+
+from contextlib import contextmanager
+import heapq
+import itertools
+import threading
+import time
+
+
+#===============================================================================
+# TokenBucket
+#===============================================================================
+class TokenBucket(object):
+    """Limit throughput to `rate` bytes/sec, allowing bursts of `burst` bytes.
+
+    Callers may overdraw the bucket; they are then delayed until the debt is
+    paid back, so the long-term rate holds even with many threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """Wait until `size` bytes may be sent and return the seconds we waited."""
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= size
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+#===============================================================================
+# RateMeter
+#===============================================================================
+class RateMeter(object):
+    """Record transferred bytes per second, so limits can be checked afterwards."""
+    def __init__(self):
+        self.start = time.time()
+        self.total = 0
+        self.per_sec = {}
+        self._lock = threading.Lock()
+
+    def add(self, size):
+        with self._lock:
+            sec = int(time.time())
+            self.per_sec[sec] = self.per_sec.get(sec, 0) + size
+            self.total += size
+
+    def get_peak_rate(self):
+        """Return bytes of the busiest second (the current second is ignored)."""
+        now = int(time.time())
+        with self._lock:
+            done = [v for k, v in self.per_sec.items() if k < now]
+        return max(done) if done else 0
+
+    def get_avg_rate(self):
+        elap = time.time() - self.start
+        return self.total / elap if elap > 0 else 0
+
+
+#===============================================================================
+# _PrioritySlots
+#===============================================================================
+class _PrioritySlots(object):
+    """Semaphore that wakes waiters with the lowest priority value first."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self.peak = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def acquire(self, priority=0):
+        """Wait for a free slot and return the seconds we waited."""
+        start = time.time()
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            while self.active >= self.limit or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            # The next waiter may get a slot, too
+            self._cond.notify_all()
+        return time.time() - start
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+#===============================================================================
+# Scheduler
+#===============================================================================
+class Scheduler(object):
+    """Limit bandwidth and concurrent transfers per host.
+
+    One instance may be shared by many synchronizers (e.g. by run-jobs).
+    When transfer slots are contended, smaller files get them first.
+
+    Use get_stats() to check that the limits were held:
+    'sched_peak_transfers' (max. concurrent transfers to any host),
+    'sched_peak_rate' (bytes of the busiest second), 'sched_avg_rate'.
+    """
+    def __init__(self, max_rate=None, max_transfers_per_host=None):
+        self.bucket = TokenBucket(max_rate) if max_rate else None
+        self.max_transfers_per_host = max_transfers_per_host
+        self.meter = RateMeter()
+        self._slots = {}
+        self._lock = threading.Lock()
+        self._stats = {"sched_slot_wait_secs": 0.0,
+                       "sched_throttle_secs": 0.0,
+                       }
+
+    @staticmethod
+    def from_options(options):
+        """Return a Scheduler if 'max_rate' or 'max_transfers_per_host' is set, else None."""
+        max_rate = options.get("max_rate")
+        max_transfers = options.get("max_transfers_per_host")
+        if not max_rate and not max_transfers:
+            return None
+        return Scheduler(max_rate, max_transfers)
+
+    def _inc_stat(self, name, ofs):
+        with self._lock:
+            self._stats[name] += ofs
+
+    def _get_slots(self, host):
+        with self._lock:
+            slots = self._slots.get(host)
+            if slots is None:
+                slots = self._slots[host] = _PrioritySlots(self.max_transfers_per_host)
+            return slots
+
+    def throttle(self, size, job_bucket=None):
+        """Account for `size` bytes (blocks if a bandwidth limit is exceeded)."""
+        wait = 0
+        if job_bucket:
+            wait += job_bucket.consume(size)
+        if self.bucket:
+            wait += self.bucket.consume(size)
+        if wait:
+            self._inc_stat("sched_throttle_secs", wait)
+        self.meter.add(size)
+
+    @contextmanager
+    def transfer(self, host, size, job_bucket=None):
+        """Context manager that holds a transfer slot for `host`.
+
+        Yields a function that wraps a file object, so read() is throttled.
+        """
+        slots = None
+        if self.max_transfers_per_host:
+            slots = self._get_slots(host or "local")
+            self._inc_stat("sched_slot_wait_secs", slots.acquire(size or 0))
+        try:
+            yield lambda fp: _ThrottledReader(fp, self, job_bucket)
+        finally:
+            if slots:
+                slots.release()
+
+    def get_stats(self):
+        res = dict(self._stats)
+        with self._lock:
+            res["sched_peak_transfers"] = max([s.peak for s in self._slots.values()] or [0])
+        res["sched_peak_rate"] = self.meter.get_peak_rate()
+        res["sched_avg_rate"] = self.meter.get_avg_rate()
+        return res
+
+
+class _ThrottledReader(object):
+    """File-like wrapper that calls Scheduler.throttle() for every block read."""
+    def __init__(self, fp, scheduler, job_bucket):
+        self._fp = fp
+        self._scheduler = scheduler
+        self._job_bucket = job_bucket
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        if data:
+            self._scheduler.throttle(len(data), self._job_bucket)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
@@ -7,13 +7,26 @@ Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.p
 from __future__ import print_function
 
 import fnmatch
+from multiprocessing.pool import ThreadPool
+import os
+from posixpath import join as join_url, normpath as normpath_url, \
+    dirname as dirname_url, basename as basename_url, relpath as relpath_url
 import sys
+import threading
 import time
 from datetime import datetime
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
 from ftpsync.targets import IS_REDIRECTED, DRY_RUN_PREFIX, DirMetadata,\
-    ansi_code
+    ansi_code, DEFAULT_BLOCKSIZE, MetaWriter, FsTarget, HASH_ALGOS, new_hash
+from ftpsync import diff as diff_mod
+from ftpsync.history import PerfHistory, estimate_secs, measure_run
+from ftpsync.journal import SyncJournal, get_journal_path
 from ftpsync.resources import FileEntry, DirectoryEntry
+from ftpsync.scheduler import Scheduler, TokenBucket
 
 def _ts(timestamp):
     return "{} ({})".format(datetime.fromtimestamp(timestamp), timestamp)
@@ -25,6 +38,28 @@ DEFAULT_OMIT = [".DS_Store",
                 DirMetadata.META_FILE_NAME,
                 ]
 
+#: Values for the 'order' option (None: copy files while traversing the tree)
+TRANSFER_ORDERS = ("smallest", "largest", "extension", "directory")
+#: File extensions that are copied first by `order='extension'`
+DEFAULT_EXT_PRIORITY = "html,htm,css,js,json,xml,svg,txt"
+#: Files of this size (bytes) or larger are copied in separate lanes
+DEFAULT_LARGE_FILE_SIZE = 1024 * 1024
+DEFAULT_LARGE_LANES = 1
+
+
+def check_unsupported_options(options, names, context):
+    """Raise ValueError if one of the option `names` is set in `options`.
+
+    'compare' is only set if it is not 'mtime' (the default).
+    """
+    unsupported = []
+    for name in names:
+        value = (options or {}).get(name)
+        if value and not (name == "compare" and value == "mtime"):
+            unsupported.append("--" + name.replace("_", "-"))
+    if unsupported:
+        raise ValueError("not supported %s: %s" % (context, ", ".join(unsupported)))
+
 
 #===============================================================================
 # BaseSynchronizer
@@ -47,6 +82,42 @@ class BaseSynchronizer(object):
         self.omit = self.options.get("omit")
         if self.omit:
             self.omit = [ pat.strip() for pat in self.omit.split(",") ]
+
+        # 'mtime': compare files by size and modification date
+        # 'hash': files of same size are considered equal if the hashes match
+        self.compare = self.options.get("compare") or "mtime"
+        if self.compare not in ("mtime", "hash"):
+            raise ValueError("Invalid compare mode: %r" % self.compare)
+        self.hash_algo = None # Set by _get_hash_algo()
+        # Hash copied files while transferring them: an algorithm or 'auto'
+        self.verify = self.options.get("verify") or None
+        if self.verify not in (None, "auto") and self.verify not in HASH_ALGOS:
+            raise ValueError("Invalid verify algorithm: %r" % self.verify)
+        self.strategies = {} # Set by _select_strategies()
+
+        # Copy files in this order after the whole tree was traversed
+        self.order = self.options.get("order")
+        if self.order is not None and self.order not in TRANSFER_ORDERS:
+            raise ValueError("Invalid order: %r" % self.order)
+        self._plan = None # List of _PlannedCopy while collecting
+        self.journal = None # SyncJournal, if the 'journal' option is set
+        self._journal_done = set() # Completed directories of an interrupted run
+        self.meta_writer = None # MetaWriter, if the 'meta_write_behind' option is set
+        # Actions that a dry run would perform (see get_dry_run_report())
+        self._dry_run_actions = {}
+        self._dry_run_dirs = set()
+        self._dry_run_secs = None
+        # Settings derived from the performance history (see _apply_tuning())
+        self.tuning = {}
+
+        # Bandwidth and transfer limits. A scheduler passed by the caller may
+        # be shared with other synchronizers; 'max_rate' is then a per-job limit.
+        self.scheduler = self.options.get("scheduler")
+        self._job_bucket = None
+        if self.scheduler is None:
+            self.scheduler = Scheduler.from_options(self.options)
+        elif self.options.get("max_rate"):
+            self._job_bucket = TokenBucket(self.options["max_rate"])
         
         self.local.synchronizer = self
         self.local.peer = remote
@@ -57,12 +128,8 @@ class BaseSynchronizer(object):
             self.local.dry_run = True
             self.remote.readonly = True
             self.remote.dry_run = True
-        if not local.connected:
-            local.open()
-        if not remote.connected:
-            remote.open()
-
         self.resolve_all = None
+        self._stats_lock = threading.Lock()
                 
         self._stats = {"bytes_written": 0,
                        "conflict_files": 0,
@@ -86,12 +153,18 @@ class BaseSynchronizer(object):
                        "upload_bytes_written": 0,
                        "upload_files_written": 0,
                        }
+        # Open targets last, because they may already update the stats
+        if not local.connected:
+            local.open()
+        if not remote.connected:
+            remote.open()
     
     def get_stats(self):
         return self._stats
     
     def _inc_stat(self, name, ofs=1):
-        self._stats[name] = self._stats.get(name, 0) + ofs
+        with self._stats_lock:
+            self._stats[name] = self._stats.get(name, 0) + ofs
 
     def _match(self, entry):
         name = entry.name
@@ -122,8 +195,43 @@ class BaseSynchronizer(object):
                                             info_strings[1], 
                                             self.remote.get_base_name()))
 
-        res = self._sync_dir()
-        
+        self._select_strategies()
+        if self.options.get("detect_moves"):
+            self._detect_moves()
+
+        if self.order and not self.dry_run:
+            self._plan = []
+        self._open_journal()
+        if self.options.get("meta_write_behind") and not self.dry_run:
+            self.meta_writer = MetaWriter(self._open_lane_target)
+        self._apply_tuning()
+        completed = False
+        try:
+            if self.options.get("bulk_list"):
+                self.remote.prefetch_tree()
+            res = self._sync_dir()
+            self._run_plan()
+            self._commit_uploads(("dir", "plan"))
+            self.remote.flush_batch()
+            completed = True
+        finally:
+            self._plan = None
+            self.remote.clear_tree()
+            if self.meta_writer:
+                self.meta_writer.close()
+                if self.meta_writer.errors:
+                    completed = False
+                self.meta_writer = None
+            self._close_journal(completed)
+        self._set_elap_stats(start)
+        if self.dry_run:
+            self._dry_run_secs = self._stats["elap_secs"]
+        elif completed:
+            self._record_perf()
+        return res
+
+    def _set_elap_stats(self, start):
+        """Add elapsed time and transfer rates to the stats."""
         stats = self._stats
         stats["elap_secs"] = time.time() - start
         stats["elap_str"] = "%0.2f sec" % stats["elap_secs"]
@@ -133,8 +241,86 @@ class BaseSynchronizer(object):
                 stats[rate] = "%0.2f kb/sec" % (.001 * stats[size] / stats[time])
         _add("upload_rate_str", "upload_bytes_written", "upload_write_time")
         _add("download_rate_str", "download_bytes_written", "download_write_time")
-        return res
+        if stats.get("mode_z_bytes_wire"):
+            stats["mode_z_ratio_str"] = "%0.1f:1" % (
+                float(stats["mode_z_bytes_raw"]) / stats["mode_z_bytes_wire"])
+        if self.scheduler and not self.options.get("scheduler"):
+            stats.update(self.scheduler.get_stats())
     
+    def _get_rel_dir(self, target, name=None):
+        """Return target.cur_dir (or cur_dir/name) relative to the root."""
+        path = target.cur_dir if name is None else join_url(target.cur_dir, name)
+        return relpath_url(path, target.root_dir)
+
+    def _open_journal(self):
+        """Open the journal and replay the records of an interrupted run."""
+        if not self.options.get("journal") or self.dry_run:
+            return
+        self.journal = SyncJournal(get_journal_path(self.local, self.remote))
+        records = self.journal.open()
+        if records:
+            if self.verbose >= 3:
+                print("Resuming interrupted run (%s journal records)" % len(records))
+            self._replay_journal(records)
+
+    def _close_journal(self, completed):
+        if self.journal:
+            self.journal.close(completed)
+            self._stats.update(self.journal.stats)
+            self.journal = None
+
+    def _journal_dir_done(self, rel_dir):
+        """Record that rel_dir is complete, once its meta data was written."""
+        if self.meta_writer:
+            self.meta_writer.call(lambda: self.journal.record("done", rel_dir))
+        else:
+            self.journal.record("done", rel_dir)
+
+    def _is_journal_done(self, rel_dir):
+        """Return True if rel_dir was completely synchronized by an interrupted run."""
+        for done in self._journal_done:
+            if rel_dir == done or done == "." or rel_dir.startswith(done + "/"):
+                return True
+        return False
+
+    def _replay_journal(self, records):
+        """Store mtimes and sync info of copies whose meta data was not flushed.
+
+        Directories that were completed are skipped by _sync_dir() later.
+        """
+        copies = {}
+        for rec in records:
+            if rec["a"] == "done":
+                self._journal_done.add(rec["d"])
+            elif rec["a"] == "copy":
+                copies.setdefault(rec["d"], []).append(rec)
+        for rel_dir in sorted(copies):
+            if self._is_journal_done(rel_dir):
+                # Meta data was flushed before the directory was completed
+                continue
+            try:
+                self.local.cwd(join_url(self.local.root_dir, rel_dir))
+                self.remote.cwd(join_url(self.remote.root_dir, rel_dir))
+                local_entries = dict((e.name, e) for e in self.local.get_dir())
+                remote_entries = dict((e.name, e) for e in self.remote.get_dir())
+                for rec in copies[rel_dir]:
+                    if rec["up"]:
+                        dest, entry = self.remote, remote_entries.get(rec["n"])
+                    else:
+                        dest, entry = self.local, local_entries.get(rec["n"])
+                    if entry is None or entry.size != rec["s"]:
+                        continue # modified since
+                    dest.set_mtime(rec["n"], rec["m"], rec["s"])
+                    dest.set_sync_info(rec["n"], rec["m"], rec["s"])
+                    self._inc_stat("journal_replayed")
+                self.local.flush_meta()
+                self.remote.flush_meta()
+            except Exception as e:
+                print("Could not replay journal for %r: %s" % (rel_dir, e), file=sys.stderr)
+            finally:
+                self.local.cwd(self.local.root_dir)
+                self.remote.cwd(self.remote.root_dir)
+
     def _copy_file(self, src, dest, file_entry):
         # TODO: save replace:
         # 1. remove temp file
@@ -152,10 +338,24 @@ class BaseSynchronizer(object):
             self._inc_stat("download_files_written")
         self._tick()
         if self.dry_run:
-            return self._dry_run_action("copy file (%s, %s --> %s)" % (file_entry, src, dest))
+            return self._dry_run_action("copy file (%s, %s --> %s)" % (file_entry, src, dest),
+                                        "upload" if is_upload else "download", dest,
+                                        files=1, size=file_entry.size)
         elif dest.readonly:
             raise RuntimeError("target is read-only: %s" % dest)
 
+        if self._plan is not None:
+            # Postponed until the whole tree was traversed (see _run_plan())
+            self._plan.append(_PlannedCopy(self, src, dest, file_entry, is_upload))
+            return
+        self._transfer_file(src, dest, file_entry, is_upload)
+
+    def _transfer_file(self, src, dest, file_entry, is_upload, sync_meta=None):
+        """Copy src/name to dest/name and store mtime and sync info.
+
+        `sync_meta` is the local DirMetadata that receives the sync info
+        (default: the current directory of dest's local peer).
+        """
         start = time.time()
         def __block_written(data):
 #            print(">(%s), " % len(data))
@@ -165,13 +365,39 @@ class BaseSynchronizer(object):
             else:
                 self._inc_stat("download_bytes_written", len(data))
 
-        with src.open_readable(file_entry.name) as fp_src:
-            dest.write_file(file_entry.name, fp_src, callback=__block_written)
+        blocksize = self._get_tuned_option("blocksize", DEFAULT_BLOCKSIZE)
+        algo = self._get_verify_algo()
+        hashing = None
+        if self.scheduler:
+            host = getattr(dest, "host", None) or getattr(src, "host", None)
+            with self.scheduler.transfer(host, file_entry.size, self._job_bucket) as throttled:
+                with src.open_readable(file_entry.name) as fp_src:
+                    if algo:
+                        fp_src = hashing = _HashingReader(fp_src, algo)
+                    dest.write_file(file_entry.name, throttled(fp_src), blocksize,
+                                    callback=__block_written)
+        else:
+            with src.open_readable(file_entry.name) as fp_src:
+                if algo:
+                    fp_src = hashing = _HashingReader(fp_src, algo)
+                dest.write_file(file_entry.name, fp_src, blocksize, callback=__block_written)
+        if hashing:
+            self._verify_copy(src, dest, file_entry, algo, hashing.hash.hexdigest())
 
 #         dest.set_mtime(file_entry.name, file_entry.get_adjusted_mtime(), file_entry.size)
 #         dest.set_sync_info(file_entry.name, file_entry.get_adjusted_mtime(), file_entry.size)
         dest.set_mtime(file_entry.name, file_entry.mtime, file_entry.size)
-        dest.set_sync_info(file_entry.name, file_entry.mtime, file_entry.size)
+        if sync_meta is None:
+            dest.set_sync_info(file_entry.name, file_entry.mtime, file_entry.size)
+        else:
+            sync_meta.set_sync_info(file_entry.name, file_entry.mtime, file_entry.size)
+        if hashing:
+            # Also cache the digest, so '--compare hash' does not read the file again
+            for target in (src, dest):
+                target.cache_hash(file_entry.name, algo, hashing.hash.hexdigest(), sync_meta)
+        if self.journal:
+            self.journal.record("copy", self._get_rel_dir(dest), n=file_entry.name,
+                                m=file_entry.mtime, s=file_entry.size, up=is_upload)
 
         elap = time.time() - start
         self._inc_stat("write_time", elap)
@@ -181,6 +407,177 @@ class BaseSynchronizer(object):
             self._inc_stat("download_write_time", elap)
         return
     
+    def _get_verify_algo(self):
+        """Return the hash algorithm for the 'verify' option or None.
+
+        'auto' selects the fastest algorithm that the remote target can
+        calculate, so copies can be checked.
+        """
+        if self.verify == "auto":
+            self.verify = self._get_hash_algo() or HASH_ALGOS[0]
+        return self.verify
+
+    def _verify_copy(self, src, dest, file_entry, algo, digest):
+        """Compare the digest of the transferred data with the server's hash.
+
+        Uploads are checked against the destination, downloads against the
+        source. The damaged copy is removed if the hashes differ.
+        """
+        expected = None
+        for target in (dest, src):
+            # Local files would have to be read a second time
+            if not isinstance(target, FsTarget) and algo in target.get_hash_algos():
+                entry = FileEntry(target, target.cur_dir, file_entry.name,
+                                  file_entry.size, file_entry.mtime, None)
+                expected = target.get_hash(entry, algo)
+                break
+        if expected is None:
+            self._inc_stat("verify_unchecked")
+            return
+        elif expected == digest:
+            self._inc_stat("verify_files")
+            return
+        self._inc_stat("verify_mismatches")
+        if self.options.get("atomic") not in ("dir", "plan"):
+            dest.remove_file(file_entry.name)
+            dest.flush_batch()
+        raise RuntimeError("%s hash of %s does not match: %s (transferred) != %s (%s)" 
+                           % (algo, file_entry.name, digest, expected, target.get_base_name()))
+
+    def _commit_uploads(self, modes):
+        """Rename pending atomic uploads if the 'atomic' option is one of `modes`."""
+        if self.options.get("atomic") in modes and not self.dry_run:
+            self.local.commit_uploads()
+            self.remote.commit_uploads()
+
+    def _get_plan_key(self):
+        """Return a sort key function for _PlannedCopy items (see 'order' option)."""
+        if self.order == "smallest":
+            return lambda item: item.file_entry.size
+        elif self.order == "largest":
+            return lambda item: -item.file_entry.size
+        elif self.order == "extension":
+            prio = self.options.get("ext_priority") or DEFAULT_EXT_PRIORITY
+            prio = [ext.strip().lstrip(".").lower() for ext in prio.split(",")]
+            def _key(item):
+                ext = os.path.splitext(item.file_entry.name)[1].lstrip(".").lower()
+                return (prio.index(ext) if ext in prio else len(prio), item.file_entry.size)
+            return _key
+        return lambda item: (item.src_dir, item.file_entry.name)
+
+    def _open_lane_target(self, target):
+        """Return a connected copy of target for a transfer lane (or None)."""
+        clone = target.clone()
+        if clone is None:
+            return None
+        clone.synchronizer = self
+        clone.peer = target.peer
+        clone.readonly = target.readonly
+        clone.dry_run = target.dry_run
+        clone.open()
+        return clone
+
+    def _run_planned_copy(self, item, local, remote):
+        if item.is_upload:
+            src, dest = local, remote
+        else:
+            src, dest = remote, local
+        if src.cur_dir != item.src_dir:
+            src.cwd(item.src_dir)
+        if dest.cur_dir != item.dest_dir:
+            dest.cwd(item.dest_dir)
+        dest.cur_dir_meta = item.dest_meta
+        self._transfer_file(src, dest, item.file_entry, item.is_upload, item.sync_meta)
+
+    def _run_plan(self):
+        """Copy the files that were postponed by _copy_file(), sorted by 'order'.
+
+        Files of 'large_file_size' bytes or more are copied by 'large_lanes'
+        extra threads with their own connections, so they don't block the
+        small ones. Targets that cannot be cloned copy large files last.
+        """
+        plan = self._plan
+        self._plan = None
+        if not plan:
+            return
+        plan.sort(key=self._get_plan_key())
+        large_size = self._get_tuned_option("large_file_size", DEFAULT_LARGE_FILE_SIZE)
+        max_lanes = self._get_tuned_option("large_lanes", DEFAULT_LARGE_LANES)
+        small = [item for item in plan if not max_lanes or item.file_entry.size < large_size]
+        large = [item for item in plan if max_lanes and item.file_entry.size >= large_size]
+
+        lanes = []
+        for _ in range(min(max_lanes, len(large))):
+            local = self._open_lane_target(self.local)
+            remote = local and self._open_lane_target(self.remote)
+            if remote is None:
+                if local:
+                    local.close()
+                break
+            lanes.append((local, remote))
+        if self.verbose >= 4:
+            print("Copying %s files (%s large files in %s lanes), order: %s"
+                  % (len(plan), len(large), len(lanes), self.order))
+
+        large_queue = queue.Queue()
+        for item in large:
+            large_queue.put(item)
+        errors = []
+
+        def _lane(local, remote):
+            try:
+                while True:
+                    try:
+                        item = large_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._run_planned_copy(item, local, remote)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                remote.close()
+                local.close()
+
+        threads = [threading.Thread(target=_lane, args=lane) for lane in lanes]
+        start = time.time()
+        for t in threads:
+            t.start()
+
+        local_dir, local_meta = self.local.cur_dir, self.local.cur_dir_meta
+        remote_dir, remote_meta = self.remote.cur_dir, self.remote.cur_dir_meta
+        try:
+            for item in small:
+                self._run_planned_copy(item, self.local, self.remote)
+            if not lanes:
+                for item in large:
+                    self._run_planned_copy(item, self.local, self.remote)
+        finally:
+            for t in threads:
+                t.join()
+            if not errors:
+                # Total throughput of all connections (see history.measure_run())
+                self._inc_stat("plan_bytes", sum(item.file_entry.size for item in plan))
+                self._inc_stat("plan_secs", time.time() - start)
+                self._stats["plan_connections"] = 1 + len(lanes)
+            # The meta data of these directories was flushed by _sync_dir()
+            # already, so write the sync info and mtimes that we added since
+            flushed = set()
+            for item in plan:
+                for meta in (item.dest_meta, item.sync_meta):
+                    if (meta is None or id(meta) in flushed 
+                            or not (meta.modified_list or meta.modified_sync)):
+                        continue
+                    flushed.add(id(meta))
+                    meta.target.cwd(meta.path)
+                    meta.target.cur_dir_meta = meta
+                    meta.target.flush_meta()
+            self.local.cwd(local_dir)
+            self.local.cur_dir_meta = local_meta
+            self.remote.cwd(remote_dir)
+            self.remote.cur_dir_meta = remote_meta
+        if errors:
+            raise errors[0]
+
     def _copy_recursive(self, src, dest, dir_entry):
 #        print("_copy_recursive(%s, %s --> %s)" % (dir_entry, src, dest))
         assert isinstance(dir_entry, DirectoryEntry)
@@ -188,7 +585,10 @@ class BaseSynchronizer(object):
         self._inc_stat("dirs_created")
         self._tick()
         if self.dry_run:
-            return self._dry_run_action("copy directory (%s, %s --> %s)" % (dir_entry, src, dest))
+            files, size, dirs = self._get_tree_size(src, dir_entry)
+            return self._dry_run_action("copy directory (%s, %s --> %s)" % (dir_entry, src, dest),
+                                        "upload" if dest is self.remote else "download", dest,
+                                        files=files, size=size, dirs=dirs)
         elif dest.readonly:
             raise RuntimeError("target is read-only: %s" % dest)
         
@@ -211,6 +611,9 @@ class BaseSynchronizer(object):
 
         src.flush_meta()
         dest.flush_meta()
+        self._commit_uploads(("dir", ))
+        if self.journal and self._plan is None:
+            self._journal_dir_done(self._get_rel_dir(dest))
     
         src.cwd("..")
         dest.cwd("..")
@@ -226,7 +629,8 @@ class BaseSynchronizer(object):
         self._inc_stat("entries_touched")
         self._inc_stat("files_deleted")
         if self.dry_run:
-            return self._dry_run_action("delete file (%s)" % (file_entry,))
+            return self._dry_run_action("delete file (%s)" % (file_entry,), "delete",
+                                        file_entry.target, files=1)
         elif file_entry.target.readonly:
             raise RuntimeError("target is read-only: %s" % file_entry.target)
         file_entry.target.remove_file(file_entry.name)
@@ -238,7 +642,9 @@ class BaseSynchronizer(object):
         self._inc_stat("entries_touched")
         self._inc_stat("dirs_deleted")
         if self.dry_run:
-            return self._dry_run_action("delete directory (%s)" % (dir_entry,))
+            files, _size, dirs = self._get_tree_size(dir_entry.target, dir_entry)
+            return self._dry_run_action("delete directory (%s)" % (dir_entry,), "delete",
+                                        dir_entry.target, files=files, dirs=dirs)
         elif dir_entry.target.readonly:
             raise RuntimeError("target is read-only: %s" % dir_entry.target)
         dir_entry.target.rmdir(dir_entry.name)
@@ -258,7 +664,7 @@ class BaseSynchronizer(object):
 #                  ("copy", "new"): ansi_code("Fore.GREEN"),
 #                  }
     
-    def _log_action(self, action, status, symbol, entry, min_level=3):
+    def _log_action(self, action, status, symbol, entry, min_level=3, rel_path=None):
         if self.verbose < min_level:
             return
         
@@ -280,6 +686,8 @@ class BaseSynchronizer(object):
                     color = ansi_code("Fore.CYAN") + ansi_code("Style.BRIGHT") if status == "new" else ansi_code("Fore.CYAN")
             elif action == "delete":
                 color = ansi_code("Fore.RED")
+            elif action == "move":
+                color = ansi_code("Fore.MAGENTA")
             elif status == "conflict":
                 color = ansi_code("Fore.LIGHTRED_EX")
             elif action == "skip" or status == "equal":
@@ -295,7 +703,7 @@ class BaseSynchronizer(object):
             tag = ("%s %s" % (action, status)).upper()
         else:
             tag = ("%s%s" % (action, status)).upper()
-        name = entry.get_rel_path()
+        name = rel_path or entry.get_rel_path()
         if entry.is_dir():
             name = "[%s]" % name
 
@@ -314,10 +722,103 @@ class BaseSynchronizer(object):
         sys.stdout.flush()
         return
     
-    def _dry_run_action(self, action):
-        """"Called in dry-run mode after call to _log_action() and before exiting function."""
+    def _dry_run_action(self, action, kind=None, target=None, files=0, size=0, dirs=0):
+        """"Called in dry-run mode after call to _log_action() and before exiting function.
+
+        `kind` ('upload', 'download', 'delete', 'move') adds the action to the
+        dry-run report.
+        """
 #        print("dry-run", action)
+        if kind is None:
+            return
+        with self._stats_lock:
+            item = self._dry_run_actions.setdefault(kind, {"files": 0, "bytes": 0, "dirs": 0})
+            item["files"] += files
+            item["bytes"] += size
+            item["dirs"] += dirs
+            if target is not None:
+                self._dry_run_dirs.add(self._get_rel_dir(target))
         return
+
+    def _get_tree_size(self, target, dir_entry):
+        """Return (files, bytes, dirs) of target/dir_entry, including the folder itself."""
+        files = size = dirs = 0
+        target.push_meta()
+        target.cwd(dir_entry.name)
+        try:
+            for entry in target.get_dir():
+                if entry.is_dir():
+                    sub_files, sub_size, sub_dirs = self._get_tree_size(target, entry)
+                    files += sub_files
+                    size += sub_size
+                    dirs += sub_dirs
+                else:
+                    files += 1
+                    size += entry.size
+        finally:
+            target.cwd("..")
+            target.pop_meta()
+        return files, size, dirs + 1
+
+    def get_dry_run_report(self):
+        """Return what a real run would do (after a dry run).
+
+        {'actions': {'upload': {'files': n, 'bytes': n, 'dirs': n}, 'delete': ...},
+         'dirs_touched': n, 'eta_secs': seconds or None}
+        The estimate uses the performance history of the remote host, and
+        is None if no real run was recorded yet (or the history is off).
+        """
+        eta = None
+        host_key = self._get_perf_host_key()
+        if host_key and self._dry_run_secs is not None:
+            perf = PerfHistory().get_estimates(host_key)
+            eta = estimate_secs(self._dry_run_actions, perf, self._dry_run_secs)
+        elif self._dry_run_secs is not None and not self.remote.get_host_key():
+            eta = self._dry_run_secs # local targets: comparing takes the most time
+        return {"actions": self._dry_run_actions,
+                "dirs_touched": len(self._dry_run_dirs),
+                "eta_secs": eta,
+                }
+
+    def _get_perf_host_key(self):
+        """Return the remote host key, if its performance history is used.
+
+        Like the server capabilities, the history is not used if the remote
+        target's 'host_info_cache' option is off.
+        """
+        if not self.options.get("perf_history", True):
+            return None
+        if not self.remote.get_option("host_info_cache", True):
+            return None
+        return self.remote.get_host_key()
+
+    def _record_perf(self):
+        """Add the throughput and latency of this run to the host's performance history."""
+        host_key = self._get_perf_host_key()
+        if not host_key or self.dry_run:
+            return
+        PerfHistory().add_record(host_key, measure_run(self._stats, self.remote.rtt))
+
+    def _apply_tuning(self):
+        """Derive unset 'large_lanes', 'large_file_size', and 'blocksize' options
+        from the performance history of the remote host."""
+        host_key = self._get_perf_host_key()
+        if not host_key:
+            return
+        tuning = PerfHistory().get_tuning(host_key)
+        if "connections" in tuning:
+            tuning["large_lanes"] = tuning.pop("connections") - 1
+        self.tuning = dict((k, v) for k, v in tuning.items() if self.options.get(k) is None)
+        if self.tuning and self.verbose >= 4:
+            print("Tuned from performance history: %s" 
+                  % ", ".join("%s=%s" % kv for kv in sorted(self.tuning.items())))
+
+    def _get_tuned_option(self, name, default):
+        """Return option `name`, the tuned value (if the option is not set), or `default`."""
+        value = self.options.get(name)
+        if value is None:
+            value = self.tuning.get(name, default)
+        return value
     
     def _test_match_or_print(self, entry):
         """Return True if entry matches filter. Otherwise print 'skip' and return False ."""
@@ -357,7 +858,272 @@ class BaseSynchronizer(object):
 
         return is_conflict 
 
-    def _sync_dir(self):
+    def _select_strategies(self):
+        """Choose the fastest way to perform each operation, based on the
+        capabilities of both targets."""
+        local_caps = self.local.get_capabilities()
+        remote_caps = self.remote.get_capabilities()
+        res = self.strategies
+        res["compare"] = "mtime"
+        if self.compare == "hash":
+            algo = self._get_hash_algo()
+            res["compare"] = "hash (%s)" % algo if algo else "mtime (no common hash)"
+        for name, caps in (("local", local_caps), ("remote", remote_caps)):
+            set_time = caps.get("set_time")
+            if set_time is True:
+                res[name + "_set_mtime"] = "native"
+            elif set_time:
+                res[name + "_set_mtime"] = set_time
+            else:
+                res[name + "_set_mtime"] = "meta data"
+            res[name + "_resume"] = bool(caps.get("rest_stream"))
+            res[name + "_mode_z"] = bool(caps.get("mode_z"))
+        if self.verbose >= 4:
+            for k, v in sorted(res.items()):
+                print("Strategy %s: %s" % (k, v))
+        return res
+
+    def _get_hash_algo(self):
+        """Return the fastest hash algorithm that is available on both targets."""
+        if self.hash_algo is None:
+            remote_algos = self.remote.get_hash_algos()
+            for algo in self.local.get_hash_algos():
+                if algo in remote_algos:
+                    self.hash_algo = algo
+                    break
+            else:
+                self.hash_algo = False
+        return self.hash_algo
+
+    def _prefetch_hashes(self, diff):
+        """Calculate hashes for all file pairs that can only be compared by content.
+
+        Only files with identical size and different mtime are considered.
+        `diff` is a list of (status, local_entry, remote_entry) (see diff_listings()).
+        """
+        if self.hash_algo is None and not self._get_hash_algo():
+            print("No common hash algorithm found: using mtime comparison", 
+                  file=sys.stderr)
+        algo = self._get_hash_algo()
+        if not algo:
+            return
+        local_list = []
+        remote_list = []
+        for status, local_file, remote_file in diff:
+            if (status in (diff_mod.NEWER, diff_mod.OLDER) and local_file.is_file()
+                    and local_file.size == remote_file.size):
+                local_list.append(local_file)
+                remote_list.append(remote_file)
+        if not local_list:
+            return
+        local_hashes = self.local.get_hashes(local_list, algo)
+        remote_hashes = self.remote.get_hashes(remote_list, algo)
+        for local_file, remote_file in zip(local_list, remote_list):
+            local_file.hash = local_hashes.get(local_file.name)
+            remote_file.hash = remote_hashes.get(remote_file.name)
+
+    def _is_same_content(self, local_file, remote_file):
+        """Return True if both files are known to have identical hashes."""
+        if self.compare != "hash" or not remote_file or not remote_file.is_file():
+            return False
+        if local_file.hash is None or local_file.size != remote_file.size:
+            return False
+        return local_file.hash == remote_file.hash
+
+    def _get_move_targets(self):
+        """Return (src, dest) if moved resources may be renamed on dest, else None.
+
+        Renaming is only an option if the synchronizer would delete the old
+        resource on dest anyway.
+        """
+        return None
+
+    def _scan_tree(self, target):
+        """Return ({rel_path: FileEntry}, {rel_path: DirectoryEntry}) for the whole target."""
+        files = {}
+        dirs = {}
+        def _scan(rel_dir):
+            for entry in target.get_dir():
+                if not self._match(entry):
+                    continue
+                rel_path = normpath_url(join_url(rel_dir, entry.name))
+                if entry.is_dir():
+                    dirs[rel_path] = entry
+                    target.cwd(entry.name)
+                    _scan(rel_path)
+                    target.cwd("..")
+                else:
+                    files[rel_path] = entry
+
+        target.push_meta()
+        try:
+            _scan("")
+        finally:
+            target.pop_meta()
+        return files, dirs
+
+    def _detect_moves(self):
+        """Rename resources on the destination target if they were moved on the source.
+
+        This pre-pass scans both trees and matches resources that are new on
+        the source against resources that are missing on the source:
+          - Directories match if they contain the same relative file names with
+            identical sizes and modification dates.
+          - Files match if the size and modification date are equal and there
+            is exactly one candidate. The match is verified by comparing hashes
+            (if available) or the file name.
+        The following _sync_dir() pass will then find these resources unchanged.
+        """
+        move_targets = self._get_move_targets()
+        if not move_targets:
+            print("Move detection is only supported by upload and download with "
+                  "'--delete' option", file=sys.stderr)
+            return
+        src, dest = move_targets
+        src_files, src_dirs = self._scan_tree(src)
+        dest_files, dest_dirs = self._scan_tree(dest)
+        symbol = ">" if dest is self.remote else "<"
+
+        def _top_level(paths, other):
+            missing = set(p for p in paths if p not in other)
+            return [ p for p in missing if dirname_url(p) not in missing ]
+
+        def _signature(rel_dir, files, dirs):
+            prefix = rel_dir + "/"
+            l = len(prefix)
+            sig = [ (p[l:], e.size, int(e.mtime)) for p, e in files.items() if p.startswith(prefix) ]
+            if not sig:
+                return None
+            sig.extend(p[l:] for p in dirs if p.startswith(prefix))
+            return frozenset(sig)
+
+        def _is_below(path, dir_list):
+            for d in dir_list:
+                if path.startswith(d + "/"):
+                    return True
+            return False
+
+        moved_src_dirs = []
+        moved_dest_dirs = []
+        moved_files = []
+
+        # 1. Match directories that exist only on one side
+        gone_dir_map = {}
+        for path in _top_level(dest_dirs, src_dirs):
+            sig = _signature(path, dest_files, dest_dirs)
+            if sig:
+                gone_dir_map.setdefault(sig, []).append(path)
+
+        for path in sorted(_top_level(src_dirs, dest_dirs)):
+            sig = _signature(path, src_files, src_dirs)
+            candidates = gone_dir_map.get(sig)
+            if not sig or not candidates or len(candidates) != 1:
+                continue
+            parent = dirname_url(path)
+            if parent and parent not in dest_dirs:
+                continue
+            old_path = candidates.pop()
+            entry = src_dirs[path]
+            size = sum(e.size for p, e in src_files.items() if p.startswith(path + "/"))
+            self._move_entry(dest, old_path, path, entry, size, symbol)
+            moved_src_dirs.append(path)
+            moved_dest_dirs.append(old_path)
+
+        # 2. Match files that exist only on one side
+        gone_file_map = {}
+        for path, entry in dest_files.items():
+            if path not in src_files and not _is_below(path, moved_dest_dirs):
+                gone_file_map.setdefault(entry.size, []).append(path)
+
+        algo = self._get_hash_algo()
+        for path in sorted(src_files):
+            if path in dest_files or _is_below(path, moved_src_dirs):
+                continue
+            entry = src_files[path]
+            candidates = [ p for p in gone_file_map.get(entry.size, ())
+                          if FileEntry._eps_compare(entry.mtime, dest_files[p].mtime, 
+                                                    entry._get_eps(dest_files[p])) == 0 ]
+            if len(candidates) != 1:
+                continue
+            old_path = candidates[0]
+            if algo:
+                if src.get_hash(entry, algo) != dest.get_hash(dest_files[old_path], algo):
+                    continue
+            elif basename_url(path) != basename_url(old_path):
+                continue
+            gone_file_map[entry.size].remove(old_path)
+            # Make sure that the parent directory exists
+            parent = dirname_url(path)
+            missing_dirs = []
+            while parent and parent not in dest_dirs:
+                missing_dirs.insert(0, parent)
+                parent = dirname_url(parent)
+            for dir_path in missing_dirs:
+                if not self.dry_run:
+                    dest.mkdir(dir_path)
+                dest_dirs[dir_path] = src_dirs[dir_path]
+            self._move_entry(dest, old_path, path, entry, entry.size, symbol)
+            moved_files.append((path, entry))
+
+        # 3. Store original modification dates for the renamed files
+        if moved_files and not self.dry_run:
+            by_dir = {}
+            for path, entry in moved_files:
+                by_dir.setdefault(dirname_url(path), []).append(entry)
+            dest.push_meta()
+            for rel_dir, entries in by_dir.items():
+                if rel_dir:
+                    dest.cwd(rel_dir)
+                dest.get_dir()
+                for entry in entries:
+                    dest.set_mtime(entry.name, entry.mtime, entry.size)
+                dest.flush_meta()
+                if rel_dir:
+                    dest.cwd(dest.root_dir)
+            dest.pop_meta()
+        return
+
+    def _move_entry(self, target, old_path, new_path, entry, size, symbol):
+        """Rename target/old_path to target/new_path (both relative to root)."""
+        self._inc_stat("entries_touched")
+        self._inc_stat("dirs_moved" if entry.is_dir() else "files_moved")
+        self._inc_stat("move_bytes_saved", size)
+        self._log_action("move", "renamed", symbol, entry, 
+                         rel_path="%s -> %s" % (old_path, new_path))
+        if self.dry_run:
+            return self._dry_run_action("move (%s --> %s)" % (old_path, new_path), "move", 
+                                        target, dirs=int(entry.is_dir()),
+                                        files=int(not entry.is_dir()))
+        target.rename(old_path, new_path)
+
+    def sync_dirs(self, rel_dirs):
+        """Synchronize some directories (relative to root), without recursion.
+
+        This is used for incremental updates (e.g. by the `watch` command).
+        Subdirectories are only visited if they are missing on the peer.
+        Return a list of directories that could not be synchronized.
+        """
+        start = time.time()
+        failed = []
+        for rel_dir in sorted(rel_dirs):
+            try:
+                if rel_dir:
+                    self.local.cwd(rel_dir)
+                    self.remote.cwd(rel_dir)
+                self._sync_dir(recursive=False)
+                self.remote.flush_batch() # don't keep DELE/MKD queued until the next event
+            except Exception as e:
+                print("Could not synchronize %r: %s" % (rel_dir, e), file=sys.stderr)
+                failed.append(rel_dir)
+            finally:
+                self.local.cwd(self.local.root_dir)
+                self.remote.cwd(self.remote.root_dir)
+        self._commit_uploads(("dir", "plan"))
+        self._stats["elap_secs"] = time.time() - start
+        self._stats["elap_str"] = "%0.2f sec" % self._stats["elap_secs"]
+        return failed
+
+    def _sync_dir(self, recursive=True):
         """Traverse the local folder structure and remote peers.
         
         This is the core algorithm that generates calls to self.sync_XXX() 
@@ -365,19 +1131,22 @@ class BaseSynchronizer(object):
         _sync_dir() is called by self.run().
         """
         local_entries = self.local.get_dir()
-        local_entry_map = dict(map(lambda e: (e.name, e), local_entries))
-        local_files = [e for e in local_entries if isinstance(e, FileEntry)]
-        local_directories = [e for e in local_entries if isinstance(e, DirectoryEntry)]
-        
         remote_entries = self.remote.get_dir()
-        # convert into a dict {name: FileEntry, ...}
-        remote_entry_map = dict(map(lambda e: (e.name, e), remote_entries))
-        
+        # Classify all entries in one pass: [(status, local_entry, remote_entry), ...]
+        eps = max(FileEntry.EPS_TIME, self.local.mtime_precision, self.remote.mtime_precision)
+        diff = diff_mod.diff_listings(local_entries, remote_entries, eps)
+        report_equal = self._needs_equal_files()
+
         conflict_list = []
+
+        if self.compare == "hash":
+            self._prefetch_hashes(diff)
         
         # 1. Loop over all local files and classify the relationship to the
         #    peer entries.
-        for local_file in local_files:
+        for status, local_file, remote_file in diff:
+            if local_file is None or local_file.is_dir():
+                continue
             self._inc_stat("local_files")
             if not self._before_sync(local_file):
                 # TODO: currently, if a file is skipped, it will not be
@@ -386,24 +1155,34 @@ class BaseSynchronizer(object):
             # TODO: case insensitive?
             # We should use os.path.normcase() to convert to lowercase on windows
             # (i.e. if the FTP server is based on Windows)
-            remote_file = remote_entry_map.get(local_file.name)
-
-            if self._is_conflict(local_file, remote_file):
+            if remote_file is not None and remote_file.is_dir():
+                self._log_call("_sync_error(%s, %s)" % (local_file, remote_file))
+                self._sync_error("file and directory with the same name", 
+                                 local_file, remote_file)
+            elif self._is_conflict(local_file, remote_file):
+                # Checked first: both sides may have been modified to the
+                # same size and mtime
                 conflict_list.append( (local_file, remote_file) )
-            elif remote_file is None:
+            elif status == diff_mod.EQUAL:
+                self._inc_stat("equal_files")
+                if report_equal:
+                    self._log_call("sync_equal_file(%s, %s)" % (local_file, remote_file))
+                    self.sync_equal_file(local_file, remote_file)
+            elif self._is_same_content(local_file, remote_file):
+                self._log_call("sync_equal_file(%s, %s) # same hash" % (local_file, remote_file))
+                self._inc_stat("hash_equal_files")
+                self.sync_equal_file(local_file, remote_file)
+            elif status == diff_mod.LOCAL_ONLY:
                 self._log_call("sync_missing_remote_file(%s)" % local_file)
                 self.sync_missing_remote_file(local_file)
-            elif local_file == remote_file:
-                self._log_call("sync_equal_file(%s, %s)" % (local_file, remote_file))
-                self.sync_equal_file(local_file, remote_file)
             # TODO: renaming could be triggered, if we find an existing
             # entry.unique with a different entry.name
 #            elif local_file.key in remote_keys:
 #                self._rename_file(local_file, remote_file)
-            elif local_file > remote_file:
+            elif status == diff_mod.NEWER:
                 self._log_call("sync_newer_local_file(%s, %s)" % (local_file, remote_file))
                 self.sync_newer_local_file(local_file, remote_file)
-            elif local_file < remote_file:
+            elif status == diff_mod.OLDER:
                 self._log_call("sync_older_local_file(%s, %s)" % (local_file, remote_file))
                 self.sync_older_local_file(local_file, remote_file)
             else:
@@ -412,17 +1191,24 @@ class BaseSynchronizer(object):
                                  local_file, remote_file)
 
         # 2. Handle all local directories that do NOT exist on remote target.
-        for local_dir in local_directories:
+        for status, local_dir, remote_entry in diff:
+            if local_dir is None or not local_dir.is_dir():
+                continue
             self._inc_stat("local_dirs")
             if not self._before_sync(local_dir):
                 continue
-            remote_dir = remote_entry_map.get(local_dir.name)
-            if not remote_dir:
+            if status == diff_mod.LOCAL_ONLY:
                 self._log_call("sync_missing_remote_dir(%s)" % local_dir)
                 self.sync_missing_remote_dir(local_dir)
+            elif status == diff_mod.DIFFERENT:
+                self._log_call("_sync_error(%s, %s)" % (local_dir, remote_entry))
+                self._sync_error("file and directory with the same name", 
+                                 local_dir, remote_entry)
 
         # 3. Handle all remote entries that do NOT exist on the local target.
-        for remote_entry in remote_entries:
+        for status, _local_entry, remote_entry in diff:
+            if remote_entry is None:
+                continue
             if isinstance(remote_entry, DirectoryEntry):
                 self._inc_stat("remote_dirs")
             else:
@@ -430,7 +1216,7 @@ class BaseSynchronizer(object):
                 
             if not self._before_sync(remote_entry):
                 continue
-            if not remote_entry.name in local_entry_map:
+            if status == diff_mod.REMOTE_ONLY:
                 if self._is_conflict(None, remote_entry):
                     conflict_list.append( (None, remote_entry) )   
                 elif isinstance(remote_entry, DirectoryEntry):
@@ -449,27 +1235,46 @@ class BaseSynchronizer(object):
             
         # 5. Let the target provider write its meta data for the files in the 
         #    current directory.
+        #    (Queued DELEs remove their sync info when they are confirmed.)
+        self.remote.flush_batch()
         self.local.flush_meta()
         self.remote.flush_meta()
+        self._commit_uploads(("dir", ))
 
         # 6. Finally visit all local sub-directories recursively that also 
         #    exist on the remote target.
-        for local_dir in local_directories:
+        if not recursive:
+            return
+        for status, local_dir, remote_dir in diff:
+            if status != diff_mod.EQUAL or not local_dir.is_dir():
+                continue
             if not self._before_sync(local_dir):
                 continue
-            remote_dir = remote_entry_map.get(local_dir.name)
             if remote_dir:
                 self._log_call("sync_equal_dir(%s, %s)" % (local_dir, remote_dir))
                 res = self.sync_equal_dir(local_dir, remote_dir)
                 if res is not False:
+                    if self._is_journal_done(self._get_rel_dir(self.local, local_dir.name)):
+                        self._inc_stat("journal_dirs_skipped")
+                        continue
                     self.local.cwd(local_dir.name)
                     self.remote.cwd(local_dir.name)
                     self._sync_dir()
                     self.local.cwd("..")
                     self.remote.cwd("..")
 
+        # With a plan, files of this directory may still be copied later
+        if self.journal and self._plan is None:
+            self._journal_dir_done(self._get_rel_dir(self.local))
         return
         
+    def _needs_equal_files(self):
+        """Return True if sync_equal_file() must be called for all equal files.
+
+        By default, equal files are only counted (or logged in verbose mode).
+        """
+        return self.verbose >= 4
+
     def _sync_error(self, msg, local_file, remote_file):
         print(msg, local_file, remote_file, file=sys.stderr)
     
@@ -691,6 +1496,11 @@ class UploadSynchronizer(BaseSynchronizer):
 
     def get_info_strings(self):
         return ("upload", "to")
+
+    def _get_move_targets(self):
+        if self.options.get("delete"):
+            return (self.local, self.remote)
+        return None
     
     def _check_del_unmatched(self, remote_entry):
         """Return True if entry is NOT matched (i.e. excluded by filter).
@@ -709,6 +1519,34 @@ class UploadSynchronizer(BaseSynchronizer):
             return True
         return False
 
+    def _needs_equal_files(self):
+        # Equal files may be unmatched by the filter
+        return (super(UploadSynchronizer, self)._needs_equal_files()
+                or bool(self.options.get("delete_unmatched")))
+
+    def _get_upload_action(self, status, local_file, remote_file):
+        """Return 'new', 'modified', 'older' (if forced), or None for a file
+        pair returned by diff_listings().
+
+        Uses the rules of _sync_dir() and the sync_*() methods below, for
+        drivers that compare listings without sync info (mirrors, asyncio).
+        """
+        if status == diff_mod.LOCAL_ONLY:
+            return "new"
+        elif remote_file.is_dir():
+            self._sync_error("file and directory with the same name", 
+                             local_file, remote_file)
+        elif status == diff_mod.NEWER:
+            return "modified"
+        elif status == diff_mod.OLDER:
+            if self.options.get("force"):
+                return "older"
+            self._log_action("skip", "older", "?", local_file, 4)
+        elif status != diff_mod.EQUAL:
+            self._sync_error("file with identical date but different otherwise", 
+                             local_file, remote_file)
+        return None
+
     def sync_equal_file(self, local_file, remote_file):
         self._log_action("", "equal", "=", local_file, min_level=4)
         self._check_del_unmatched(remote_file)
@@ -784,6 +1622,11 @@ class DownloadSynchronizer(BaseSynchronizer):
     def get_info_strings(self):
         return ("download", "from")
 
+    def _get_move_targets(self):
+        if self.options.get("delete"):
+            return (self.remote, self.local)
+        return None
+
     def _check_del_unmatched(self, local_entry):
         """Return True if entry is NOT matched (i.e. excluded by filter).
         
@@ -801,6 +1644,11 @@ class DownloadSynchronizer(BaseSynchronizer):
             return True
         return False
 
+    def _needs_equal_files(self):
+        # Equal files may be unmatched by the filter
+        return (super(DownloadSynchronizer, self)._needs_equal_files()
+                or bool(self.options.get("delete_unmatched")))
+
     def sync_equal_file(self, local_file, remote_file):
         self._log_action("", "equal", "=", local_file, min_level=4)
         self._check_del_unmatched(local_file)
@@ -860,3 +1708,327 @@ class DownloadSynchronizer(BaseSynchronizer):
             self._remove_dir(local_dir)
         else:
             self._log_action("skip", "missing", "?", local_dir, 4)
+
+
+#===============================================================================
+# _HashingReader
+#===============================================================================
+class _HashingReader(object):
+    """File-like wrapper that hashes every block read (see 'verify' option)."""
+    def __init__(self, fp, algo):
+        self._fp = fp
+        self.algo = algo
+        self.hash = new_hash(algo)
+
+    def read(self, size=-1):
+        data = self._fp.read(size)
+        self.hash.update(data)
+        return data
+
+    def seek(self, pos, whence=0):
+        """Start over (e.g. if an upload is retried) and hash up to `pos` again."""
+        if whence != 0:
+            raise IOError("only absolute positions are supported")
+        self._fp.seek(0)
+        self.hash = new_hash(self.algo)
+        while pos > 0:
+            data = self._fp.read(min(pos, 64 * 1024))
+            if not data:
+                break
+            self.hash.update(data)
+            pos -= len(data)
+
+    def __getattr__(self, name):
+        return getattr(self._fp, name)
+
+
+#===============================================================================
+# _TeeReader
+#===============================================================================
+class _TeeReader(object):
+    """Read a file once and hand out every block to several consumers.
+
+    Each consumer is a file-like object that is passed to a target's
+    write_file() in its own thread. At most `max_blocks` blocks are buffered
+    per consumer.
+    """
+    def __init__(self, fp, count, reopen, blocksize=DEFAULT_BLOCKSIZE, max_blocks=16):
+        self.fp = fp
+        self.blocksize = blocksize
+        self.consumers = [_TeeConsumer(reopen, max_blocks) for _ in range(count)]
+
+    def run(self):
+        """Feed all consumers until EOF and return the number of bytes read."""
+        size = 0
+        try:
+            while True:
+                active = [c for c in self.consumers if not c.detached]
+                if not active:
+                    break
+                data = self.fp.read(self.blocksize)
+                for consumer in active:
+                    consumer.put(data)
+                if not data:
+                    break
+                size += len(data)
+        except BaseException:
+            for consumer in self.consumers:
+                consumer.put(None) # make pending read() calls fail
+            raise
+        return size
+
+
+class _TeeConsumer(object):
+    """File-like object that returns the blocks read by a _TeeReader."""
+    def __init__(self, reopen, max_blocks):
+        self.reopen = reopen
+        self.queue = queue.Queue(max_blocks)
+        self.detached = False
+        self.eof = False
+        self.fp = None
+
+    def put(self, data):
+        while not self.detached:
+            try:
+                self.queue.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self, size=-1):
+        if self.fp is not None:
+            return self.fp.read(size)
+        elif self.eof or self.detached:
+            return b""
+        data = self.queue.get()
+        if data is None:
+            raise IOError("Reading the source file failed")
+        self.eof = not data
+        return data
+
+    def seek(self, pos):
+        """Continue with a private file handle (e.g. if an upload is retried)."""
+        self.detached = True
+        if self.fp is None:
+            self.fp = self.reopen()
+        self.fp.seek(pos)
+
+    def close(self):
+        self.detached = True
+        if self.fp is not None:
+            self.fp.close()
+
+
+#===============================================================================
+# _PlannedCopy
+#===============================================================================
+class _PlannedCopy(object):
+    """A file copy that was postponed by _copy_file() (see _run_plan()).
+
+    We keep the DirMetadata objects of the current directories, so mtimes and
+    sync info can be stored when the copy is finally done.
+    """
+    def __init__(self, synchronizer, src, dest, file_entry, is_upload):
+        self.file_entry = file_entry
+        self.is_upload = is_upload
+        self.src_dir = src.cur_dir
+        self.dest_dir = dest.cur_dir
+        self.dest_meta = dest.cur_dir_meta
+        self.sync_meta = synchronizer.local.cur_dir_meta
+
+
+#===============================================================================
+# MultiUploadSynchronizer
+#===============================================================================
+class MultiUploadSynchronizer(UploadSynchronizer):
+    """Upload a local folder to several remote targets (mirrors) in one run.
+
+    The local tree is scanned once. Every folder is listed on all mirrors in
+    parallel, and each file is read once and streamed to all mirrors that
+    need it at the same time.
+    Peer sync info is not stored, since there is more than one peer.
+    Options that need the per-target copy path (see UNSUPPORTED_OPTIONS) are
+    rejected.
+    """
+    #: Options that are not available with mirrors
+    UNSUPPORTED_OPTIONS = ("compare", "verify", "journal", "order", "detect_moves", 
+                           "delta", "max_rate", "max_transfers_per_host")
+
+    def __init__(self, local, remotes, options):
+        self.remotes = list(remotes)
+        if not self.remotes:
+            raise ValueError("At least one remote target is required")
+        check_unsupported_options(options, self.UNSUPPORTED_OPTIONS, "with mirrors")
+        super(MultiUploadSynchronizer, self).__init__(local, self.remotes[0], options)
+        for remote in self.remotes[1:]:
+            remote.synchronizer = self
+            remote.peer = local
+            if self.dry_run:
+                remote.readonly = True
+                remote.dry_run = True
+            if not remote.connected:
+                remote.open()
+        self._pool = None
+
+    def _map(self, func, remotes):
+        """Call func(remote) for all remotes in parallel and return the results."""
+        if len(remotes) == 1:
+            return [func(remotes[0])]
+        return self._pool.map(func, remotes)
+
+    def run(self):
+        start = time.time()
+        print("Upload %s" % self.local.get_base_name())
+        for remote in self.remotes:
+            print("%20s %s" % ("to", remote.get_base_name()))
+        self._pool = ThreadPool(len(self.remotes))
+        try:
+            self._sync_dir_multi(self.remotes)
+            # Publish pending atomic uploads and send queued commands
+            self._commit_mirrors(self.remotes, ("dir", "plan"))
+            self._map(lambda r: r.flush_batch(), self.remotes)
+        finally:
+            self._pool.close()
+            self._pool = None
+        self._set_elap_stats(start)
+
+    def _commit_mirrors(self, remotes, modes):
+        """Rename pending atomic uploads if the 'atomic' option is one of `modes`."""
+        if self.options.get("atomic") in modes and not self.dry_run:
+            self._map(lambda r: r.commit_uploads(), remotes)
+
+    def _remove_file(self, file_entry):
+        """Delete a file on one mirror (there is no peer sync info to update)."""
+        self._inc_stat("entries_touched")
+        self._inc_stat("files_deleted")
+        if self.dry_run:
+            return self._dry_run_action("delete file (%s)" % (file_entry,), "delete",
+                                        file_entry.target, files=1)
+        elif file_entry.target.readonly:
+            raise RuntimeError("target is read-only: %s" % file_entry.target)
+        file_entry.target.remove_file(file_entry.name)
+
+    def _sync_dir_multi(self, remotes):
+        local_entries = self.local.get_dir()
+        def _diff(remote):
+            eps = max(FileEntry.EPS_TIME, self.local.mtime_precision, remote.mtime_precision)
+            diff = diff_mod.diff_listings(local_entries, remote.get_dir(), eps)
+            return dict(((local or remote_entry).name, (status, remote_entry)) 
+                        for status, local, remote_entry in diff)
+        diff_maps = self._map(_diff, remotes)
+
+        # 1. Copy new and modified files
+        for local_file in sorted(local_entries, key=lambda e: e.name):
+            if not local_file.is_file():
+                continue
+            self._inc_stat("local_files")
+            if not self._before_sync(local_file) or not self._test_match_or_print(local_file):
+                continue
+            dests = []
+            for remote, diff_map in zip(remotes, diff_maps):
+                status, remote_file = diff_map[local_file.name]
+                action = self._get_upload_action(status, local_file, remote_file)
+                if action:
+                    self._log_action("copy" if action != "older" else "restore", 
+                                     action, ">", local_file, 
+                                     rel_path="%s (%s)" % (local_file.get_rel_path(), 
+                                                           remote.get_base_name()))
+                    dests.append(remote)
+            if dests:
+                self._copy_file_multi(local_file, dests)
+            else:
+                self._log_action("", "equal", "=", local_file, min_level=4)
+
+        # 2. Remove remote entries that do not exist locally
+        for diff_map in diff_maps:
+            for name, (status, remote_entry) in sorted(diff_map.items()):
+                if remote_entry is None:
+                    continue
+                elif remote_entry.is_dir():
+                    self._inc_stat("remote_dirs")
+                else:
+                    self._inc_stat("remote_files")
+                if status != diff_mod.REMOTE_ONLY:
+                    continue
+                if self._check_del_unmatched(remote_entry):
+                    continue
+                elif self.options.get("delete"):
+                    self._log_action("delete", "missing", "X", remote_entry, 
+                                     rel_path="%s (%s)" % (remote_entry.get_rel_path(), 
+                                                           remote_entry.target.get_base_name()))
+                    if remote_entry.is_dir():
+                        self._remove_dir(remote_entry)
+                    else:
+                        self._remove_file(remote_entry)
+
+        self.local.flush_meta()
+        self._map(lambda r: r.flush_meta(), remotes)
+        self._commit_mirrors(remotes, ("dir", ))
+
+        # 3. Visit sub folders (create them where missing)
+        for local_dir in local_entries:
+            if not local_dir.is_dir():
+                continue
+            self._inc_stat("local_dirs")
+            if not self._before_sync(local_dir) or not self._test_match_or_print(local_dir):
+                continue
+            sub_remotes = []
+            for remote, diff_map in zip(remotes, diff_maps):
+                _status, remote_dir = diff_map[local_dir.name]
+                if remote_dir is not None and not remote_dir.is_dir():
+                    self._sync_error("file and directory with the same name", 
+                                     local_dir, remote_dir)
+                    continue
+                if remote_dir is None:
+                    self._log_action("copy", "new", ">", local_dir, 
+                                     rel_path="%s (%s)" % (local_dir.get_rel_path(), 
+                                                           remote.get_base_name()))
+                    self._inc_stat("dirs_created")
+                    if self.dry_run:
+                        continue
+                    remote.mkdir(local_dir.name)
+                sub_remotes.append(remote)
+            if not sub_remotes:
+                continue
+            self.local.cwd(local_dir.name)
+            self._map(lambda r: r.cwd(local_dir.name), sub_remotes)
+            self._sync_dir_multi(sub_remotes)
+            self.local.cwd("..")
+            self._map(lambda r: r.cwd(".."), sub_remotes)
+
+    def _copy_file_multi(self, file_entry, dests):
+        """Read a local file once and write it to all `dests` concurrently."""
+        self._inc_stat("entries_touched")
+        self._inc_stat("files_written", len(dests))
+        self._inc_stat("upload_files_written", len(dests))
+        self._inc_stat("local_files_read")
+        self._tick()
+        if self.dry_run:
+            return self._dry_run_action("copy file (%s --> %s targets)" % (file_entry, len(dests)),
+                                        "upload", dests[0], files=len(dests),
+                                        size=file_entry.size * len(dests))
+
+        def _block_written(data):
+            self._inc_stat("bytes_written", len(data))
+            self._inc_stat("upload_bytes_written", len(data))
+
+        name = file_entry.name
+        start = time.time()
+        with self.local.open_readable(name) as fp_src:
+            if len(dests) == 1:
+                dests[0].write_file(name, fp_src, callback=_block_written)
+                self._inc_stat("local_bytes_read", file_entry.size)
+            else:
+                tee = _TeeReader(fp_src, len(dests), lambda: self.local.open_readable(name))
+                def _write(args):
+                    dest, consumer = args
+                    try:
+                        dest.write_file(name, consumer, callback=_block_written)
+                    finally:
+                        consumer.close()
+                res = self._pool.map_async(_write, list(zip(dests, tee.consumers)))
+                self._inc_stat("local_bytes_read", tee.run())
+                res.get()
+
+        self._map(lambda d: d.set_mtime(name, file_entry.mtime, file_entry.size), dests)
+        self._inc_stat("upload_write_time", time.time() - start)
@@ -6,14 +6,21 @@ Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.p
 
 from __future__ import print_function
 
+import base64
+import binascii
+import gzip
 import io
+import math
 import os
 from posixpath import join as join_url, normpath as normpath_url
 import shutil
 import sys
 import json
+import threading
 import time
 import getpass
+import hashlib
+from multiprocessing.pool import ThreadPool
 from ftpsync._version import __version__
 from ftpsync.resources import DirectoryEntry, FileEntry
 
@@ -24,6 +31,21 @@ except ImportError:
     # Python 2
     from urlparse import urlparse
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
+
+try:
+    import orjson  # faster JSON backend for meta data files
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash  # fast non-cryptographic 'xxh64' hashes
+except ImportError:
+    xxhash = None
+
 try:
     import colorama  # provide color codes, ...
     colorama.init()  # improve color handling on windows terminals
@@ -39,9 +61,25 @@ except ImportError:
 
 
 DEFAULT_CREDENTIAL_STORE = "pyftpsync.pw"
+#: Folder for cached information about hosts, runs, ... (may be overridden by
+#: the PYFTPSYNC_STATE_DIR environment variable)
+DEFAULT_STATE_DIR = "~/.pyftpsync"
 DRY_RUN_PREFIX = "(DRY-RUN) "
 IS_REDIRECTED = (os.fstat(0) != os.fstat(1))
 DEFAULT_BLOCKSIZE = 8 * 1024
+DEFAULT_HASH_WORKERS = 4
+#: With the 'delta' option, existing files of this size (bytes) or larger
+#: are updated in place, ...
+DELTA_MIN_SIZE = 1024 * 1024
+#: ... by comparing and rewriting blocks of this size
+DELTA_BLOCKSIZE = 64 * 1024
+#: Hash algorithms that may be used by `--compare hash` and `--verify`, fastest first
+HASH_ALGOS = ("md5", "sha1", "sha256")
+if xxhash is not None:
+    HASH_ALGOS = ("xxh64", ) + HASH_ALGOS
+#: Format version of compact meta data files (see encode_meta())
+META_COMPACT_VERSION = 2
+GZIP_MAGIC = b"\x1f\x8b"
 
 
 #===============================================================================
@@ -140,6 +178,38 @@ def ansi_code(name):
         return ""
 
 
+def get_state_path(file_name):
+    """Return path to a file in the state folder (the folder is created on demand)."""
+    state_dir = os.environ.get("PYFTPSYNC_STATE_DIR") or DEFAULT_STATE_DIR
+    state_dir = os.path.expanduser(state_dir)
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+    return os.path.join(state_dir, file_name)
+
+
+def new_hash(algo):
+    """Return a hash object for a HASH_ALGOS name."""
+    if algo == "xxh64":
+        if xxhash is None:
+            raise ValueError("xxh64 requires the 'xxhash' library")
+        return xxhash.xxh64()
+    return hashlib.new(algo)
+
+
+def hash_file(path, algo, blocksize=64 * 1024):
+    """Return (hex digest, bytes read) for a local file."""
+    h = new_hash(algo)
+    size = 0
+    with open(path, "rb") as fp:
+        while True:
+            data = fp.read(blocksize)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+    return h.hexdigest(), size
+
+
 #===============================================================================
 # make_target
 #===============================================================================
@@ -229,6 +299,110 @@ else:
 #        self.fp.close()
 
 
+#===============================================================================
+# Meta data encoding
+#===============================================================================
+def _to_ms(stamp):
+    # Round up, so a decoded time is never older than the original
+    return None if stamp is None else int(math.ceil(stamp * 1000))
+
+
+def _from_ms(ms):
+    return None if ms is None else ms / 1000.0
+
+
+def _pack_digest(digest):
+    try:
+        return base64.b64encode(binascii.unhexlify(digest)).decode("ascii").rstrip("=")
+    except (TypeError, ValueError):
+        return "=" + digest  # not a hex digest
+
+
+def _unpack_digest(packed):
+    if packed.startswith("="):
+        return packed[1:]
+    packed += "=" * (-len(packed) % 4)
+    return binascii.hexlify(base64.b64decode(packed)).decode("ascii")
+
+
+def _json_dumps(obj, pretty=False):
+    if pretty:
+        return json.dumps(obj, indent=4, sort_keys=True).encode("utf8")
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf8")
+
+
+def _json_loads(data):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data.decode("utf8"))
+
+
+def encode_meta(meta, compact=False, use_gzip=False, pretty=False):
+    """Return DirMetadata.dir as bytes.
+
+    The compact format uses short keys, lists instead of dicts, integer
+    milliseconds for times, and base64 for hex digests. Both formats may be
+    gzip'ed. decode_meta() reads all variants.
+    """
+    if compact:
+        res = {"_v": META_COMPACT_VERSION,
+               "_t": int(time.time()),
+               "f": dict((name, [_to_ms(info["m"]), info["s"], _to_ms(info.get("u"))])
+                         for name, info in meta.get("files", {}).items()),
+               "p": dict((peer, dict((name, [_to_ms(info["m"]), info["s"]])
+                                     for name, info in infos.items()))
+                         for peer, infos in meta.get("peer_sync", {}).items()),
+               "h": dict((name, [info.get("i"), info.get("s"), _to_ms(info.get("m")),
+                                 dict((k, _pack_digest(v)) for k, v in info.items()
+                                      if k not in ("i", "s", "m"))])
+                         for name, info in meta.get("hashes", {}).items()),
+               }
+        data = _json_dumps(res)
+    else:
+        meta["_disclaimer"] = "Generated by https://github.com/mar10/pyftpsync"
+        meta["_time_str"] = "%s" % time.ctime()
+        meta["_file_version"] = DirMetadata.VERSION
+        meta["_version"] = __version__
+        meta["_time"] = time.mktime(time.gmtime())
+        data = _json_dumps(meta, pretty)
+    if use_gzip:
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6, mtime=0) as f:
+            f.write(data)
+        data = buf.getvalue()
+    return data
+
+
+def decode_meta(data):
+    """Return a DirMetadata.dir compatible dict for data written by encode_meta()."""
+    if data.startswith(GZIP_MAGIC):
+        with gzip.GzipFile(fileobj=io.BytesIO(data), mode="rb") as f:
+            data = f.read()
+    d = _json_loads(data)
+    if "_v" in d:
+        if d["_v"] != META_COMPACT_VERSION:
+            raise RuntimeError("Invalid meta data version: %s (expected %s)" 
+                               % (d["_v"], META_COMPACT_VERSION))
+        hashes = {}
+        for name, (unique, size, mtime, digests) in d.get("h", {}).items():
+            info = hashes[name] = dict((k, _unpack_digest(v)) for k, v in digests.items())
+            info.update({"i": unique, "s": size, "m": _from_ms(mtime)})
+        return {"files": dict((name, {"m": _from_ms(m), "s": size, "u": _from_ms(u)})
+                              for name, (m, size, u) in d.get("f", {}).items()),
+                "peer_sync": dict((peer, dict((name, {"m": _from_ms(m), "s": size})
+                                              for name, (m, size) in infos.items()))
+                                  for peer, infos in d.get("p", {}).items()),
+                "hashes": hashes,
+                "_file_version": DirMetadata.VERSION,
+                }
+    if d.get("_file_version", 0) < DirMetadata.VERSION:
+        raise RuntimeError("Invalid meta data version: %s (expected %s)" 
+                           % (d.get("_file_version"), DirMetadata.VERSION))
+    return d
+
+
 #===============================================================================
 # DirMetadata
 #===============================================================================
@@ -245,12 +419,15 @@ class DirMetadata(object):
         self.path = target.cur_dir
         self.list = {}
         self.peer_sync = {}
+        self.hashes = {}
         self.dir = {"files": self.list,
                     "peer_sync": self.peer_sync,
+                    "hashes": self.hashes,
                     }
         self.filename = self.META_FILE_NAME
         self.modified_list = False
         self.modified_sync = False
+        self.modified_hashes = False
         self.was_read = False
         
     def set_mtime(self, filename, mtime, size):
@@ -289,28 +466,66 @@ class DirMetadata(object):
         if self.PRETTY or self.DEBUG:
             pse["mtime_str"] = time.ctime(mtime) if mtime else "(directory)"
         self.modified_sync = True
-        
+
+    def get_hash(self, filename, algo, unique, mtime, size):
+        """Return a cached file hash or None.
+
+        The cache entry is only used if inode, size, and mtime still match.
+        """
+        info = self.hashes.get(filename)
+        if (info and info.get("i") == unique and info.get("s") == size 
+                and self._same_mtime(info.get("m"), mtime)):
+            return info.get(algo)
+        return None
+
+    @staticmethod
+    def _same_mtime(stored, mtime):
+        # The compact format stores milliseconds
+        return stored is not None and mtime is not None and abs(stored - mtime) < 0.001
+
+    def set_hash(self, filename, algo, digest, unique, mtime, size):
+        """Store a file hash together with inode, size, and mtime."""
+        info = self.hashes.get(filename)
+        if (not info or info.get("i") != unique or info.get("s") != size 
+                or not self._same_mtime(info.get("m"), mtime)):
+            info = self.hashes[filename] = {"i": unique, "s": size, "m": mtime}
+        info[algo] = digest
+        self.modified_hashes = True
+
+    def remove_mtime(self, filename):
+        """Discard the stored mtime (e.g. because the target could set it directly)."""
+        if self.list.pop(filename, None):
+            self.modified_list = True
+
     def remove(self, filename):
         if self.list.pop(filename, None):
             self.modified_list = True
+        if self.hashes.pop(filename, None):
+            self.modified_hashes = True
         if self.target.is_local():
             remote_target = self.target.peer
-            self.modified_sync = self.dir["peer_sync"][remote_target.get_id()].pop(filename, None)
+            ps = self.dir["peer_sync"].get(remote_target.get_id(), {})
+            if ps.pop(filename, None):
+                self.modified_sync = True
         return
 
     def read(self):
         assert self.path == self.target.cur_dir
+        writer = getattr(self.target.synchronizer, "meta_writer", None)
+        if writer:
+            writer.wait(self.target, self.path)
         try:
-            s = self.target.read_text(self.filename)
-            self.target.synchronizer._inc_stat("meta_bytes_read", len(s))
+            with self.target.open_readable(self.filename) as fp:
+                data = fp.read()
+            self.target.synchronizer._inc_stat("meta_bytes_read", len(data))
             self.was_read = True # True, if exists (even invalid)
-            self.dir = json.loads(s)
-            if self.dir.get("_file_version", 0) < self.VERSION:
-                raise RuntimeError("Invalid meta data version: %s (expected %s)" % (self.dir.get("_file_version"), self.VERSION))
+            self.dir = decode_meta(data)
             self.list = self.dir["files"]
             self.peer_sync = self.dir["peer_sync"] 
+            self.hashes = self.dir.setdefault("hashes", {})
             self.modified_list = False
             self.modified_sync = False
+            self.modified_hashes = False
 #              print("DirMetadata: read(%s)" % (self.filename, ), self.dir)
         except Exception as e:
             print("Could not read meta info: %s" % e, file=sys.stderr)
@@ -321,36 +536,122 @@ class DirMetadata(object):
 #             print("DirMetadata.flush(%s): read-only; nothing to do" % self.target)
 #             return
         assert self.path == self.target.cur_dir
+        writer = getattr(self.target.synchronizer, "meta_writer", None)
         if self.target.dry_run:
 #             print("DirMetadata.flush(%s): dry-run; nothing to do" % self.target)
             pass
         
-        elif self.was_read and len(self.list) == 0 and len(self.peer_sync) == 0:
+        elif (self.was_read and len(self.list) == 0 and len(self.peer_sync) == 0
+              and len(self.hashes) == 0):
 #             print("DirMetadata.flush(%s): DELETE" % self.target)
-            self.target.remove_file(self.filename)
+            if not (writer and writer.put(self.target, self.path, self.filename, None)):
+                self.target.remove_file(self.filename)
+            self.was_read = False
 
-        elif not self.modified_list and not self.modified_sync:
+        elif not self.modified_list and not self.modified_sync and not self.modified_hashes:
 #             print("DirMetadata.flush(%s): unmodified; nothing to do" % self.target)
             pass
 
         else:        
-            self.dir["_disclaimer"] = "Generated by https://github.com/mar10/pyftpsync"
-            self.dir["_time_str"] = "%s" % time.ctime()
-            self.dir["_file_version"] = self.VERSION
-            self.dir["_version"] = __version__
-            self.dir["_time"] = time.mktime(time.gmtime())
-            if self.PRETTY or self.DEBUG:
-                s = json.dumps(self.dir, indent=4, sort_keys=True)
-            else:
-                s = json.dumps(self.dir)
+            data = encode_meta(self.dir, 
+                               compact=self.target.get_option("meta_format") == "compact",
+                               use_gzip=self.target.get_option("meta_gzip", False),
+                               pretty=self.PRETTY or self.DEBUG)
 #             print("DirMetadata.flush(%s)" % (self.target, ))#, s)
-            self.target.write_text(self.filename, s)
-            self.target.synchronizer._inc_stat("meta_bytes_written", len(s))
+            if not (writer and writer.put(self.target, self.path, self.filename, data)):
+                self.target.write_file(self.filename, io.BytesIO(data))
+            self.target.synchronizer._inc_stat("meta_bytes_written", len(data))
             if self.DEBUG:
-                self.target.write_text(self.DEBUG_META_FILE_NAME, s)
+                self.target.write_text(self.DEBUG_META_FILE_NAME, 
+                                       json.dumps(self.dir, indent=4, sort_keys=True))
         
         self.modified_list = False
         self.modified_sync = False
+        self.modified_hashes = False
+
+
+#===============================================================================
+# MetaWriter
+#===============================================================================
+class MetaWriter(object):
+    """Write meta data files on a background thread (write-behind).
+
+    Every target gets a connected clone (i.e. its own FTP connection), so
+    the traversal can go on with the original one. put() returns False for
+    targets that cannot be cloned; the caller must write synchronously then.
+    """
+    def __init__(self, open_clone):
+        self._open_clone = open_clone # callable(target) -> connected clone or None
+        self._clones = {} # {id(target): clone or None}
+        self._pending = {} # {(id(target), path): number of queued writes}
+        self._queue = queue.Queue()
+        self._idle = threading.Condition()
+        self.errors = []
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, target, path, name, data):
+        """Queue writing `data` to path/name (remove the file if data is None)."""
+        key = id(target)
+        if key not in self._clones:
+            self._clones[key] = self._open_clone(target)
+        if self._clones[key] is None:
+            return False
+        with self._idle:
+            self._pending[(key, path)] = self._pending.get((key, path), 0) + 1
+        self._queue.put((key, path, name, data))
+        target.synchronizer._inc_stat("meta_write_behind")
+        return True
+
+    def call(self, func):
+        """Call func() on the worker thread, after all writes queued so far."""
+        self._queue.put((None, None, func, None))
+
+    def wait(self, target=None, path=None):
+        """Block until the writes for target/path (default: all) are done."""
+        key = (id(target), path)
+        with self._idle:
+            while self._pending if target is None else self._pending.get(key):
+                self._idle.wait()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            key, path, name, data = item
+            try:
+                if key is None:
+                    name()
+                    continue
+                clone = self._clones[key]
+                if clone.cur_dir != path:
+                    clone.cwd(path)
+                if data is None:
+                    clone.remove_file(name)
+                else:
+                    clone.write_file(name, io.BytesIO(data))
+            except Exception as e:
+                print("Could not write meta data %s/%s: %s" % (path, name, e), file=sys.stderr)
+                self.errors.append(e)
+            finally:
+                if key is not None:
+                    with self._idle:
+                        if self._pending[(key, path)] == 1:
+                            del self._pending[(key, path)]
+                        else:
+                            self._pending[(key, path)] -= 1
+                        self._idle.notify_all()
+
+    def close(self):
+        """Wait for all pending writes and close the clones."""
+        self._queue.put(None)
+        self._thread.join()
+        for clone in self._clones.values():
+            if clone is not None:
+                clone.close()
+        self._clones = {}
 
 
 #===============================================================================
@@ -369,9 +670,11 @@ class _Target(object):
         self.cur_dir = None
         self.connected = False
         self.save_mode = True
-        self.case_sensitive = None # TODO: don't know yet
-        self.time_ofs = None # TODO: don't know yet
-        self.support_set_time = None # TODO: don't know yet
+        self.case_sensitive = None # None: unknown (probed by FtpTarget.open())
+        self.time_ofs = None # None: unknown (probed by FtpTarget.open())
+        self.support_set_time = None # None: unknown (probed by FtpTarget.open())
+        self.mtime_precision = 0 # seconds, see FileEntry._get_eps()
+        self.rtt = None # seconds per command round trip (measured by open())
         self.cur_dir_meta = DirMetadata(self)
         self.meta_stack = []
         
@@ -382,6 +685,10 @@ class _Target(object):
     def get_base_name(self):
         return "%s" % self.root_dir
 
+    def get_host_key(self):
+        """Return 'host:port' for network targets, else None."""
+        return None
+
     def is_local(self):
         return self.synchronizer.local is self
     
@@ -396,6 +703,17 @@ class _Target(object):
     
     def close(self):
         self.connected = False
+
+    def clone(self):
+        """Return a new, unconnected target for the same location or None.
+
+        This is used to open additional connections (e.g. transfer lanes).
+        """
+        return None
+
+    def keep_alive(self):
+        """Make sure an idle connection is not dropped (called by long running commands)."""
+        pass
     
     def check_write(self, name):
         """Raise exception if writing cur_dir/name is not allowed."""
@@ -473,9 +791,62 @@ class _Target(object):
         """Remove cur_dir/name."""
         raise NotImplementedError
 
+    def rename(self, old_path, new_path):
+        """Rename or move cur_dir/old_path to cur_dir/new_path."""
+        raise NotImplementedError
+
     def set_mtime(self, name, mtime, size):
         raise NotImplementedError
 
+    def prefetch_tree(self):
+        """Fetch the listing of the whole tree in advance, if that is faster.
+
+        Return True if get_dir() will use the prefetched listings.
+        """
+        return False
+
+    def clear_tree(self):
+        """Discard listings that were fetched by prefetch_tree()."""
+        pass
+
+    def flush_batch(self):
+        """Send commands that were queued to save round trips (see 'pipeline' option)."""
+        pass
+
+    def commit_uploads(self):
+        """Rename files that write_file() stored under a temporary name.
+
+        Return the number of renamed files (see 'atomic' option).
+        """
+        return 0
+
+    def get_hash_algos(self):
+        """Return a list of hash algorithms supported by get_hash(), fastest first."""
+        return []
+
+    def get_capabilities(self):
+        """Return a dict that describes the strategies this target supports."""
+        return {"hash_algos": self.get_hash_algos(),
+                "set_time": self.support_set_time,
+                "rest_stream": False,
+                "mode_z": False,
+                }
+
+    def get_hash(self, file_entry, algo):
+        """Return hex digest of a file or None if not available."""
+        return None
+
+    def cache_hash(self, name, algo, digest, meta=None):
+        """Remember the digest of cur_dir/name, computed while copying it.
+
+        Targets that keep a hash cache store it in `meta` (default: cur_dir_meta).
+        """
+        pass
+
+    def get_hashes(self, file_entries, algo):
+        """Return a dict {name: hex digest} (see get_hash())."""
+        return dict((e.name, self.get_hash(e, algo)) for e in file_entries)
+
     def set_sync_info(self, name, mtime, size):
         """Store mtime/size when this resource was last synchronized with remote."""
         if not self.is_local():
@@ -498,6 +869,7 @@ class FsTarget(_Target):
         if not os.path.isdir(root_dir):
             raise ValueError("%s is not a directory" % root_dir)
         super(FsTarget, self).__init__(root_dir, extra_opts)
+        self.support_set_time = True
         self.open()
 
     def __str__(self):
@@ -507,6 +879,9 @@ class FsTarget(_Target):
         self.connected = True
         self.cur_dir = self.root_dir
 
+    def clone(self):
+        return FsTarget(self.root_dir, self.extra_opts)
+
     def close(self):
         self.connected = False
         
@@ -576,7 +951,11 @@ class FsTarget(_Target):
         
     def write_file(self, name, fp_src, blocksize=DEFAULT_BLOCKSIZE, callback=None):
         self.check_write(name)
-        with open(os.path.join(self.cur_dir, name), "wb") as fp_dst:
+        path = os.path.join(self.cur_dir, name)
+        if (self.get_option("delta") and os.path.isfile(path) 
+                and os.path.getsize(path) >= DELTA_MIN_SIZE):
+            return self._write_delta(path, fp_src, callback)
+        with open(path, "wb") as fp_dst:
             while True:
                 data = fp_src.read(blocksize)
                 if data is None or not len(data):
@@ -585,6 +964,32 @@ class FsTarget(_Target):
                 if callback:
                     callback(data)
         return
+
+    def _write_delta(self, path, fp_src, callback=None):
+        """Update an existing file in place, writing only the blocks that differ.
+
+        Both blocks are read locally, so they are compared directly instead
+        of by checksum. `callback` only receives the blocks that were written.
+        """
+        written = skipped = 0
+        with open(path, "r+b") as fp_dst:
+            while True:
+                data = fp_src.read(DELTA_BLOCKSIZE)
+                if data is None or not len(data):
+                    break
+                pos = fp_dst.tell()
+                if fp_dst.read(len(data)) == data:
+                    skipped += len(data)
+                    continue
+                fp_dst.seek(pos)
+                fp_dst.write(data)
+                written += len(data)
+                if callback:
+                    callback(data)
+            fp_dst.truncate()
+        self.synchronizer._inc_stat("delta_files")
+        self.synchronizer._inc_stat("delta_bytes_written", written)
+        self.synchronizer._inc_stat("delta_bytes_skipped", skipped)
         
     def remove_file(self, name):
         """Remove cur_dir/name."""
@@ -596,3 +1001,67 @@ class FsTarget(_Target):
         """Set modification time on file."""
         self.check_write(name)
         os.utime(os.path.join(self.cur_dir, name), (-1, mtime))
+
+    def get_hash_algos(self):
+        return list(HASH_ALGOS)
+
+    def get_hash(self, file_entry, algo):
+        return self.get_hashes([file_entry], algo).get(file_entry.name)
+
+    def cache_hash(self, name, algo, digest, meta=None):
+        meta = meta or self.cur_dir_meta
+        if meta is None or meta.path != self.cur_dir:
+            return
+        stat = os.stat(os.path.join(self.cur_dir, name))
+        meta.set_hash(name, algo, digest, str(stat.st_ino), stat.st_mtime, stat.st_size)
+
+    def get_hashes(self, file_entries, algo):
+        """Return a dict {name: hex digest}.
+
+        Hashes are looked up in the meta data cache first, keyed by
+        (inode, size, mtime). Missing hashes are computed in parallel.
+        """
+        meta = self.cur_dir_meta
+        if meta and meta.path != self.cur_dir:
+            meta = None
+        res = {}
+        todo = []
+        for e in file_entries:
+            digest = None
+            if meta and e.rel_path == self.cur_dir:
+                digest = meta.get_hash(e.name, algo, e.unique, e.mtime, e.size)
+            if digest:
+                self.synchronizer._inc_stat("hash_cache_hits")
+                res[e.name] = digest
+            else:
+                todo.append(e)
+        if not todo:
+            return res
+
+        def _hash(e):
+            return hash_file(os.path.join(e.rel_path, e.name), algo)
+
+        workers = self.get_option("hash_workers", DEFAULT_HASH_WORKERS)
+        if len(todo) > 1 and workers > 1:
+            pool = ThreadPool(min(workers, len(todo)))
+            try:
+                results = pool.map(_hash, todo)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [ _hash(e) for e in todo ]
+
+        for e, (digest, size) in zip(todo, results):
+            self.synchronizer._inc_stat("hash_files_computed")
+            self.synchronizer._inc_stat("hash_bytes_read", size)
+            if meta and e.rel_path == self.cur_dir:
+                meta.set_hash(e.name, algo, digest, e.unique, e.mtime, e.size)
+            res[e.name] = digest
+        return res
+
+    def rename(self, old_path, new_path):
+        """Rename or move cur_dir/old_path to cur_dir/new_path."""
+        self.check_write(new_path)
+        os.rename(os.path.join(self.cur_dir, old_path), 
+                  os.path.join(self.cur_dir, new_path))
@@ -0,0 +1,218 @@
+# -*- coding: iso-8859-1 -*-
+"""
+(c) 2012-2015 Martin Wendt; see https://github.com/mar10/pyftpsync
+Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
+
+Watch a local folder and upload modifications incrementally.
+"""
+from __future__ import print_function
+
+import os
+from posixpath import dirname as dirname_url
+import time
+
+from ftpsync.targets import DirMetadata, FsTarget
+from ftpsync.synchronizers import UploadSynchronizer
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None  # Use PollingWatcher
+
+
+DEFAULT_DEBOUNCE = 2.0
+DEFAULT_MAX_DELAY = 30.0
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_KEEPALIVE = 60.0
+
+#: Changes of these files never trigger a sync (we write them ourselves)
+IGNORE_NAMES = (DirMetadata.META_FILE_NAME,
+                DirMetadata.DEBUG_META_FILE_NAME,
+                )
+
+
+#===============================================================================
+# PollingWatcher
+#===============================================================================
+class PollingWatcher(object):
+    """Detect modified folders by comparing snapshots of the local tree."""
+
+    def __init__(self, root_dir, interval=DEFAULT_POLL_INTERVAL):
+        self.root_dir = root_dir
+        self.interval = interval
+        self.snapshot = self._scan()
+        self.last_scan = time.time()
+
+    def _scan(self):
+        """Return a dict {rel_dir: {name: (size, mtime)}}."""
+        res = {}
+        for dir_path, dir_names, file_names in os.walk(self.root_dir):
+            rel_dir = os.path.relpath(dir_path, self.root_dir).replace(os.sep, "/")
+            if rel_dir == ".":
+                rel_dir = ""
+            entries = res[rel_dir] = {}
+            # Folder mtimes change when we write meta data, so ignore them
+            for name in dir_names:
+                entries[name] = None
+            for name in file_names:
+                if name in IGNORE_NAMES:
+                    continue
+                try:
+                    stat = os.lstat(os.path.join(dir_path, name))
+                except OSError:
+                    continue # removed in the meantime
+                entries[name] = (stat.st_size, stat.st_mtime)
+        return res
+
+    def poll(self, timeout):
+        """Wait up to `timeout` seconds and return a set of modified folders."""
+        wait = self.last_scan + self.interval - time.time()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        elif wait > 0:
+            time.sleep(wait)
+        snapshot = self._scan()
+        self.last_scan = time.time()
+        changed = set()
+        for rel_dir, entries in snapshot.items():
+            if self.snapshot.get(rel_dir) != entries:
+                changed.add(rel_dir)
+        for rel_dir in self.snapshot:
+            if rel_dir not in snapshot:
+                changed.add(dirname_url(rel_dir))
+        self.snapshot = snapshot
+        return changed
+
+    def close(self):
+        pass
+
+
+#===============================================================================
+# InotifyWatcher
+#===============================================================================
+class InotifyWatcher(object):
+    """Detect modified folders using Linux inotify (requires `pyinotify`)."""
+
+    MASK = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE
+            | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+            | pyinotify.IN_ATTRIB) if pyinotify else 0
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.changed = set()
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, self._on_event, timeout=10)
+        self.wm.add_watch(root_dir, self.MASK, rec=True, auto_add=True)
+
+    def _on_event(self, event):
+        if event.name in IGNORE_NAMES:
+            return
+        rel_dir = os.path.relpath(event.path, self.root_dir).replace(os.sep, "/")
+        self.changed.add("" if rel_dir == "." else rel_dir)
+
+    def poll(self, timeout):
+        """Wait up to `timeout` seconds and return a set of modified folders."""
+        if self.notifier.check_events(timeout=int(timeout * 1000)):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed = self.changed
+        self.changed = set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+
+def make_watcher(root_dir, options):
+    """Return an InotifyWatcher if available, else a PollingWatcher."""
+    if pyinotify and not options.get("poll"):
+        return InotifyWatcher(root_dir)
+    if options.get("verbose", 3) >= 4:
+        print("Polling for changes every %s sec"
+              % options.get("poll_interval", DEFAULT_POLL_INTERVAL))
+    return PollingWatcher(root_dir, options.get("poll_interval", DEFAULT_POLL_INTERVAL))
+
+
+#===============================================================================
+# WatchSynchronizer
+#===============================================================================
+class WatchSynchronizer(object):
+    """Upload local modifications as they happen.
+
+    Starts with a full upload, then keeps the remote connection open and
+    synchronizes only the folders that were reported by the watcher.
+    Modifications are collected until the watcher stays quiet for `debounce`
+    seconds (but at most `max_delay` seconds).
+    """
+    def __init__(self, local, remote, options):
+        if not isinstance(local, FsTarget):
+            raise ValueError("watch requires a local file system target: %s" % local)
+        self.local = local
+        self.remote = remote
+        self.options = options or {}
+        self.verbose = self.options.get("verbose", 3)
+        self.debounce = self.options.get("debounce") or DEFAULT_DEBOUNCE
+        self.max_delay = self.options.get("max_delay") or DEFAULT_MAX_DELAY
+        self.keepalive = self.options.get("keepalive") or DEFAULT_KEEPALIVE
+        self._stats = {}
+
+    def get_stats(self):
+        return self._stats
+
+    def _add_stats(self, stats):
+        for k, v in stats.items():
+            if isinstance(v, (int, float)) and not isinstance(v, bool):
+                self._stats[k] = self._stats.get(k, 0) + v
+        self._stats["elap_str"] = "%0.2f sec" % self._stats.get("elap_secs", 0)
+
+    def _sync_dirs(self, rel_dirs):
+        """Run an incremental upload for some folders and return failed folders."""
+        # Deleted folders are handled when the parent is synchronized
+        todo = set()
+        for rel_dir in rel_dirs:
+            while rel_dir and not os.path.isdir(os.path.join(self.local.root_dir, rel_dir)):
+                rel_dir = dirname_url(rel_dir)
+            todo.add(rel_dir)
+        s = UploadSynchronizer(self.local, self.remote, self.options)
+        failed = s.sync_dirs(todo)
+        stats = s.get_stats()
+        self._add_stats(stats)
+        if self.verbose >= 1:
+            prefix = "(DRY-RUN) " if s.dry_run else ""
+            print("%sWrote %s files in %s dirs. Elap: %s"
+                  % (prefix, stats["files_written"], len(todo), stats["elap_str"]))
+        return failed
+
+    def run(self):
+        s = UploadSynchronizer(self.local, self.remote, self.options)
+        s.run()
+        self._add_stats(s.get_stats())
+
+        watcher = make_watcher(self.local.root_dir, self.options)
+        print("Watching %s for changes (hit Ctrl+C to stop)..." % self.local.root_dir)
+        pending = set()
+        first_event = last_event = None
+        last_activity = time.time()
+        try:
+            while True:
+                changed = watcher.poll(timeout=min(self.debounce, 1.0))
+                now = time.time()
+                if changed:
+                    pending.update(changed)
+                    last_event = now
+                    if first_event is None:
+                        first_event = now
+
+                if pending and (now - last_event >= self.debounce
+                                or now - first_event >= self.max_delay):
+                    failed = self._sync_dirs(pending)
+                    # Retry from the parent folder, e.g. if it was missing on remote
+                    pending = set(dirname_url(d) for d in failed if d)
+                    first_event = last_event = now if pending else None
+                    last_activity = time.time()
+                elif now - last_activity >= self.keepalive:
+                    self.remote.keep_alive()
+                    last_activity = now
+        finally:
+            watcher.close()
@@ -5,23 +5,48 @@ Tests for pyftpsync
 from __future__ import print_function
 
 import datetime
+import json
 import os
 from pprint import pprint
 import sys
+import threading
+import time
 from unittest import TestCase
 import unittest
 from unittest.case import SkipTest
 
-from ftpsync.targets import FsTarget, DirMetadata
+from ftpsync.targets import FsTarget, DirMetadata, GZIP_MAGIC, decode_meta, \
+    encode_meta, DELTA_BLOCKSIZE
 
 from ftpsync.synchronizers import DownloadSynchronizer, UploadSynchronizer, \
-    BiDirSynchronizer
+    BiDirSynchronizer, MultiUploadSynchronizer
+from ftpsync.watch import PollingWatcher, WatchSynchronizer
+from ftpsync.jobs import JobRunner, load_jobs
+from ftpsync.journal import SyncJournal
+from ftpsync.scheduler import Scheduler
+from ftpsync import diff
+from ftpsync.resources import FileEntry, DirectoryEntry
 from test.tools import prepare_fixtures_1, PYFTPSYNC_TEST_FOLDER, \
     _get_test_file_date, STAMP_20140101_120000, _touch_test_file, \
     _write_test_file, _remove_test_file, _is_test_file, _get_test_folder,\
     _remove_test_folder, prepare_fixtures_2, _sync_test_folders
 
 
+DO_BENCHMARKS = False #True
+
+def _make_meta(count):
+    """Return meta data with `count` file, peer sync, and hash entries."""
+    meta = {"files": {}, "peer_sync": {"ftp:example.com/htdocs": {}}, "hashes": {}}
+    stamp = STAMP_20140101_120000 + .123456
+    for i in range(count):
+        name = "file_%05d.html" % i
+        meta["files"][name] = {"m": stamp + i, "s": 1000 + i, "u": stamp + 2 * i}
+        meta["peer_sync"]["ftp:example.com/htdocs"][name] = {"m": stamp + i, "s": 1000 + i}
+        meta["hashes"][name] = {"i": str(i), "s": 1000 + i, "m": stamp + i,
+                                "md5": "%032x" % i, "sha256": "%064x" % i}
+    return meta
+
+
 #===============================================================================
 # Module setUp / tearDown
 #===============================================================================
@@ -101,6 +126,19 @@ class FilesystemTest(TestCase):
         self.assertEqual(_get_test_file_date("remote/file1.txt"), STAMP_20140101_120000)
 
 
+    def test_dry_run_report(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        s = UploadSynchronizer(local, remote, {"dry_run": True, "verbose": 1})
+        s.run()
+        report = s.get_dry_run_report()
+        # Same numbers as test_upload_fs_fs (including files in new folders)
+        self.assertEqual(report["actions"], {"upload": {"files": 6, "dirs": 2, "bytes": 16403}})
+        self.assertEqual(report["dirs_touched"], 1)
+        # No host: the estimate is the time needed to compare
+        self.assertEqual(report["eta_secs"], s.get_stats()["elap_secs"])
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "file1.txt")))
+
     def test_sync_fs_fs(self):
         local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
         remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
@@ -198,6 +236,423 @@ class FilesystemTest(TestCase):
         self.assertEqual(stats["bytes_written"], 0)
         self.assertEqual(stats["conflict_files"], 2)
 
+    def test_sync_conflict_same_size_and_mtime(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 3}
+        s = BiDirSynchronizer(local, remote, opts)
+        s.run()
+
+        # Both sides modified: same size and mtime, but different content
+        _write_test_file("local/file1.txt", dt="2014-01-01 14:00:00", content="local 14:00")
+        _write_test_file("remote/file1.txt", dt="2014-01-01 14:00:00", content="rmote 14:00")
+
+        s = BiDirSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["conflict_files"], 1)
+        self.assertEqual(stats["equal_files"], 5)
+        self.assertEqual(stats["bytes_written"], 0)
+        self.assertEqual(_get_test_folder("local")["file1.txt"]["content"], "local 14:00")
+        self.assertEqual(_get_test_folder("remote")["file1.txt"]["content"], "rmote 14:00")
+
+    def test_compare_hash(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 3}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 6)
+
+        # Touch without modifying content
+        _touch_test_file("local/file1.txt")
+        _touch_test_file("local/big_file.txt")
+
+        opts = {"dry_run": False, "verbose": 3, "compare": "hash"}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["hash_equal_files"], 2)
+        self.assertEqual(stats["hash_files_computed"], 4)
+
+        # Local hashes are cached in the meta data
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["hash_cache_hits"], 4)
+        self.assertEqual(stats.get("hash_files_computed", 0), 0)
+
+        # Modified content is detected
+        _write_test_file("local/file1.txt", content="xxx")
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 1)
+
+    def test_verify_caches_hashes(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 3, 
+                                               "verify": "md5"})
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 6)
+        # There is no server that could check the hash ...
+        self.assertEqual(stats["verify_unchecked"], 6)
+
+        # ... but the digests of both copies were stored in the meta data
+        _touch_test_file("remote/file1.txt")
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 3, 
+                                               "compare": "hash"})
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["hash_equal_files"], 1)
+        self.assertEqual(stats["hash_cache_hits"], 1)
+        self.assertEqual(stats["hash_files_computed"], 1)
+
+        self.assertRaises(ValueError, UploadSynchronizer, local, remote, {"verify": "crc"})
+
+    def test_delta_write(self):
+        data = bytearray(os.urandom(40 * DELTA_BLOCKSIZE))
+        with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "disk.img"), "wb") as f:
+            f.write(data)
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 3, "delta": True}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats().get("delta_files", 0), 0) # new file
+
+        def _modify(data, dt):
+            with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "disk.img"), "wb") as f:
+                f.write(data)
+            _touch_test_file("local/disk.img", dt=dt)
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "disk.img"), "rb") as f:
+                self.assertEqual(f.read(), data)
+            return s.get_stats()
+
+        # Two changed blocks are rewritten in place
+        data[5] ^= 0xFF
+        data[20 * DELTA_BLOCKSIZE] ^= 0xFF
+        stats = _modify(data, "2030-01-01 12:00:00")
+        self.assertEqual(stats["delta_files"], 1)
+        self.assertEqual(stats["delta_bytes_written"], 2 * DELTA_BLOCKSIZE)
+        self.assertEqual(stats["delta_bytes_skipped"], 38 * DELTA_BLOCKSIZE)
+        self.assertEqual(stats["upload_bytes_written"], 2 * DELTA_BLOCKSIZE)
+        # Shorter files are truncated (the remaining blocks did not change)
+        stats = _modify(data[:30 * DELTA_BLOCKSIZE + 10], "2030-01-02 12:00:00")
+        self.assertEqual(stats["delta_bytes_written"], 0)
+        self.assertEqual(stats["delta_bytes_skipped"], 30 * DELTA_BLOCKSIZE + 10)
+
+    def test_detect_moves(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 3, "delete": True}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 6)
+
+        # Rename a folder and move a file into another folder
+        os.rename(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "folder1"),
+                  os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "folder1_new"))
+        os.rename(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "big_file.txt"),
+                  os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "folder2", "big_file.txt"))
+
+        opts = {"dry_run": False, "verbose": 3, "delete": True, "detect_moves": True}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 0)
+        self.assertEqual(stats["files_deleted"], 0)
+        self.assertEqual(stats["dirs_deleted"], 0)
+        self.assertEqual(stats["dirs_moved"], 1)
+        self.assertEqual(stats["files_moved"], 1)
+        self.assertEqual(stats["move_bytes_saved"], 16384 + 5)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+
+    def test_upload_mirrors(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        # The second mirror is already partially up to date
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 3})
+        s.run()
+        _write_test_file("local/file1.txt", content="111 changed")
+        _write_test_file("remote/obsolete.txt")
+        os.mkdir(os.path.join(PYFTPSYNC_TEST_FOLDER, "mirror"))
+        mirror = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "mirror"))
+
+        opts = {"dry_run": False, "verbose": 3, "delete": True}
+        s = MultiUploadSynchronizer(local, [remote, mirror], opts)
+        s.run()
+        stats = s.get_stats()
+        # file1.txt is written twice, the other five files only to the mirror
+        self.assertEqual(stats["files_written"], 2 + 5)
+        self.assertEqual(stats["local_files_read"], 6)
+        self.assertEqual(stats["local_bytes_read"], 2 * 3 + 11 + 2 * 5 + 16384)
+        self.assertEqual(stats["files_deleted"], 1)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("mirror"))
+
+        s = MultiUploadSynchronizer(local, [remote, mirror], opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 0)
+
+        # Same mtime, but a different size is an error (as in UploadSynchronizer)
+        _write_test_file("mirror/file2.txt", content="different size")
+        stamp = _get_test_file_date("local/file2.txt")
+        os.utime(os.path.join(PYFTPSYNC_TEST_FOLDER, "mirror", "file2.txt"), (stamp, stamp))
+        s = MultiUploadSynchronizer(local, [remote, mirror], opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 0)
+
+        # Options that need the per-target copy path are rejected
+        for name, value in (("compare", "hash"), ("verify", "auto"), ("journal", True),
+                            ("order", "smallest"), ("max_rate", 1000)):
+            self.assertRaises(ValueError, MultiUploadSynchronizer, local, [remote, mirror], 
+                              dict(opts, **{name: value}))
+
+    def test_upload_mirrors_without_sync_info(self):
+        # No previous run has stored peer sync info for the mirrors
+        _remove_test_folder("remote")
+        for name in ("m1", "m2"):
+            _write_test_file("%s/gone.txt" % name)
+        mirrors = [FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, name)) for name in ("m1", "m2")]
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        s = MultiUploadSynchronizer(local, mirrors, {"dry_run": False, "verbose": 3,
+                                                     "delete": True})
+        s.run()
+        self.assertEqual(s.get_stats()["files_deleted"], 2)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("m1"))
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("m2"))
+
+    def test_run_jobs(self):
+        for name in ("remote", "remote2"):
+            if not os.path.isdir(os.path.join(PYFTPSYNC_TEST_FOLDER, name)):
+                os.mkdir(os.path.join(PYFTPSYNC_TEST_FOLDER, name))
+        path = os.path.join(PYFTPSYNC_TEST_FOLDER, "jobs.json")
+        with open(path, "wt") as f:
+            json.dump({"max_jobs": 2,
+                       "defaults": {"delete": True},
+                       "jobs": [{"local": os.path.join(PYFTPSYNC_TEST_FOLDER, "local"),
+                                 "remote": os.path.join(PYFTPSYNC_TEST_FOLDER, "remote")},
+                                {"name": "second",
+                                 "local": os.path.join(PYFTPSYNC_TEST_FOLDER, "local"),
+                                 "remote": os.path.join(PYFTPSYNC_TEST_FOLDER, "remote2"),
+                                 "options": {"omit": "big_file.txt"}},
+                                ]}, f)
+        config = load_jobs(path)
+        self.assertEqual(config["jobs"][0]["name"], "job1")
+        self.assertEqual(config["jobs"][0]["command"], "upload")
+
+        runner = JobRunner(config, {"dry_run": False, "verbose": 1})
+        self.assertTrue(runner.run())
+        stats = runner.get_stats()
+        self.assertEqual(stats["jobs"], 2)
+        self.assertEqual(stats["jobs_failed"], 0)
+        self.assertEqual(stats["files_written"], 6 + 5)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+        self.assertFalse(_is_test_file("remote2/big_file.txt"))
+
+        with open(path, "wt") as f:
+            json.dump({"jobs": [{"command": "mirror", "local": "a", "remote": "b"}]}, f)
+        self.assertRaises(ValueError, load_jobs, path)
+
+    def test_transfer_order(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        written = []
+        write_file = remote.write_file
+        def _write_file(name, fp_src, *args, **kwargs):
+            written.append(name)
+            return write_file(name, fp_src, *args, **kwargs)
+        remote.write_file = _write_file
+        opts = {"dry_run": False, "verbose": 1, "order": "largest", "large_lanes": 0}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 6)
+        self.assertEqual(written[0], "big_file.txt")
+        self.assertEqual(set(written[1:3]), set(["file1_1.txt", "file2_1.txt"]))
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+
+        # Large files use a separate lane; sync info is stored nevertheless
+        os.mkdir(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote2"))
+        opts = {"dry_run": False, "verbose": 1, "order": "extension", 
+                "large_file_size": 1000}
+        for files_written in (6, 0):
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote2"))
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            self.assertEqual(s.get_stats()["files_written"], files_written)
+            self.assertEqual(local.cur_dir, local.root_dir)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote2"))
+        with open(os.path.join(local.root_dir, DirMetadata.META_FILE_NAME), "rt") as f:
+            peer_sync = json.load(f)["peer_sync"][remote.get_id()]
+        self.assertIn("big_file.txt", peer_sync)
+
+        self.assertRaises(ValueError, UploadSynchronizer, local, remote, {"order": "random"})
+
+    def test_journal_resume(self):
+        os.environ["PYFTPSYNC_STATE_DIR"] = os.path.join(PYFTPSYNC_TEST_FOLDER, "state")
+        try:
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+            opts = {"dry_run": False, "verbose": 1, "journal": True}
+            s = UploadSynchronizer(local, remote, opts)
+            # Simulate a crash before the meta data of the root folder is written
+            flush_meta = local.flush_meta
+            def _flush_meta():
+                if local.cur_dir == local.root_dir:
+                    raise RuntimeError("killed")
+                flush_meta()
+            local.flush_meta = _flush_meta
+            self.assertRaises(RuntimeError, s.run)
+            self.assertFalse(_is_test_file("local/" + DirMetadata.META_FILE_NAME))
+            self.assertEqual(s.get_stats()["journal_records"], 6 + 2)
+
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            stats = s.get_stats()
+            self.assertEqual(stats["journal_replayed"], 4)
+            self.assertEqual(stats["journal_dirs_skipped"], 2)
+            self.assertEqual(stats["files_written"], 0)
+            self.assertTrue(_is_test_file("local/" + DirMetadata.META_FILE_NAME))
+            self.assertEqual(os.listdir(os.environ["PYFTPSYNC_STATE_DIR"]), [])
+        finally:
+            del os.environ["PYFTPSYNC_STATE_DIR"]
+
+    def test_journal_torn_line(self):
+        path = os.path.join(PYFTPSYNC_TEST_FOLDER, "journal.jsonl")
+        with open(path, "wt") as f:
+            f.write('{"a": "copy", "d": "/", "n": "a.txt"}\n{"a": "co')
+        j = SyncJournal(path)
+        self.assertEqual(len(j.open()), 1)
+        j.record("copy", "/", n="b.txt")
+        j.close(False)
+        # The torn line was dropped, so the appended record is readable
+        records = SyncJournal(path).load()
+        self.assertEqual([r["n"] for r in records], ["a.txt", "b.txt"])
+        os.remove(path)
+
+    def test_meta_formats(self):
+        opts = {"dry_run": False, "verbose": 1, "meta_format": "compact", 
+                "meta_gzip": True, "meta_write_behind": True}
+        for files_written, meta_written in ((6, 3), (0, 0)):
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+            s = BiDirSynchronizer(local, remote, opts)
+            s.run()
+            stats = s.get_stats()
+            self.assertEqual(stats["files_written"], files_written)
+            self.assertEqual(stats["conflict_files"], 0)
+            self.assertEqual(stats.get("meta_write_behind", 0), meta_written)
+        path = os.path.join(PYFTPSYNC_TEST_FOLDER, "local", DirMetadata.META_FILE_NAME)
+        with open(path, "rb") as f:
+            data = f.read()
+        self.assertTrue(data.startswith(GZIP_MAGIC))
+        self.assertEqual(len(decode_meta(data)["peer_sync"][remote.get_id()]), 4 + 2)
+
+        meta = {"files": {"a.txt": {"m": 1388577600.5, "s": 3, "u": 1388577601.25}},
+                "peer_sync": {"ftp:x/y": {"a.txt": {"m": 1388577600.0004, "s": 3},
+                                          "sub": {"m": None, "s": None}}},
+                "hashes": {"a.txt": {"i": "801", "s": 3, "m": 1388577600.5,
+                                     "md5": "900150983cd24fb0d6963f7d28e17f72"}},
+                }
+        res = decode_meta(encode_meta(dict(meta), compact=True))
+        self.assertEqual(res["files"], meta["files"])
+        self.assertEqual(res["hashes"], meta["hashes"])
+        self.assertEqual(res["peer_sync"]["ftp:x/y"]["sub"], {"m": None, "s": None})
+        self.assertAlmostEqual(res["peer_sync"]["ftp:x/y"]["a.txt"]["m"], 1388577600.001)
+
+    def test_meta_size(self):
+        meta = _make_meta(1000)
+        sizes = [len(encode_meta(dict(meta), compact=compact, use_gzip=use_gzip))
+                 for compact, use_gzip in ((False, False), (True, False), (True, True))]
+        self.assertTrue(sizes[0] > sizes[1] > sizes[2])
+
+    def test_diff_listings(self):
+        target = FsTarget(PYFTPSYNC_TEST_FOLDER)
+        def _entries(spec):
+            return [DirectoryEntry(target, "", name[:-1], 0, mtime, None) if name.endswith("/")
+                    else FileEntry(target, "", name, size, mtime, None)
+                    for name, size, mtime in spec]
+        t = STAMP_20140101_120000
+        local = _entries([("same.txt", 1, t), ("newer.txt", 1, t + 10), ("older.txt", 1, t),
+                          ("size.txt", 1, t + 0.05), ("local.txt", 1, t), ("dir/", 0, t),
+                          ("both/", 0, t + 99), ("x", 1, t)])
+        remote = _entries([("same.txt", 1, t), ("newer.txt", 1, t), ("older.txt", 1, t + 10),
+                           ("size.txt", 2, t), ("remote.txt", 1, t), ("both/", 0, t),
+                           ("x/", 0, t)])
+        expected = [("both/", "equal"), ("dir/", "local_only"), ("local.txt", "local_only"),
+                    ("newer.txt", "newer"), ("older.txt", "older"),
+                    ("remote.txt", "remote_only"), ("same.txt", "equal"),
+                    ("size.txt", "different"), ("x", "different")]
+        res = diff.diff_listings(local, remote, 0.1)
+        res = [((l or r).name + ("/" if (l or r).is_dir() else ""), status) 
+               for status, l, r in res]
+        self.assertEqual(res, expected)
+
+    def test_scheduler_limits(self):
+        # Bandwidth: ~16.5 kB with a 10 kB/sec bucket (10 kB burst) takes > 0.5 sec
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 1, "max_rate": 10000}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertGreater(stats["upload_bytes_written"], 16384)
+        self.assertGreater(stats["elap_secs"], 0.5)
+        self.assertGreater(stats["sched_throttle_secs"], 0.4)
+        self.assertLessEqual(stats["sched_peak_rate"], 10000 + 10000)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+
+        # Transfer slots: never more than 2 at a time, small files first
+        sched = Scheduler(max_transfers_per_host=2)
+        order = []
+        def _transfer(size):
+            with sched.transfer("example.com", size):
+                order.append(size)
+                time.sleep(0.2)
+        blockers = [threading.Thread(target=_transfer, args=(0,)) for _ in range(2)]
+        for t in blockers:
+            t.start()
+        time.sleep(0.01)
+        threads = [threading.Thread(target=_transfer, args=(size,)) 
+                   for size in (300, 100, 200, 400)]
+        for t in threads:
+            t.start()
+            time.sleep(0.005)
+        for t in blockers + threads:
+            t.join()
+        self.assertEqual(order, [0, 0, 100, 200, 300, 400])
+        self.assertEqual(sched.get_stats()["sched_peak_transfers"], 2)
+
+    def test_watch_sync_dirs(self):
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote"))
+        opts = {"dry_run": False, "verbose": 3}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+
+        watcher = PollingWatcher(local.root_dir, interval=0)
+        self.assertEqual(watcher.poll(0), set())
+        _write_test_file("local/folder1/file1_1.txt", content="changed")
+        _write_test_file("local/folder2/sub/new_file.txt", content="new")
+        self.assertEqual(watcher.poll(0), set(["folder1", "folder2", "folder2/sub"]))
+
+        w = WatchSynchronizer(local, remote, opts)
+        failed = w._sync_dirs(set(["folder1", "folder2", "folder2/sub"]))
+        self.assertEqual(failed, [])
+        stats = w.get_stats()
+        self.assertEqual(stats["files_written"], 2)
+        self.assertEqual(stats["dirs_created"], 1)
+        self.assertDictEqual(_get_test_folder("local"), _get_test_folder("remote"))
+
 
 #===============================================================================
 # BidirSyncTest
@@ -410,6 +865,30 @@ class BidirSpecialTest(TestCase):
         self.assertDictEqual(_get_test_folder("local"), expect_local)
         self.assertDictEqual(_get_test_folder("remote"), expect_local)
         
+
+#===============================================================================
+# BenchmarkTest
+#===============================================================================
+class BenchmarkTest(TestCase):
+    """Print timings (set DO_BENCHMARKS to run)."""
+    def setUp(self):
+        if not DO_BENCHMARKS:
+            self.skipTest("DO_BENCHMARKS is not set")
+
+    def test_meta_benchmark(self):
+        """Meta data bytes and encode/decode time per 10k entries."""
+        meta = _make_meta(10000)
+        for compact, use_gzip in ((False, False), (True, False), (True, True)):
+            start = time.time()
+            data = encode_meta(dict(meta), compact=compact, use_gzip=use_gzip)
+            elap_write = time.time() - start
+            start = time.time()
+            decode_meta(data)
+            elap_read = time.time() - start
+            print("Meta data (compact=%s, gzip=%s): %s bytes, write %0.3f sec, read %0.3f sec" 
+                  % (compact, use_gzip, len(data), elap_write, elap_read), file=sys.stderr)
+
+
 #===============================================================================
 # Main
 #===============================================================================
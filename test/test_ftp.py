@@ -6,17 +6,29 @@ from __future__ import print_function
 
 from ftplib import FTP
 from pprint import pprint
+import io
+import os
+import socket
+import threading
+import time
 from unittest import TestCase
 import unittest
+import zlib
 
+from ftpsync import ftp_target
 from ftpsync.ftp_target import *  # @UnusedWildImport
 from ftpsync.targets import *  # @UnusedWildImport
 
 from ftpsync.synchronizers import DownloadSynchronizer, UploadSynchronizer, \
-    BiDirSynchronizer
-from test.tools import PYFTPSYNC_TEST_FTP_URL, prepare_fixtures, \
+    BiDirSynchronizer, MultiUploadSynchronizer
+from ftpsync.jobs import JobRunner
+from ftpsync.agent import AGENT_SUPPORTED, AgentClient, FtpAgent
+from ftpsync.history import PerfHistory, tune
+from ftpsync.pyftpsync import format_dry_run_report
+from test.tools import PYFTPSYNC_TEST_FTP_URL, prepare_fixtures_1, \
     PYFTPSYNC_TEST_FOLDER, _get_test_file_date, STAMP_20140101_120000, \
-    _empty_folder, _write_test_file, _touch_test_file
+    _empty_folder, _write_test_file, _touch_test_file, _remove_test_file, \
+    _is_test_file, FakeFtpServer
 
 
 DO_BENCHMARKS = False #True
@@ -94,7 +106,7 @@ class FtpTargetTest(TestCase):
         self.assertTrue("/test" in ftp_url or "/temp" in ftp_url, "FTP target path must include '/test' or '/temp'")
 
         # Create local /temp1 folder with files and empty /temp2 folder
-        prepare_fixtures()
+        prepare_fixtures_1()
 
 #        print(ftp_url)
         
@@ -295,7 +307,7 @@ class BenchmarkTest(TestCase):
         self.assertTrue("/test" in ftp_url or "/temp" in ftp_url, "FTP target path must include '/test' or '/temp'")
 
         # Create local /temp1 folder with files and empty /temp2 folder
-        prepare_fixtures()
+        prepare_fixtures_1()
 
         self.remote = make_target(ftp_url)
         self.remote.open()
@@ -353,6 +365,25 @@ class BenchmarkTest(TestCase):
         """Transfer 20 KiB in one large file."""
         self._transfer_files(count=1, size=20*1024)
 
+    def test_delete_large_tree(self):
+        """Remove a remote tree of 10 folders with 50 files each (--delete)."""
+        temp1_path = os.path.join(PYFTPSYNC_TEST_FOLDER, "temp1")
+        _empty_folder(temp1_path) # remove standard test files 
+        for i in range(10):
+            for j in range(50):
+                _write_test_file("temp1/tree/folder_%s/file_%s.txt" % (i, j), size=10)
+
+        local = FsTarget(temp1_path)
+        opts = {"force": False, "delete": False, "verbose": 1, "dry_run": False}
+        s = UploadSynchronizer(local, self.remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 500)
+
+        start = time.time()
+        self.remote.rmdir("tree")
+        elap = time.time() - start
+        print("Delete 10 x 50 files took %0.2f sec" % elap, file=sys.stderr)
+
 #===============================================================================
 # PlainTest
 #===============================================================================
@@ -393,6 +424,732 @@ class PlainTest(TestCase):
         self.assertRaises(ValueError, make_target, "http://example.com/test")
         self.assertRaises(ValueError, make_target, "https://example.com/test")
 
+    def test_retry_transient(self):
+        t = make_target("ftp://ftp.example.com/target/folder", 
+                        {"retries": 2, "retry_delay": 0})
+        calls = []
+        class _FailingFTP(object):
+            def pwd(self):
+                calls.append("pwd")
+                if calls.count("pwd") < 3:
+                    raise ftplib.error_temp("421 Timeout")
+                return "/target/folder"
+        t.ftp = _FailingFTP()
+        t.reconnect = lambda: calls.append("reconnect")
+        self.assertEqual(t.pwd(), "/target/folder")
+        self.assertEqual(calls, ["pwd", "reconnect", "pwd", "reconnect", "pwd"])
+
+        # Permanent errors are not retried
+        del calls[:]
+        def _fail():
+            calls.append("pwd")
+            raise ftplib.error_perm("550 Permission denied")
+        t.ftp.pwd = _fail
+        self.assertRaises(ftplib.error_perm, t.pwd)
+        self.assertEqual(calls, ["pwd"])
+
+        # ... and neither are local errors
+        del calls[:]
+        def _fail_local():
+            calls.append("pwd")
+            raise IOError("No space left on device")
+        t.ftp.pwd = _fail_local
+        self.assertRaises(IOError, t.pwd)
+        self.assertEqual(calls, ["pwd"])
+
+    def test_retry_write_file(self):
+        t = make_target("ftp://ftp.example.com/target/folder", 
+                        {"retries": 2, "retry_delay": 0})
+        calls = []
+        class _FailingFTP(object):
+            def storbinary(self, cmd, fp, blocksize, callback):
+                calls.append(cmd)
+                while True:
+                    buf = fp.read(blocksize)
+                    if not buf:
+                        break
+                    callback(buf)
+                    if len(calls) == 1:
+                        raise EOFError("connection dropped")
+        t.ftp = _FailingFTP()
+        t.reconnect = lambda: calls.append("reconnect")
+        t._sync_cwd = lambda: None
+        t._use_mode_z = lambda name, fp_src=None: False
+        t._use_sendfile = lambda fp_src: False
+        written = []
+        t.write_file("file.txt", io.BytesIO(b"x" * 10), blocksize=4, 
+                     callback=lambda data: written.append(len(data)))
+        self.assertEqual(calls, ["STOR file.txt", "reconnect", "STOR file.txt"])
+        # The first block was sent twice, but is reported once
+        self.assertEqual(written, [4, 4, 2])
+
+    def test_set_mtime(self):
+        sent = []
+        class _FakeFTP(object):
+            def sendcmd(self, cmd):
+                sent.append(cmd)
+                if cmd.startswith("MFMT"):
+                    return "213 Modify=20140101120000; file1.txt"
+                raise ftplib.error_perm("500 Unknown command")
+
+        def _make_target(host, features):
+            t = make_target("ftp://%s/target/folder" % host, {"host_info_cache": False})
+            t.ftp = _FakeFTP()
+            t.features = features
+            t.cur_dir = t.root_dir
+            t.cur_dir_meta = DirMetadata(t)
+            t._init_set_time()
+            return t
+
+        # MFMT is announced by FEAT: don't store mtime in meta data
+        t = _make_target("mfmt.example.com", {"MFMT": ""})
+        self.assertTrue(t.support_set_time)
+        t.set_mtime("file1.txt", STAMP_20140101_120000, 3)
+        self.assertEqual(sent, ["MFMT 20140101120000 file1.txt"])
+        self.assertEqual(t.cur_dir_meta.list, {})
+        self.assertEqual(t.mtime_precision, 1)
+
+        # SITE UTIME and MDTM are tried once, then we fall back to meta data
+        del sent[:]
+        t = _make_target("nomfmt.example.com", {})
+        self.assertEqual(t.support_set_time, None)
+        t.set_mtime("file1.txt", STAMP_20140101_120000, 3)
+        t.set_mtime("file2.txt", STAMP_20140101_120000, 3)
+        self.assertEqual(sent, ["SITE UTIME 20140101120000 file1.txt", 
+                                "MDTM 20140101120000 file1.txt"])
+        self.assertEqual(sorted(t.cur_dir_meta.list.keys()), ["file1.txt", "file2.txt"])
+        self.assertEqual(t.support_set_time, False)
+
+    def test_probe_server(self):
+        sent = []
+        class _FakeFTP(object):
+            encoding = "latin-1"
+            def sendcmd(self, cmd):
+                sent.append(cmd)
+                if cmd == "FEAT":
+                    return ("211-Features:\n MFMT\n MODE Z\n REST STREAM\n UTF8\n"
+                            " MLST type*;size*;modify*;perm*;unique;\n 211 End")
+                elif cmd == "SYST":
+                    return "215 UNIX Type: L8"
+                return "200 OK"
+
+        state_dir = os.path.join(PYFTPSYNC_TEST_FOLDER, "state")
+        if os.path.isdir(state_dir):
+            _empty_folder(state_dir)
+        os.environ["PYFTPSYNC_STATE_DIR"] = state_dir
+        try:
+            FtpTarget.HOST_INFO.clear()
+            FtpTarget._host_info_loaded = False
+            t = make_target("ftp://probe.example.com/target")
+            t.ftp = _FakeFTP()
+            t._probe_server()
+            self.assertEqual(sent, ["FEAT", "SYST", "OPTS UTF8 ON", 
+                                    "OPTS MLST type;size;modify;unique;"])
+            caps = t.get_capabilities()
+            self.assertEqual(caps["set_time"], "MFMT")
+            self.assertTrue(caps["rest_stream"])
+            self.assertTrue(caps["mode_z"])
+            self.assertTrue(t.case_sensitive)
+            self.assertEqual(t.time_ofs, 0)
+            self.assertEqual(t.ftp.encoding, "utf-8")
+            self.assertTrue(os.path.isfile(os.path.join(state_dir, HOST_INFO_FILE_NAME)))
+
+            # A new process reads the persisted info and skips FEAT and SYST
+            del sent[:]
+            FtpTarget.HOST_INFO.clear()
+            FtpTarget._host_info_loaded = False
+            t = make_target("ftp://probe.example.com/target")
+            t.ftp = _FakeFTP()
+            t._probe_server()
+            self.assertEqual(sent, ["OPTS UTF8 ON", "OPTS MLST type;size;modify;unique;"])
+            self.assertTrue(t.support_set_time)
+
+            # Expired entries are probed again
+            del sent[:]
+            FtpTarget.HOST_INFO.clear()
+            FtpTarget._host_info_loaded = False
+            t = make_target("ftp://probe.example.com/target", {"host_info_ttl": 0})
+            t.ftp = _FakeFTP()
+            t._probe_server()
+            self.assertEqual(sent[:2], ["FEAT", "SYST"])
+        finally:
+            del os.environ["PYFTPSYNC_STATE_DIR"]
+            FtpTarget.HOST_INFO.clear()
+            FtpTarget._host_info_loaded = False
+
+    def test_mode_z(self):
+        self.assertTrue(is_compressible("index.html"))
+        self.assertFalse(is_compressible("photo.jpg", b"abc" * 100))
+        self.assertTrue(is_compressible("data.bin", b"abc" * 100))
+        self.assertFalse(is_compressible("data.bin", os.urandom(4096)))
+        self.assertFalse(is_compressible("data.bin"))
+
+        sent = []
+        wire = []
+        class _FakeConn(object):
+            def sendall(self, data):
+                if data:
+                    wire.append(data)
+            def recv(self, size):
+                return wire.pop(0) if wire else b""
+            def close(self):
+                pass
+        class _FakeFTP(object):
+            def voidcmd(self, cmd):
+                sent.append(cmd)
+            def transfercmd(self, cmd):
+                sent.append(cmd)
+                return _FakeConn()
+            def voidresp(self):
+                pass
+
+        t = make_target("ftp://modez.example.com/target", 
+                        {"mode_z": True, "host_info_cache": False})
+        t.ftp = _FakeFTP()
+        t._get_host_info()["mode_z"] = True
+        t.cur_dir = t.root_dir
+        content = b"<html>" + b"<p>Hello world</p>" * 1000 + b"</html>"
+        t.write_file("index.html", io.BytesIO(content))
+        self.assertEqual(sent, ["TYPE I", "MODE Z", "STOR index.html", "MODE S"])
+        self.assertEqual(zlib.decompress(b"".join(wire)), content)
+        self.assertTrue(len(b"".join(wire)) < len(content) / 10)
+
+        del sent[:]
+        self.assertEqual(t.open_readable("index.html").read(), content)
+        self.assertEqual(sent, ["TYPE I", "MODE Z", "RETR index.html", "MODE S"])
+        FtpTarget.HOST_INFO.clear()
+
+    def test_parse_mlsd_line(self):
+        name, res_type, size, mtime, unique = parse_mlsd_line(
+            "type=file;size=123;modify=20140101120000.123;unique=801U4; file 1.txt")
+        self.assertEqual(name, "file 1.txt")
+        self.assertEqual(res_type, "file")
+        self.assertEqual(size, 123)
+        self.assertEqual(mtime, STAMP_20140101_120000)
+        self.assertEqual(unique, "801U4")
+
+        name, res_type, size, mtime, unique = parse_mlsd_line("Type=Dir;Modify=20140101120000; sub")
+        self.assertEqual(name, "sub")
+        self.assertEqual(res_type, "dir")
+        self.assertEqual(size, None)
+
+
+#===============================================================================
+# FakeServerTest
+#===============================================================================
+class FakeServerTest(TestCase):
+    """Tests that run against a local FakeFtpServer."""
+    def setUp(self):
+        _empty_folder(PYFTPSYNC_TEST_FOLDER)
+        FtpTarget.HOST_INFO.clear()
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.stop()
+        FtpTarget.HOST_INFO.clear()
+        os.environ.pop("PYFTPSYNC_STATE_DIR", None)
+
+    def _start_server(self, **attrs):
+        """Serve the 'remote' test folder (stopping a previous server)."""
+        if self.server:
+            self.server.stop()
+        root_dir = os.path.join(PYFTPSYNC_TEST_FOLDER, "remote")
+        if not os.path.isdir(root_dir):
+            os.makedirs(root_dir)
+        self.server = FakeFtpServer(root_dir)
+        for name, value in attrs.items():
+            setattr(self.server, name, value)
+        self.server.start()
+        return self.server
+
+    def test_async_upload(self):
+        try:
+            from ftpsync.async_ftp import AsyncFtpTarget, AsyncUploadSynchronizer
+        except (ImportError, SyntaxError):
+            self.skipTest("asyncio target requires Python 3.5+")
+        for i in range(20):
+            _write_test_file("local/file%s.txt" % i, content="content %s" % i, 
+                             dt="2014-01-01 12:00:00")
+        _write_test_file("local/folder1/sub/file1.txt", dt="2014-01-01 12:00:00")
+        _write_test_file("remote/obsolete.txt")
+        for name in ("file.txt", DirMetadata.META_FILE_NAME, DirMetadata.DEBUG_META_FILE_NAME):
+            _write_test_file("remote/obsolete_dir/" + name, content="{}")
+        server = self._start_server()
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = AsyncFtpTarget("/", "127.0.0.1", server.server_address[1], 
+                                extra_opts={"connections": 4})
+        opts = {"dry_run": False, "verbose": 1, "delete": True}
+        s = AsyncUploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 21)
+        self.assertEqual(stats["files_deleted"], 1)
+        self.assertEqual(stats["dirs_deleted"], 1)
+        self.assertEqual(stats["dirs_created"], 2)
+        self.assertTrue(1 < stats["ftp_connections"] <= 4)
+        # Server features are probed once, although connections are opened concurrently
+        self.assertEqual(server.commands.count("FEAT"), 1)
+        # (uploads on connections that waited for the probe use MFMT, too)
+        for i in range(20):
+            self.assertEqual(_get_test_file_date("remote/file%s.txt" % i), 
+                             STAMP_20140101_120000)
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                     "remote", "obsolete.txt")))
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                     "remote", "obsolete_dir")))
+        # Second run: nothing to do
+        remote = AsyncFtpTarget("/", "127.0.0.1", server.server_address[1])
+        s = AsyncUploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 0)
+        # Same mtime, but different size: reported, not uploaded
+        _write_test_file("local/file0.txt", content="changed", dt="2014-01-01 12:00:00")
+        remote = AsyncFtpTarget("/", "127.0.0.1", server.server_address[1])
+        s = AsyncUploadSynchronizer(local, remote, opts)
+        s.run()
+        self.assertEqual(s.get_stats()["files_written"], 0)
+
+        # Options that need the per-file copy path are rejected
+        for name, value in (("compare", "hash"), ("verify", "auto"), ("journal", True), 
+                            ("order", "smallest"), ("detect_moves", True), 
+                            ("max_rate", 1000)):
+            self.assertRaises(ValueError, AsyncUploadSynchronizer, local, remote, 
+                              dict(opts, **{name: value}))
+
+    def test_connection_pool(self):
+        _write_test_file("local/file1.txt", dt="2014-01-01 12:00:00")
+        _write_test_file("remote/site1/file2.txt")
+        _write_test_file("remote/site2/file2.txt")
+        # Deleting many files must not open parallel connections either
+        for i in range(40):
+            _write_test_file("remote/site2/old/file%s.txt" % i)
+        server = self._start_server()
+        config = {"max_jobs": 2,
+                  "max_connections_per_host": 1,
+                  "defaults": {"delete": True},
+                  "jobs": [{"local": os.path.join(PYFTPSYNC_TEST_FOLDER, "local"),
+                            "remote": server.get_url("/site%s" % i),
+                            "options": {"host_info_cache": False}}
+                           for i in (1, 2)]}
+        runner = JobRunner(config, {"dry_run": False, "verbose": 1})
+        self.assertTrue(runner.run())
+        stats = runner.get_stats()
+        self.assertEqual(stats["files_written"], 2)
+        self.assertEqual(stats["dirs_deleted"], 1)
+        # The second job waited for the first and reused its connection
+        self.assertEqual(stats["pool_connections_reused"], 1)
+        self.assertEqual(server.commands.count("USER anonymous"), 1)
+
+    def test_max_connections(self):
+        _write_test_file("local/big.txt", content="x" * 2000)
+        for i in range(4):
+            _write_test_file("local/sub%s/file.txt" % i)
+        for i in range(40):
+            _write_test_file("remote/site/old/file%s.txt" % i)
+        server = self._start_server()
+        for max_connections, logins in ((None, 3), (1, 1)):
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+            opts = {"dry_run": False, "verbose": 1, "delete": True, 
+                    "bulk_list": True, "order": "smallest", 
+                    "large_file_size": 1000, "large_lanes": 2,
+                    "max_connections": max_connections}
+            del server.commands[:]
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            remote.close()
+            self.assertEqual(s.get_stats()["dirs_deleted"], 1)
+            if max_connections:
+                # Extra connections (lanes, listing, deleting) were refused
+                self.assertEqual(server.commands.count("USER anonymous"), logins)
+            else:
+                self.assertGreaterEqual(server.commands.count("USER anonymous"), logins)
+            self.assertEqual(FtpTarget.HOST_CONNECTIONS, {})
+            _empty_folder(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+            for i in range(40):
+                _write_test_file("remote/site/old/file%s.txt" % i)
+
+    def test_atomic_upload(self):
+        _write_test_file("local/file1.txt", dt="2014-01-01 12:00:00")
+        _write_test_file("local/sub/file2.txt", dt="2014-01-01 12:00:00")
+        _write_test_file("remote/site/.file3.txt.pyftpsync-tmp", content="left over",
+                         dt="2014-01-01 12:00:00")
+        # May be an upload of another client that is still in progress
+        _write_test_file("remote/site/.file4.txt.pyftpsync-tmp", content="in flight")
+        server = self._start_server()
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        opts = {"dry_run": False, "verbose": 1, "atomic": "plan"}
+        s = UploadSynchronizer(local, remote, opts)
+        s.run()
+        stats = s.get_stats()
+        self.assertEqual(stats["files_written"], 2)
+        self.assertEqual(stats["atomic_renames"], 2)
+        self.assertEqual(stats["atomic_temp_files_removed"], 1)
+        stors = [c for c in server.commands if c.startswith("STOR ")]
+        self.assertEqual(sorted(stors), ["STOR .file1.txt.pyftpsync-tmp", 
+                                         "STOR .file2.txt.pyftpsync-tmp"])
+        # All renames are sent at the end of the run
+        renames = [c for c in server.commands if c.startswith("RN")]
+        self.assertEqual(server.commands[-len(renames):], renames)
+        self.assertEqual(renames[0], "RNFR /site/.file1.txt.pyftpsync-tmp")
+        self.assertEqual(_get_test_file_date("remote/site/sub/file2.txt"), STAMP_20140101_120000)
+        self.assertEqual(sorted(os.listdir(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote/site"))),
+                         [".file4.txt.pyftpsync-tmp", "file1.txt", "sub"])
+        remote.close()
+
+        # Incremental updates (watch mode) publish their uploads, too
+        _write_test_file("local/sub/file5.txt")
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        s = UploadSynchronizer(local, remote, opts)
+        self.assertEqual(s.sync_dirs(["sub"]), [])
+        self.assertEqual(sorted(os.listdir(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote/site/sub"))),
+                         ["file2.txt", "file5.txt"])
+        remote.close()
+
+    def test_bulk_list(self):
+        for name in ("file1.txt", "sub1/file2.txt", "sub1/sub2/file3.txt", "sub3/file4.txt"):
+            _write_test_file("local/" + name, dt="2014-01-01 12:00:00")
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        server = self._start_server()
+        opts = {"dry_run": False, "verbose": 1, "bulk_list": True,
+                "list_connections": 2}
+        for i, files_written in enumerate((4, 0, 1)):
+            if i == 2:
+                _write_test_file("local/sub1/sub2/new.txt")
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+            del server.commands[:]
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            remote.close()
+            stats = s.get_stats()
+            self.assertEqual(stats["files_written"], files_written)
+            mlsd = [c for c in server.commands if c.startswith("MLSD")]
+            cwd = [c for c in server.commands if c.startswith("CWD")]
+            if i == 1:
+                # Unchanged tree: one MLSD per folder, no navigation
+                self.assertEqual(stats["tree_dirs_listed"], 4)
+                self.assertEqual(stats["tree_dirs_cached"], 4)
+                self.assertEqual(sorted(mlsd), ["MLSD /site", "MLSD /site/sub1",
+                                                "MLSD /site/sub1/sub2", "MLSD /site/sub3"])
+                # (listing connections also log in to /site)
+                self.assertEqual(set(cwd), set(["CWD /site"]))
+            elif i == 2:
+                self.assertEqual(set(cwd), set(["CWD /site", "CWD /site/sub1/sub2"]))
+        self.assertTrue(os.path.isfile(os.path.join(
+            PYFTPSYNC_TEST_FOLDER, "remote", "site", "sub1", "sub2", "new.txt")))
+
+        # Targets may be used without a synchronizer
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        remote.open()
+        self.assertTrue(remote.prefetch_tree())
+        self.assertEqual(len(remote.get_dir()), 3)
+        remote.close()
+
+    def test_sendfile_upload(self):
+        data = os.urandom(300 * 1000)
+        for name in ("big.bin", "sub/small.txt"):
+            path = os.path.join(PYFTPSYNC_TEST_FOLDER, "local", name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data if name == "big.bin" else b"hello\n")
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        server = self._start_server()
+        orig_blocksize = ftp_target.SENDFILE_BLOCKSIZE
+        ftp_target.SENDFILE_BLOCKSIZE = 100 * 1000
+        try:
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+            s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1})
+            s.run()
+            remote.close()
+            stats = s.get_stats()
+            has_sendfile = hasattr(socket.socket, "sendfile")
+            self.assertEqual(stats.get("sendfile_files", 0), 2 if has_sendfile else 0)
+            self.assertEqual(stats["upload_bytes_written"], len(data) + 6)
+            with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site", "big.bin"), "rb") as f:
+                self.assertEqual(f.read(), data)
+            # Throttled reads can't use sendfile
+            _write_test_file("local/sub/small.txt", content="changed", dt="2030-01-01 12:00:00")
+            remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+            s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                                   "max_rate": 10 * 1000 * 1000})
+            s.run()
+            remote.close()
+            self.assertEqual(s.get_stats()["files_written"], 1)
+            self.assertEqual(s.get_stats().get("sendfile_files", 0), 0)
+        finally:
+            ftp_target.SENDFILE_BLOCKSIZE = orig_blocksize
+
+    @unittest.skipUnless(AGENT_SUPPORTED, "requires Unix sockets and sendmsg()")
+    def test_agent(self):
+        _write_test_file("local/file1.txt", dt="2014-01-01 12:00:00")
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        os.environ["PYFTPSYNC_STATE_DIR"] = os.path.join(PYFTPSYNC_TEST_FOLDER, "state")
+        server = self._start_server()
+        agent = FtpAgent(check_interval=0.1, verbose=0)
+        thread = threading.Thread(target=agent.serve_forever)
+        thread.start()
+        try:
+            while AgentClient().get_stats() is None:
+                time.sleep(0.01)
+            for i in range(2):
+                del server.commands[:]
+                local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+                remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+                s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                                       "agent": True})
+                s.run()
+                remote.close()
+                self.assertEqual(s.get_stats()["files_written"], 1 - i)
+                self.assertNotIn("QUIT", server.commands)
+                # The second run reuses the logged-in connection
+                self.assertEqual("USER anonymous" in server.commands, i == 0)
+                self.assertEqual(s.get_stats().get("agent_connections_reused", 0), i)
+            stats = AgentClient().get_stats()
+            self.assertEqual(stats["agent_idle_connections"], 1)
+            self.assertEqual(stats["agent_connections_reused"], 1)
+            # Idle connections are expired
+            agent.idle_timeout = 0
+            while AgentClient().get_stats()["agent_idle_connections"]:
+                time.sleep(0.05)
+            self.assertIn("QUIT", server.commands)
+            self.assertTrue(AgentClient().stop())
+            thread.join()
+            self.assertFalse(os.path.exists(agent.path))
+            self.assertIsNone(AgentClient().get_stats())
+        finally:
+            agent.stop()
+            thread.join()
+
+    def test_pipeline(self):
+        for ignore_noop in (False, True):
+            _empty_folder(PYFTPSYNC_TEST_FOLDER)
+            for i in range(40):
+                _write_test_file("remote/site/file%s.txt" % i)
+            for i in range(15):
+                _write_test_file("remote/site/old/file%s.txt" % i)
+            _write_test_file("local/a/b/c/file.txt")
+            server = self._start_server(ignore_noop=ignore_noop)
+            orig_timeout = ftp_target.PIPELINE_PROBE_TIMEOUT
+            ftp_target.PIPELINE_PROBE_TIMEOUT = 0.2
+            try:
+                FtpTarget.HOST_INFO.clear()
+                local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+                remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+                s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                                       "delete": True})
+                s.run()
+                remote.close()
+                stats = s.get_stats()
+                self.assertEqual(stats["files_deleted"], 40)
+                self.assertEqual(stats["dirs_deleted"], 1)
+                names = os.listdir(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+                self.assertEqual([n for n in names if not n.startswith(".")], ["a"])
+                self.assertTrue(os.path.isfile(os.path.join(
+                    PYFTPSYNC_TEST_FOLDER, "remote", "site", "a", "b", "c", "file.txt")))
+                info = FtpTarget.HOST_INFO["127.0.0.1:%s" % server.server_address[1]]
+                self.assertEqual(info["pipelining"], not ignore_noop)
+                if ignore_noop:
+                    # Fallback: one command per round trip
+                    self.assertNotIn("pipeline_batches", stats)
+                else:
+                    # DELE (40 + 15), RMD, MKD, and CWD commands
+                    self.assertGreaterEqual(stats["pipeline_cmds"], 59)
+                    self.assertLessEqual(stats["pipeline_batches"], 8)
+                    self.assertIn("MKD /site/a/b/c", server.commands)
+            finally:
+                ftp_target.PIPELINE_PROBE_TIMEOUT = orig_timeout
+
+    def test_pipeline_incremental(self):
+        _write_test_file("local/keep.txt")
+        _write_test_file("remote/site/gone.txt")
+        server = self._start_server()
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                               "delete": True})
+        # Watch mode: deletions are sent before sync_dirs() returns
+        self.assertEqual(s.sync_dirs([""]), [])
+        self.assertEqual(remote._batch, [])
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                     "remote", "site", "gone.txt")))
+        # ... and keep_alive() sends anything still queued before NOOP
+        _write_test_file("remote/site/gone2.txt")
+        remote._queue_cmd("DELE /site/gone2.txt")
+        remote.keep_alive()
+        self.assertEqual(server.commands[-1], "NOOP")
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                     "remote", "site", "gone2.txt")))
+        remote.close()
+
+    def test_pipeline_errors(self):
+        _write_test_file("local/a.txt")
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        server = self._start_server()
+        opts = {"dry_run": False, "verbose": 1}
+        def _run():
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+            s = BiDirSynchronizer(local, remote, opts)
+            try:
+                s.run()
+            finally:
+                remote.close()
+            return s.get_stats()
+        _run()
+        _remove_test_file("local/a.txt")
+        # A rejected (queued) DELE keeps the sync info ...
+        server.denied.add("DELE")
+        self.assertRaises(ftplib.error_perm, _run)
+        self.assertTrue(_is_test_file("remote/site/a.txt"))
+        # ... so the next run deletes the file again, instead of restoring it
+        server.denied.clear()
+        stats = _run()
+        self.assertEqual(stats["files_deleted"], 1)
+        self.assertFalse(_is_test_file("remote/site/a.txt"))
+        self.assertFalse(_is_test_file("local/a.txt"))
+
+        # After a reconnect, only errors of commands that had run already
+        # are ignored
+        _write_test_file("remote/site/b.txt")
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        remote.open()
+        server.denied.add("DELE")
+        remote._in_retry = True
+        remote._queue_cmd("DELE /site/a.txt")
+        remote._flush_batch()
+        remote._queue_cmd("DELE /site/b.txt")
+        self.assertRaises(ftplib.error_perm, remote._flush_batch)
+        self.assertEqual(remote._batch, [])
+        remote.close()
+
+    def test_dry_run_eta(self):
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "big.bin"), "wb") as f:
+            f.write(os.urandom(500 * 1000))
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        os.environ["PYFTPSYNC_STATE_DIR"] = os.path.join(PYFTPSYNC_TEST_FOLDER, "state")
+        server = self._start_server()
+        def _run(dry_run, **opts):
+            local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+            remote = make_target(server.get_url("/site"))
+            opts.update({"dry_run": dry_run, "verbose": 1, "delete": True})
+            s = UploadSynchronizer(local, remote, opts)
+            s.run()
+            remote.close()
+            return s
+        # Nothing is known about this host yet
+        self.assertIsNone(_run(True).get_dry_run_report()["eta_secs"])
+        _run(False)
+        host_key = "127.0.0.1:%s" % server.server_address[1]
+        records = PerfHistory().get_records(host_key)
+        self.assertEqual(len(records), 1)
+        self.assertGreater(records[0]["upload_rate"], 0)
+        self.assertGreater(records[0]["rtt"], 0)
+
+        _write_test_file("local/sub/new.txt", content="x" * 1000)
+        _write_test_file("remote/site/old.txt")
+        report = _run(True).get_dry_run_report()
+        self.assertEqual(report["actions"], {"upload": {"files": 1, "bytes": 1000, "dirs": 1},
+                                             "delete": {"files": 1, "bytes": 0, "dirs": 0}})
+        self.assertEqual(report["dirs_touched"], 1)
+        self.assertGreater(report["eta_secs"], 0)
+        self.assertIn("ETA:", format_dry_run_report(report))
+        # --no-perf-history: no estimate
+        self.assertIsNone(_run(True, perf_history=False).get_dry_run_report()["eta_secs"])
+
+    def test_auto_tuning(self):
+        # 2 connections were 50% faster than 1, so 3 are tried next
+        records = [{"rtt": .01, "upload_rate": 4e6, "connections": 1, "throughput": 4e6},
+                   {"rtt": .01, "upload_rate": 3e6, "connections": 2, "throughput": 6e6}]
+        self.assertEqual(tune(records), {"connections": 3, "blocksize": 32768,
+                                         "large_file_size": 4 * 1024 * 1024})
+        # ... unless the 3rd one added nothing or caused retries
+        self.assertEqual(tune(records + [{"connections": 3, "throughput": 6e6}])["connections"], 2)
+        records.append({"connections": 3, "throughput": 8e6, "error_rate": .5})
+        self.assertEqual(tune(records)["connections"], 2)
+        self.assertEqual(tune([{"rtt": .01}]), {})
+
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "big.bin"), "wb") as f:
+            f.write(os.urandom(300 * 1000))
+        _write_test_file("local/small.txt")
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "remote", "site"))
+        os.environ["PYFTPSYNC_STATE_DIR"] = os.path.join(PYFTPSYNC_TEST_FOLDER, "state")
+        server = self._start_server()
+        host_key = "127.0.0.1:%s" % server.server_address[1]
+        history = PerfHistory()
+        for r in records[:2]:
+            history.add_record(host_key, r)
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = make_target(server.get_url("/site"))
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                               "order": "largest", "blocksize": 8192})
+        s.run()
+        remote.close()
+        # Options that were passed explicitly are not tuned
+        self.assertEqual(s.tuning, {"large_lanes": 2, "large_file_size": 4 * 1024 * 1024})
+        self.assertEqual(s.get_stats()["files_written"], 2)
+        record = PerfHistory().get_records(host_key)[-1]
+        self.assertEqual(record["connections"], 1) # no file was 'large'
+        self.assertGreater(record["throughput"], 0)
+        self.assertEqual(record["error_rate"], 0)
+
+    def test_verify_transfers(self):
+        os.makedirs(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        with open(os.path.join(PYFTPSYNC_TEST_FOLDER, "local", "big.bin"), "wb") as f:
+            f.write(os.urandom(100 * 1000))
+        _write_test_file("local/small.txt", dt="2014-01-01 12:00:00")
+        _write_test_file("remote/site/new.txt", dt="2030-01-01 12:00:00")
+        server = self._start_server(features=["XMD5"])
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        s = BiDirSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                              "verify": "auto"})
+        s.run()
+        remote.close()
+        stats = s.get_stats()
+        # Uploads are checked against the new file, downloads against the source
+        self.assertEqual(stats["files_written"], 3)
+        self.assertEqual(stats["verify_files"], 3)
+        self.assertEqual(len([c for c in server.commands if c.startswith("XMD5")]), 3)
+
+        # A damaged upload is removed
+        _write_test_file("local/small.txt", content="changed", dt="2030-01-01 12:00:00")
+        remote = make_target(server.get_url("/site"), {"host_info_cache": False})
+        remote.get_hash = lambda entry, algo: "0" * 32
+        s = UploadSynchronizer(local, remote, {"dry_run": False, "verbose": 1,
+                                               "verify": "md5"})
+        self.assertRaises(RuntimeError, s.run)
+        remote.close()
+        self.assertEqual(s.get_stats()["verify_mismatches"], 1)
+        self.assertFalse(os.path.exists(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                     "remote", "site", "small.txt")))
+
+    def test_upload_mirrors(self):
+        _write_test_file("local/index.html")
+        for name in ("m1", "m2"):
+            _write_test_file("remote/%s/gone.txt" % name)
+        server = self._start_server()
+        local = FsTarget(os.path.join(PYFTPSYNC_TEST_FOLDER, "local"))
+        mirrors = [make_target(server.get_url("/%s" % name), {"host_info_cache": False})
+                   for name in ("m1", "m2")]
+        s = MultiUploadSynchronizer(local, mirrors, {"dry_run": False, "verbose": 1,
+                                                     "delete": True, "atomic": "plan"})
+        s.run()
+        # Queued DELEs were sent and temporary files renamed before run() returned
+        for name in ("m1", "m2"):
+            self.assertEqual(sorted(os.listdir(os.path.join(PYFTPSYNC_TEST_FOLDER, 
+                                                            "remote", name))), 
+                             ["index.html"])
+        self.assertEqual(s.get_stats()["files_deleted"], 2)
+        for remote in mirrors:
+            remote.close()
+
 
 #===============================================================================
 # Main
@@ -6,10 +6,19 @@ from __future__ import print_function
 
 import calendar
 import datetime
+import hashlib
 import os
+import posixpath
 from pprint import pprint
 import shutil
+import socket
 import tempfile
+import threading
+import time
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver  # Python 2
 from ftpsync.targets import to_text, to_str, DirMetadata, FsTarget
 from ftpsync.synchronizers import BiDirSynchronizer
 
@@ -126,6 +135,213 @@ def _get_test_folder(folder_name):
     return file_map
 
 
+#===============================================================================
+# FakeFtpServer
+#===============================================================================
+class _FakeFtpHandler(socketserver.StreamRequestHandler):
+    """Minimal FTP protocol (anonymous login, passive mode) on top of a local folder."""
+
+    def _reply(self, msg):
+        self.wfile.write((msg + "\r\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def _path(self, arg):
+        path = posixpath.normpath(posixpath.join(self.cur_dir, arg or "."))
+        return os.path.join(self.server.root_dir, path.lstrip("/").replace("/", os.sep))
+
+    def _accept_data(self):
+        self._reply("150 Opening data connection")
+        conn, _ = self.data_sock.accept()
+        self.data_sock.close()
+        self.data_sock = None
+        return conn
+
+    def handle(self):
+        self.cur_dir = "/"
+        self.data_sock = None
+        self.rename_from = None
+        self._reply("220 Fake FTP server")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            line = line.decode("utf-8").rstrip("\r\n")
+            cmd, _, arg = line.partition(" ")
+            cmd = cmd.upper()
+            self.server.commands.append(line)
+            handler = getattr(self, "do_" + cmd, None)
+            if handler is None:
+                self._reply("502 Command not implemented")
+                continue
+            elif cmd in self.server.denied:
+                self._reply("550 Permission denied")
+                continue
+            try:
+                handler(arg)
+            except (IOError, OSError) as e:
+                self._reply("550 %s" % e)
+            if cmd == "QUIT":
+                break
+
+    def do_USER(self, arg):
+        self._reply("331 Password required")
+
+    def do_PASS(self, arg):
+        self._reply("230 Logged in")
+
+    def do_TYPE(self, arg):
+        self._reply("200 Type set")
+
+    def do_OPTS(self, arg):
+        self._reply("200 OK")
+
+    def do_NOOP(self, arg):
+        if not self.server.ignore_noop:
+            self._reply("200 OK")
+
+    def do_QUIT(self, arg):
+        self._reply("221 Bye")
+
+    def do_SYST(self, arg):
+        self._reply("215 UNIX Type: L8")
+
+    def do_FEAT(self, arg):
+        extra = "".join("\r\n %s" % f for f in self.server.features)
+        self._reply("211-Features:\r\n MFMT\r\n MLST type*;size*;modify*;unique*;"
+                    "\r\n EPSV%s\r\n211 End" % extra)
+
+    def do_PWD(self, arg):
+        self._reply('257 "%s"' % self.cur_dir)
+
+    def do_CWD(self, arg):
+        if not os.path.isdir(self._path(arg)):
+            self._reply("550 No such directory")
+            return
+        self.cur_dir = posixpath.normpath(posixpath.join(self.cur_dir, arg))
+        self._reply("250 OK")
+
+    def do_CDUP(self, arg):
+        self.do_CWD("..")
+
+    def _listen(self):
+        self.data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.data_sock.bind(("127.0.0.1", 0))
+        self.data_sock.listen(1)
+        return self.data_sock.getsockname()[1]
+
+    def do_EPSV(self, arg):
+        self._reply("229 Entering Extended Passive Mode (|||%s|)" % self._listen())
+
+    def do_PASV(self, arg):
+        port = self._listen()
+        self._reply("227 Entering Passive Mode (127,0,0,1,%s,%s)" % (port >> 8, port & 0xFF))
+
+    def do_MLSD(self, arg):
+        path = self._path(arg)
+        conn = self._accept_data()
+        for name in sorted(os.listdir(path)):
+            stat = os.lstat(os.path.join(path, name))
+            modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(stat.st_mtime))
+            if os.path.isdir(os.path.join(path, name)):
+                facts = "type=dir;modify=%s;unique=%s;" % (modify, stat.st_ino)
+            else:
+                facts = "type=file;size=%s;modify=%s;unique=%s;" % (
+                    stat.st_size, modify, stat.st_ino)
+            conn.sendall(("%s %s\r\n" % (facts, name)).encode("utf-8"))
+        conn.close()
+        self._reply("226 Transfer complete")
+
+    def do_MLST(self, arg):
+        path = self._path(arg)
+        stat = os.lstat(path)
+        res_type = "dir" if os.path.isdir(path) else "file"
+        self._reply("250-Listing\r\n type=%s;size=%s; %s\r\n250 End"
+                    % (res_type, stat.st_size, arg))
+
+    def do_RETR(self, arg):
+        with open(self._path(arg), "rb") as f:
+            conn = self._accept_data()
+            conn.sendall(f.read())
+        conn.close()
+        self._reply("226 Transfer complete")
+
+    def do_STOR(self, arg):
+        conn = self._accept_data()
+        with open(self._path(arg), "wb") as f:
+            while True:
+                data = conn.recv(8192)
+                if not data:
+                    break
+                f.write(data)
+        conn.close()
+        self._reply("226 Transfer complete")
+
+    def do_DELE(self, arg):
+        os.remove(self._path(arg))
+        self._reply("250 Deleted")
+
+    def do_MKD(self, arg):
+        os.mkdir(self._path(arg))
+        self._reply('257 "%s" created' % arg)
+
+    def do_RMD(self, arg):
+        os.rmdir(self._path(arg))
+        self._reply("250 Removed")
+
+    def do_RNFR(self, arg):
+        self.rename_from = self._path(arg)
+        self._reply("350 Ready for RNTO")
+
+    def do_RNTO(self, arg):
+        os.rename(self.rename_from, self._path(arg))
+        self._reply("250 Renamed")
+
+    def do_XMD5(self, arg):
+        if "XMD5" not in self.server.features:
+            self._reply("502 Command not implemented")
+            return
+        with open(self._path(arg), "rb") as f:
+            self._reply("250 %s" % hashlib.md5(f.read()).hexdigest())
+
+    def do_MFMT(self, arg):
+        stamp, _, name = arg.partition(" ")
+        mtime = calendar.timegm(time.strptime(stamp, "%Y%m%d%H%M%S"))
+        os.utime(self._path(name), (mtime, mtime))
+        self._reply("213 Modify=%s; %s" % (stamp, name))
+
+
+class FakeFtpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Serve `root_dir` on a random localhost port (for tests only).
+
+    All received command lines are recorded in `commands`.
+    Set `ignore_noop` to simulate a server that chokes on pipelined commands.
+    Optional commands (e.g. 'XMD5') are enabled by adding them to `features`.
+    Commands in `denied` (e.g. 'DELE') are answered with '550 Permission denied'.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, root_dir):
+        socketserver.TCPServer.__init__(self, ("127.0.0.1", 0), _FakeFtpHandler)
+        self.root_dir = root_dir
+        self.commands = []
+        self.ignore_noop = False
+        self.features = []
+        self.denied = set()
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def get_url(self, path="/"):
+        return "ftp://127.0.0.1:%s%s" % (self.server_address[1], path)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
 # def prepare_test_folder(path, files):
 #     _empty_folder(path)
 #     for f in files: